@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from .constrained import FSMIndex, FSMLogitsProcessor
+from .fsm import RegexFSM, json_schema_to_regex
 from .logits_process import FusedLogitsWarper
-from .token_selector import TokenSelector
+from .prompt_lookup import PromptLookupIndex
+from .token_selector import BatchedTokenSelector, TokenSelector
 from .utils import NeuronGenerationMixin
@@ -0,0 +1,376 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Constrained decoding: restrict the generated tokens to the strings matching a regular expression."""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from transformers import PreTrainedTokenizerBase
+from transformers.generation import LogitsProcessor
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from ..utils.cache_utils import HF_HOME
+from .fsm import RegexFSM, json_schema_to_regex
+
+
+logger = logging.getLogger(__name__)
+
+# The version of the index format: cached indices of a different version are ignored
+_INDEX_VERSION = 2
+
+
+_BYTE_FALLBACK = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+
+
+def _token_bytes(tokenizer: PreTrainedTokenizerBase) -> List[Optional[bytes]]:
+    """Return the UTF-8 bytes of each token of the vocabulary when it is appended to a sequence.
+
+    Tokens that do not correspond to a complete text (e.g. a part of a multi-byte character) are indexed by their raw
+    bytes, obtained from the byte-level BPE alphabet or from the sentencepiece byte fallback tokens (`<0xE2>`).
+    Special tokens and tokens whose bytes cannot be determined are `None`.
+    """
+    special_ids = set(tokenizer.all_special_ids)
+    byte_decoder = {char: byte for byte, char in bytes_to_unicode().items()}
+    token_bytes = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token is None or token_id in special_ids:
+            token_bytes.append(None)
+            continue
+        text = tokenizer.convert_tokens_to_string([token])
+        # Sentencepiece decoders drop the leading space of the first token of a sequence
+        if token.startswith("▁") and not text.startswith(" "):
+            text = " " + text
+        if "�" not in text:
+            token_bytes.append(text.encode() if len(text) > 0 else None)
+            continue
+        byte_fallback = _BYTE_FALLBACK.fullmatch(token)
+        if byte_fallback is not None:
+            token_bytes.append(bytes([int(byte_fallback.group(1), 16)]))
+        elif all(char in byte_decoder for char in token):
+            token_bytes.append(bytes(byte_decoder[char] for char in token))
+        else:
+            token_bytes.append(None)
+    return token_bytes
+
+
+def _utf8_length(byte: int) -> int:
+    """Return the length of the UTF-8 encoding of a character starting with a byte (0 for invalid leading bytes)."""
+    if byte < 0x80:
+        return 1
+    if 0xC2 <= byte < 0xE0:
+        return 2
+    if 0xE0 <= byte < 0xF0:
+        return 3
+    if 0xF0 <= byte < 0xF5:
+        return 4
+    return 0
+
+
+def _second_byte_range(byte: int) -> Tuple[int, int]:
+    """Return the range of the valid second bytes of a character starting with a byte.
+
+    Overlong encodings, surrogates and code points beyond U+10FFFF are excluded.
+    """
+    return {0xE0: (0xA0, 0xC0), 0xED: (0x80, 0xA0), 0xF0: (0x90, 0xC0), 0xF4: (0x80, 0x90)}.get(byte, (0x80, 0xC0))
+
+
+def _byte_transitions(fsm: RegexFSM) -> np.ndarray:
+    """Return the transition table of a `RegexFSM` over the UTF-8 bytes of the strings.
+
+    The first `fsm.num_states` states are the states of the machine, and the additional states stand for the
+    incomplete characters whose first bytes have been read. The last state is a sink state for rejected bytes.
+
+    Return:
+        `np.ndarray`: the `(num_states + 1, 256)` table of the state reached from each state by each byte.
+    """
+    rows = [np.full(256, -1, dtype=np.int64) for _ in range(fsm.num_states)]
+
+    def add_state() -> int:
+        rows.append(np.full(256, -1, dtype=np.int64))
+        return len(rows) - 1
+
+    # The states expecting the remaining continuation bytes of a character leading to a state
+    continuations = {}
+
+    def continuation(target: int, remaining: int, valid_bytes: Tuple[int, int] = (0x80, 0xC0)) -> int:
+        state = continuations.get((target, remaining, valid_bytes))
+        if state is None:
+            next_state = target if remaining == 1 else continuation(target, remaining - 1)
+            state = add_state()
+            rows[state][valid_bytes[0] : valid_bytes[1]] = next_state
+            continuations[(target, remaining, valid_bytes)] = state
+        return state
+
+    for state in range(fsm.num_states):
+        transitions = fsm.transitions[state]
+        default = transitions.get(None, -1)
+        if default >= 0:
+            # Any character that does not appear in the expression leads to the default state
+            rows[state][0x00:0x80] = default
+            for byte in range(0xC2, 0xF5):
+                rows[state][byte] = continuation(default, _utf8_length(byte) - 1, _second_byte_range(byte))
+        # The characters of the expression are inserted in a trie of their bytes
+        prefixes = {b"": state}
+        for char, target in transitions.items():
+            # Surrogates cannot be encoded, and cannot appear in a generated text either
+            encoded = b"" if char is None else char.encode(errors="ignore")
+            if len(encoded) == 0:
+                continue
+            for length in range(1, len(encoded)):
+                prefix = encoded[:length]
+                if prefix not in prefixes:
+                    prefixes[prefix] = add_state()
+                    if default >= 0:
+                        # The other characters starting with the same bytes lead to the default state
+                        remaining = _utf8_length(encoded[0]) - length
+                        valid_bytes = _second_byte_range(encoded[0]) if length == 1 else (0x80, 0xC0)
+                        rows[prefixes[prefix]][valid_bytes[0] : valid_bytes[1]] = (
+                            default if remaining == 1 else continuation(default, remaining - 1)
+                        )
+                    rows[prefixes[prefix[:-1]]][prefix[-1]] = prefixes[prefix]
+            rows[prefixes[encoded[:-1]]][encoded[-1]] = target
+    table = np.stack(rows + [np.full(256, -1, dtype=np.int64)])
+    table[table < 0] = len(rows)
+    return table
+
+
+class FSMIndex:
+    """The tokens that can be generated in each state of a `RegexFSM`.
+
+    The machine reads the UTF-8 bytes of the tokens, so that the tokens holding a part of a multi-byte character can
+    be generated: its states include the states of the incomplete characters (see `num_states`).
+    For each state, the tokens of the vocabulary whose bytes lead to a state from which the end of the expression
+    can still be reached are precomputed once, and stored as a `(num_states + 1, vocab_size)` boolean mask.
+    The end-of-sequence token is allowed in the final states, and the last row of the mask (only allowing the
+    end-of-sequence token) is used for sequences that are already finished.
+
+    The vocabulary is evaluated for all states at once, as a sequence of gather operations on the transition table of
+    the machine, but it can still take a few seconds for large expressions and vocabularies: indices are therefore
+    cached on disk, identified by a hash of the tokenizer vocabulary and of the expression.
+
+    Instances should be obtained by calling `FSMIndex.from_regex()` or `FSMIndex.from_json_schema()`.
+
+    Args:
+        fsm (`RegexFSM`):
+            The finite-state machine of the expression.
+        token_bytes (`List[Optional[bytes]]`):
+            The bytes of each token of the vocabulary (`None` for tokens that cannot be generated).
+        eos_token_id (`int`):
+            The end-of-sequence token id.
+        masks (`torch.Tensor`):
+            The `(num_states + 1, vocab_size)` boolean mask of the tokens allowed in each state.
+    """
+
+    def __init__(self, fsm: RegexFSM, token_bytes: List[Optional[bytes]], eos_token_id: int, masks: torch.Tensor):
+        self.fsm = fsm
+        self.token_bytes = token_bytes
+        self.transitions = _byte_transitions(fsm)
+        self.eos_token_id = eos_token_id
+        self.masks = masks
+        self._padded_masks: Dict[int, torch.Tensor] = {}
+
+    @classmethod
+    def from_regex(
+        cls, pattern: str, tokenizer: PreTrainedTokenizerBase, cache_dir: Optional[str] = None
+    ) -> "FSMIndex":
+        """Build or load the index of a regular expression for a tokenizer.
+
+        Args:
+            pattern (`str`):
+                The regular expression the whole generated text must match.
+            tokenizer (`transformers.PreTrainedTokenizerBase`):
+                The tokenizer of the model.
+            cache_dir (`Optional[str]`, defaults to `None`):
+                The directory where indices are cached. Defaults to `$HF_HOME/optimum-neuron/fsm`.
+
+        Return:
+            `FSMIndex`: the index of the expression.
+        """
+        fsm = RegexFSM(pattern)
+        token_bytes = _token_bytes(tokenizer)
+        eos_token_id = tokenizer.eos_token_id
+        if cache_dir is None:
+            cache_dir = os.path.join(HF_HOME, "optimum-neuron", "fsm")
+        vocabulary = [None if token is None else token.hex() for token in token_bytes]
+        key = hashlib.sha256(json.dumps([_INDEX_VERSION, pattern, eos_token_id, vocabulary]).encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{key}.npz")
+        if os.path.exists(cache_path):
+            logger.debug(f"Loading the index of {pattern!r} from {cache_path}")
+            with np.load(cache_path) as data:
+                masks = np.unpackbits(data["masks"], axis=-1, count=len(token_bytes)).astype(bool)
+            return cls(fsm, token_bytes, eos_token_id, torch.from_numpy(masks))
+        masks = cls._build_masks(fsm, token_bytes, eos_token_id)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, as the cache can be shared by several processes
+        temporary_path = f"{cache_path}.{os.getpid()}.npz"
+        np.savez_compressed(temporary_path, masks=np.packbits(masks.numpy(), axis=-1))
+        os.replace(temporary_path, cache_path)
+        return cls(fsm, token_bytes, eos_token_id, masks)
+
+    @classmethod
+    def from_json_schema(
+        cls,
+        schema: Union[str, Dict[str, Any]],
+        tokenizer: PreTrainedTokenizerBase,
+        cache_dir: Optional[str] = None,
+    ) -> "FSMIndex":
+        """Build or load the index of the JSON documents following a JSON schema for a tokenizer.
+
+        Args:
+            schema (`Union[str, Dict[str, Any]]`):
+                The JSON schema, as a dictionary or a serialized JSON string.
+            tokenizer (`transformers.PreTrainedTokenizerBase`):
+                The tokenizer of the model.
+            cache_dir (`Optional[str]`, defaults to `None`):
+                The directory where indices are cached. Defaults to `$HF_HOME/optimum-neuron/fsm`.
+
+        Return:
+            `FSMIndex`: the index of the schema.
+        """
+        return cls.from_regex(json_schema_to_regex(schema), tokenizer, cache_dir)
+
+    @staticmethod
+    def _build_masks(fsm: RegexFSM, token_bytes: List[Optional[bytes]], eos_token_id: int) -> torch.Tensor:
+        table = torch.from_numpy(_byte_transitions(fsm))
+        num_states = table.shape[0] - 1
+        # Walk the bytes of the tokens from all states at once, grouping the tokens of the same length
+        targets = torch.full([num_states, len(token_bytes)], fill_value=num_states, dtype=torch.int64)
+        tokens_by_length = defaultdict(list)
+        for token_id, token in enumerate(token_bytes):
+            if token is not None:
+                tokens_by_length[len(token)].append(token_id)
+        all_states = torch.arange(num_states)[:, None]
+        for length, token_ids in tokens_by_length.items():
+            values = torch.tensor([list(token_bytes[token_id]) for token_id in token_ids])
+            states = all_states.expand(num_states, len(token_ids))
+            for position in range(length):
+                states = table[states, values[:, position]]
+            targets[:, token_ids] = states
+        # Only keep the tokens leading to states from which a final state can be reached by a sequence of tokens
+        predecessors = defaultdict(set)
+        for state in range(num_states):
+            for target in torch.unique(targets[state]).tolist():
+                predecessors[target].add(state)
+        live_states = set(fsm.finals)
+        pending = list(live_states)
+        while pending:
+            for state in predecessors[pending.pop()] - live_states:
+                live_states.add(state)
+                pending.append(state)
+        if 0 not in live_states:
+            raise ValueError(f"No sequence of tokens matches the regular expression {fsm.pattern!r}.")
+        live = torch.zeros(num_states + 1, dtype=torch.bool)
+        live[list(live_states)] = True
+        masks = torch.zeros([num_states + 1, len(token_bytes)], dtype=torch.bool)
+        masks[:num_states] = live[targets]
+        masks[list(fsm.finals), eos_token_id] = True
+        masks[num_states, eos_token_id] = True
+        return masks
+
+    @property
+    def num_states(self) -> int:
+        """The number of states of the machine reading bytes, including the states of incomplete characters."""
+        return self.transitions.shape[0] - 1
+
+    def next_state(self, state: int, token_id: int) -> int:
+        """Return the state reached after a token, or -1 if the token ends or does not match the expression."""
+        if state < 0 or token_id >= len(self.token_bytes) or self.token_bytes[token_id] is None:
+            return -1
+        for byte in self.token_bytes[token_id]:
+            state = self.transitions[state, byte]
+        return -1 if state == self.num_states else int(state)
+
+    def mask(self, states: torch.LongTensor, vocab_size: int) -> torch.Tensor:
+        """Return the mask of the tokens allowed in each state.
+
+        Args:
+            states (`torch.LongTensor` of shape `(batch_size,)`):
+                The current state of each sequence (-1 for finished sequences).
+            vocab_size (`int`):
+                The size of the model logits, that may be padded beyond the tokenizer vocabulary.
+
+        Return:
+            `torch.Tensor`: A `(batch_size, vocab_size)` boolean mask.
+        """
+        masks = self._padded_masks.get(vocab_size)
+        if masks is None:
+            masks = torch.zeros([self.masks.shape[0], vocab_size], dtype=torch.bool)
+            width = min(vocab_size, self.masks.shape[-1])
+            masks[:, :width] = self.masks[:, :width]
+            self._padded_masks[vocab_size] = masks
+        return masks[states]
+
+
+class FSMLogitsProcessor(LogitsProcessor):
+    """A logits processor masking the tokens that would prevent the generated text from matching an `FSMIndex`.
+
+    The state of each sequence is obtained by walking its generated tokens through the machine: the states of the
+    previous call are kept, so that only the new tokens are walked.
+
+    Args:
+        index (`FSMIndex`):
+            The index of the expression the generated text must match.
+        prompt_length (`Optional[int]`, defaults to `None`):
+            The number of tokens of the prompt, that are not constrained. Defaults to the length of the
+            sequences passed to the first call.
+    """
+
+    def __init__(self, index: FSMIndex, prompt_length: Optional[int] = None):
+        self.index = index
+        self.prompt_length = prompt_length
+        # The generated tokens and corresponding states of each sequence
+        self._walks: Dict[int, Tuple[List[int], List[int]]] = {}
+
+    def states(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """Evaluate the current state of each sequence.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The tokens of each sequence. Negative values are considered as padding and ignored.
+
+        Return:
+            `torch.LongTensor`: The state of each sequence (-1 if the sequence is finished).
+        """
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1]
+        states = []
+        for i, sequence in enumerate(input_ids[:, self.prompt_length :].tolist()):
+            tokens = [token for token in sequence if token >= 0]
+            walked_tokens, walked_states = self._walks.get(i, ([], [0]))
+            # Reuse the states of the longest common prefix with the previous call
+            limit = min(len(tokens), len(walked_tokens))
+            length = 0
+            while length < limit and tokens[length] == walked_tokens[length]:
+                length += 1
+            walked_states = walked_states[: length + 1]
+            for token in tokens[length:]:
+                walked_states.append(self.index.next_state(walked_states[-1], token))
+            self._walks[i] = (tokens, walked_states)
+            states.append(walked_states[-1])
+        return torch.tensor(states)
+
+    def mask(self, input_ids: torch.LongTensor, vocab_size: int) -> torch.Tensor:
+        """Return the `(batch_size, vocab_size)` boolean mask of the tokens allowed for each sequence."""
+        return self.index.mask(self.states(input_ids), vocab_size)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return scores.masked_fill(~self.mask(input_ids, scores.shape[-1]), float("-Inf"))
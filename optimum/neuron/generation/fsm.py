@@ -0,0 +1,501 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compilation of regular expressions and JSON schemas into deterministic finite-state machines."""
+
+import json
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple, Union
+
+
+class _CharSet:
+    """A set of characters, possibly negated (i.e. all the characters that are not in the set)."""
+
+    __slots__ = ("chars", "negated")
+
+    def __init__(self, chars: FrozenSet[str], negated: bool = False):
+        self.chars = chars
+        self.negated = negated
+
+    def __contains__(self, char: Optional[str]) -> bool:
+        # None stands for any character that does not appear explicitly in the expression
+        if char is None:
+            return self.negated
+        return (char in self.chars) != self.negated
+
+
+_DIGITS = frozenset("0123456789")
+_WORD = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+_SPACES = frozenset(" \t\n\r\f\v")
+_CLASS_ESCAPES = {
+    "d": _CharSet(_DIGITS),
+    "D": _CharSet(_DIGITS, negated=True),
+    "w": _CharSet(_WORD),
+    "W": _CharSet(_WORD, negated=True),
+    "s": _CharSet(_SPACES),
+    "S": _CharSet(_SPACES, negated=True),
+}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+# Regular expression syntax tree nodes
+_Node = Tuple
+
+
+class _RegexParser:
+    """A recursive descent parser for the subset of the python regular expression syntax describing regular languages.
+
+    Supported constructs: literals and escapes, `.`, character classes (`[a-z]`, `[^"]`, `\\d`, `\\w`, `\\s`),
+    groups (capturing or not), alternation and the `*`, `+`, `?`, `{m}`, `{m,}` and `{m,n}` quantifiers.
+    The `^` and `$` anchors are accepted at the boundaries of the expression, since the whole generated
+    text must match it anyway. Backreferences and lookarounds are not supported.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.position = 0
+
+    def parse(self) -> _Node:
+        node = self._alternation()
+        if self.position < len(self.pattern):
+            raise self._error("unbalanced parenthesis")
+        return node
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f"Unsupported regular expression {self.pattern!r} at position {self.position}: {message}.")
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.position] if self.position < len(self.pattern) else None
+
+    def _next(self) -> str:
+        char = self._peek()
+        if char is None:
+            raise self._error("unexpected end of expression")
+        self.position += 1
+        return char
+
+    def _alternation(self) -> _Node:
+        branches = [self._concatenation()]
+        while self._peek() == "|":
+            self.position += 1
+            branches.append(self._concatenation())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _concatenation(self) -> _Node:
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            items.append(self._repetition())
+        return ("cat", items)
+
+    def _repetition(self) -> _Node:
+        node = self._atom()
+        while True:
+            char = self._peek()
+            if char == "*":
+                bounds = (0, None)
+            elif char == "+":
+                bounds = (1, None)
+            elif char == "?":
+                bounds = (0, 1)
+            elif char == "{" and re.match(r"\{\d+(,\d*)?\}", self.pattern[self.position :]):
+                end = self.pattern.index("}", self.position)
+                values = self.pattern[self.position + 1 : end].split(",")
+                bounds = (
+                    int(values[0]),
+                    int(values[0]) if len(values) == 1 else int(values[1]) if values[1] else None,
+                )
+                if bounds[1] is not None and bounds[1] < bounds[0]:
+                    raise self._error("invalid repetition bounds")
+                self.position = end
+            else:
+                return node
+            self.position += 1
+            if self._peek() == "+":
+                # Possessive quantifiers never backtrack, so they may reject strings the greedy quantifiers match
+                raise self._error("possessive quantifiers are not supported")
+            if self._peek() == "?":
+                # Lazy quantifiers match the same language as greedy quantifiers
+                self.position += 1
+            node = ("rep", node, bounds[0], bounds[1])
+
+    def _atom(self) -> _Node:
+        char = self._next()
+        if char == "(":
+            if self.pattern.startswith("?:", self.position):
+                self.position += 2
+            elif self._peek() == "?":
+                raise self._error("lookarounds and group flags are not supported")
+            node = self._alternation()
+            if self._next() != ")":
+                raise self._error("unbalanced parenthesis")
+            return node
+        if char == "[":
+            return ("set", self._char_class())
+        if char == ".":
+            return ("set", _CharSet(frozenset("\n"), negated=True))
+        if char in "^$":
+            if (char == "^" and self.position != 1) or (char == "$" and self.position != len(self.pattern)):
+                raise self._error("anchors are only supported at the boundaries of the expression")
+            return ("cat", [])
+        if char == "\\":
+            return ("set", self._escape())
+        if char in "*+?":
+            raise self._error("nothing to repeat")
+        return ("set", _CharSet(frozenset(char)))
+
+    def _escape(self) -> _CharSet:
+        char = self._next()
+        if char in _CLASS_ESCAPES:
+            return _CLASS_ESCAPES[char]
+        if char in _CHAR_ESCAPES:
+            return _CharSet(frozenset(_CHAR_ESCAPES[char]))
+        if char in "xu":
+            length = 2 if char == "x" else 4
+            code = self.pattern[self.position : self.position + length]
+            if not re.fullmatch(f"[0-9a-fA-F]{{{length}}}", code):
+                raise self._error("invalid character code")
+            self.position += length
+            return _CharSet(frozenset(chr(int(code, 16))))
+        if char.isalnum():
+            raise self._error(f"unsupported escape sequence \\{char}")
+        return _CharSet(frozenset(char))
+
+    def _char_class(self) -> _CharSet:
+        negated = self._peek() == "^"
+        if negated:
+            self.position += 1
+        chars: Set[str] = set()
+        first = True
+        while first or self._peek() != "]":
+            first = False
+            char = self._next()
+            if char == "\\":
+                escaped = self._escape()
+                if escaped.negated:
+                    raise self._error("negated classes are not supported inside character classes")
+                if len(escaped.chars) > 1:
+                    chars |= escaped.chars
+                    continue
+                char = next(iter(escaped.chars))
+            if self._peek() == "-" and self.pattern[self.position + 1 : self.position + 2] not in ("]", ""):
+                self.position += 1
+                last = self._next()
+                if last == "\\":
+                    escaped = self._escape()
+                    if escaped.negated or len(escaped.chars) > 1:
+                        raise self._error("invalid character range")
+                    last = next(iter(escaped.chars))
+                if ord(last) < ord(char):
+                    raise self._error("invalid character range")
+                chars |= {chr(code) for code in range(ord(char), ord(last) + 1)}
+            else:
+                chars.add(char)
+        self.position += 1
+        return _CharSet(frozenset(chars), negated)
+
+
+class _NFA:
+    """A non-deterministic finite automaton with epsilon transitions (Thompson construction)."""
+
+    def __init__(self):
+        self.epsilons: List[List[int]] = []
+        self.transitions: List[List[Tuple[_CharSet, int]]] = []
+
+    def add_state(self) -> int:
+        self.epsilons.append([])
+        self.transitions.append([])
+        return len(self.epsilons) - 1
+
+    def build(self, node: _Node, start: int) -> int:
+        """Add the states matching a syntax tree node from a start state, and return the end state."""
+        kind = node[0]
+        if kind == "set":
+            end = self.add_state()
+            self.transitions[start].append((node[1], end))
+            return end
+        if kind == "cat":
+            for item in node[1]:
+                start = self.build(item, start)
+            return start
+        if kind == "alt":
+            end = self.add_state()
+            for branch in node[1]:
+                branch_start = self.add_state()
+                self.epsilons[start].append(branch_start)
+                self.epsilons[self.build(branch, branch_start)].append(end)
+            return end
+        _, item, min_count, max_count = node
+        for _ in range(min_count):
+            start = self.build(item, start)
+        if max_count is None:
+            loop_start = self.add_state()
+            self.epsilons[start].append(loop_start)
+            self.epsilons[self.build(item, loop_start)].append(loop_start)
+            end = self.add_state()
+            self.epsilons[loop_start].append(end)
+            return end
+        end = self.add_state()
+        for _ in range(max_count - min_count):
+            self.epsilons[start].append(end)
+            start = self.build(item, start)
+        self.epsilons[start].append(end)
+        return end
+
+    def closure(self, states: Set[int]) -> FrozenSet[int]:
+        stack = list(states)
+        closure = set(states)
+        while stack:
+            for state in self.epsilons[stack.pop()]:
+                if state not in closure:
+                    closure.add(state)
+                    stack.append(state)
+        return frozenset(closure)
+
+
+class RegexFSM:
+    """A deterministic finite-state machine matching the strings of a regular expression.
+
+    The states are numbered from zero (the initial state). The transitions of each state are indexed by the
+    characters appearing explicitly in the expression, and all the other characters lead to the same default state.
+
+    Args:
+        pattern (`str`):
+            The regular expression. The whole string must match the expression (as with `re.fullmatch`).
+        max_states (`int`, defaults to 100000):
+            The maximum number of states of the machine, to avoid the exponential blow-up of some expressions.
+    """
+
+    def __init__(self, pattern: str, max_states: int = 100000):
+        self.pattern = pattern
+        nfa = _NFA()
+        nfa_start = nfa.add_state()
+        nfa_end = nfa.build(_RegexParser(pattern).parse(), nfa_start)
+        alphabet = sorted(
+            {char for transitions in nfa.transitions for charset, _ in transitions for char in charset.chars}
+        )
+        # The transitions of each state for each character of the alphabet (None being any other character)
+        self.transitions: List[Dict[Optional[str], int]] = []
+        self.finals: Set[int] = set()
+        initial = nfa.closure({nfa_start})
+        states = {initial: 0}
+        pending = [initial]
+        while pending:
+            nfa_states = pending.pop()
+            state = states[nfa_states]
+            while len(self.transitions) <= state:
+                self.transitions.append({})
+            if nfa_end in nfa_states:
+                self.finals.add(state)
+            for char in alphabet + [None]:
+                targets = {
+                    target
+                    for nfa_state in nfa_states
+                    for charset, target in nfa.transitions[nfa_state]
+                    if char in charset
+                }
+                if len(targets) == 0:
+                    continue
+                next_nfa_states = nfa.closure(targets)
+                if next_nfa_states not in states:
+                    if len(states) >= max_states:
+                        raise ValueError(f"The regular expression {pattern!r} requires more than {max_states} states.")
+                    states[next_nfa_states] = len(states)
+                    pending.append(next_nfa_states)
+                self.transitions[state][char] = states[next_nfa_states]
+        for transitions in self.transitions:
+            default = transitions.get(None)
+            if default is None:
+                continue
+            for char in alphabet:
+                target = transitions.pop(char, -1)
+                if target != default:
+                    # Characters that appear in the expression have an explicit transition (possibly rejected)
+                    transitions[char] = target
+
+    @property
+    def num_states(self) -> int:
+        return len(self.transitions)
+
+    def next_state(self, state: int, char: str) -> int:
+        """Return the state reached from a state by a character, or -1 if the character is not accepted."""
+        transitions = self.transitions[state]
+        target = transitions.get(char)
+        if target is None:
+            target = transitions.get(None, -1)
+        return target
+
+    def walk(self, state: int, text: str) -> int:
+        """Return the state reached from a state by a string, or -1 if the string is not accepted."""
+        for char in text:
+            state = self.next_state(state, char)
+            if state < 0:
+                break
+        return state
+
+    def matches(self, text: str) -> bool:
+        """Whether a string matches the expression."""
+        return self.walk(0, text) in self.finals
+
+
+_WHITESPACE = r"[ ]?"
+_JSON_STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt])'
+_JSON_TYPES = {
+    "string": f'"{_JSON_STRING_CHAR}*"',
+    "integer": r"-?(0|[1-9][0-9]*)",
+    "number": r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?",
+    "boolean": r"(true|false)",
+    "null": r"null",
+}
+
+
+def json_schema_to_regex(schema: Union[str, Dict[str, Any]]) -> str:
+    """Convert a JSON schema into a regular expression matching the JSON documents that follow the schema.
+
+    The properties of objects are generated in the order of the schema, with optional whitespace after separators.
+    Supported keywords: `type` (including lists of types), `properties`, `required`, `items`, `minItems`, `maxItems`,
+    `enum`, `const`, `anyOf`, `oneOf`, `allOf` (with a single schema), `minLength`, `maxLength`, `pattern` and local
+    `$ref` definitions (non-recursive). Objects without properties and schemas without type match any JSON value
+    of limited nesting depth.
+
+    Args:
+        schema (`Union[str, Dict[str, Any]]`):
+            The JSON schema, as a dictionary or a serialized JSON string.
+
+    Return:
+        `str`: A regular expression that can be compiled into a `RegexFSM`.
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    return _schema_to_regex(schema, schema, set())
+
+
+def _schema_to_regex(schema: Dict[str, Any], root: Dict[str, Any], refs: Set[str]) -> str:
+    if schema is True or schema == {}:
+        return _any_json_regex()
+    if "$ref" in schema:
+        ref = schema["$ref"]
+        if not ref.startswith("#/") or ref in refs:
+            raise ValueError(
+                f"Unsupported JSON schema reference {ref} (only non-recursive local references are supported)."
+            )
+        target = root
+        for key in ref[2:].split("/"):
+            target = target[key]
+        return _schema_to_regex(target, root, refs | {ref})
+    if "const" in schema:
+        return re.escape(json.dumps(schema["const"]))
+    if "enum" in schema:
+        return "(" + "|".join(re.escape(json.dumps(value)) for value in schema["enum"]) + ")"
+    for keyword in ("anyOf", "oneOf"):
+        if keyword in schema:
+            return "(" + "|".join(_schema_to_regex(item, root, refs) for item in schema[keyword]) + ")"
+    if "allOf" in schema:
+        if len(schema["allOf"]) != 1:
+            raise ValueError("Only allOf keywords with a single schema are supported.")
+        return _schema_to_regex(schema["allOf"][0], root, refs)
+    schema_type = schema.get("type")
+    if schema_type is None:
+        if "properties" in schema:
+            schema_type = "object"
+        else:
+            return _any_json_regex()
+    if isinstance(schema_type, list):
+        return "(" + "|".join(_schema_to_regex({**schema, "type": item}, root, refs) for item in schema_type) + ")"
+    if schema_type == "object":
+        properties = schema.get("properties")
+        if not properties:
+            return _any_json_regex()
+        required = set(schema.get("required", []))
+        return _object_regex(
+            [
+                (
+                    f'"{re.escape(name)}"{_WHITESPACE}:{_WHITESPACE}' + _schema_to_regex(value, root, refs),
+                    name in required,
+                )
+                for name, value in properties.items()
+            ]
+        )
+    if schema_type == "array":
+        item = _schema_to_regex(schema.get("items", {}), root, refs)
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+        separator = f",{_WHITESPACE}"
+        if max_items == 0:
+            return rf"\[{_WHITESPACE}\]"
+        # The first item, followed by the other items
+        other_max = "" if max_items is None else max_items - 1
+        items = f"{item}({separator}{item}){{{max(min_items - 1, 0)},{other_max}}}"
+        if min_items == 0:
+            items = f"({items})?"
+        return rf"\[{_WHITESPACE}{items}{_WHITESPACE}\]"
+    if schema_type == "string":
+        if "pattern" in schema:
+            return f'"{_string_pattern_regex(schema["pattern"])}"'
+        if "minLength" in schema or "maxLength" in schema:
+            max_length = schema.get("maxLength", "")
+            return f'"{_JSON_STRING_CHAR}{{{schema.get("minLength", 0)},{max_length}}}"'
+        return _JSON_TYPES["string"]
+    if schema_type in _JSON_TYPES:
+        return _JSON_TYPES[schema_type]
+    raise ValueError(f"Unsupported JSON schema type {schema_type}.")
+
+
+def _string_pattern_regex(pattern: str) -> str:
+    """Build the regular expression of the content of a string matching a JSON schema `pattern`.
+
+    JSON schema patterns match anywhere in the string, unless they are anchored: the unanchored sides are extended
+    with any string characters, and the anchors, only supported at the boundaries of the pattern, are removed.
+    """
+    # Raise early, with the pattern itself in the message, if it contains unsupported constructs
+    _RegexParser(pattern).parse()
+    starts_anchored = pattern.startswith("^")
+    # A trailing dollar is an anchor unless it is escaped by an odd number of backslashes
+    trailing_backslashes = len(pattern[:-1]) - len(pattern[:-1].rstrip("\\"))
+    ends_anchored = pattern.endswith("$") and trailing_backslashes % 2 == 0 and len(pattern) > starts_anchored
+    body = pattern[int(starts_anchored) : len(pattern) - int(ends_anchored)]
+    prefix = "" if starts_anchored else f"{_JSON_STRING_CHAR}*"
+    suffix = "" if ends_anchored else f"{_JSON_STRING_CHAR}*"
+    return f"{prefix}({body}){suffix}"
+
+
+def _object_regex(properties: List[Tuple[str, bool]]) -> str:
+    """Build the regular expression of an object from the expression and requirement of each of its properties."""
+    separator = f"{_WHITESPACE},{_WHITESPACE}"
+    first_required = next((i for i, (_, required) in enumerate(properties) if required), None)
+    if first_required is None:
+        # Any property can be the first one, followed by any subset of the next ones
+        alternatives = []
+        for i, (first, _) in enumerate(properties):
+            alternatives.append(first + "".join(f"({separator}{other})?" for other, _ in properties[i + 1 :]))
+        body = "(" + "|".join(alternatives) + ")?"
+    else:
+        # Optional properties before the first required property are followed by a separator, the other ones
+        # are preceded by a separator
+        body = "".join(f"({regex}{separator})?" for regex, _ in properties[:first_required])
+        body += properties[first_required][0]
+        for regex, required in properties[first_required + 1 :]:
+            body += f"{separator}{regex}" if required else f"({separator}{regex})?"
+    return rf"\{{{_WHITESPACE}{body}{_WHITESPACE}\}}"
+
+
+def _any_json_regex(depth: int = 2) -> str:
+    """A regular expression matching any JSON value with at most `depth` levels of nested arrays and objects."""
+    scalar = "(" + "|".join(_JSON_TYPES[name] for name in ("string", "number", "boolean", "null")) + ")"
+    value = scalar
+    for _ in range(depth):
+        separator = f"{_WHITESPACE},{_WHITESPACE}"
+        member = f'{_JSON_TYPES["string"]}{_WHITESPACE}:{_WHITESPACE}{value}'
+        array = rf"\[{_WHITESPACE}({value}({separator}{value})*)?{_WHITESPACE}\]"
+        obj = rf"\{{{_WHITESPACE}({member}({separator}{member})*)?{_WHITESPACE}\}}"
+        value = f"({scalar}|{array}|{obj})"
+    return value
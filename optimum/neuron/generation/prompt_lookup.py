@@ -0,0 +1,50 @@
+from typing import Dict, List, Sequence, Tuple
+
+
+class PromptLookupIndex:
+    """Propose continuation tokens by looking up the last tokens of a sequence in its prompt.
+
+    When the generated text copies spans of the prompt (typically for summarization or code editing), the tokens
+    following the last n-gram of the sequence are likely to be the tokens following the same n-gram in the prompt.
+    These tokens can be proposed for speculative decoding without any draft model.
+
+    The positions of all the n-grams of the prompt are indexed when the index is created, so that each lookup only
+    costs a few dictionary accesses.
+
+    Args:
+        prompt_ids (`Sequence[int]`):
+            The token ids of the prompt.
+        max_ngram_size (`int`, defaults to 3):
+            The size of the longest n-gram to match: shorter n-grams are only matched if no longer n-gram matches.
+    """
+
+    def __init__(self, prompt_ids: Sequence[int], max_ngram_size: int = 3):
+        if max_ngram_size < 1:
+            raise ValueError("The n-gram size must be at least 1.")
+        self.prompt_ids = list(prompt_ids)
+        self.max_ngram_size = max_ngram_size
+        # For each n-gram size, the position of the token following the last occurrence of each n-gram
+        self._positions: List[Dict[Tuple[int, ...], int]] = []
+        for n in range(1, max_ngram_size + 1):
+            positions = {}
+            for start in range(len(self.prompt_ids) - n):
+                positions[tuple(self.prompt_ids[start : start + n])] = start + n
+            self._positions.append(positions)
+
+    def propose(self, token_ids: Sequence[int], num_tokens: int) -> List[int]:
+        """Propose the tokens following a sequence.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                The token ids of the sequence (typically the prompt followed by the generated tokens).
+            num_tokens (`int`):
+                The maximum number of proposed tokens.
+
+        Returns:
+            The proposed tokens (possibly empty if the last tokens of the sequence do not appear in the prompt).
+        """
+        for n in range(min(self.max_ngram_size, len(token_ids)), 0, -1):
+            position = self._positions[n - 1].get(tuple(token_ids[-n:]))
+            if position is not None:
+                return self.prompt_ids[position : position + num_tokens]
+        return []
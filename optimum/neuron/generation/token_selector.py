@@ -1,15 +1,17 @@
 import logging
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import torch
 from transformers.generation import (
     GenerationConfig,
     GenerationMixin,
     LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
     StoppingCriteriaList,
 )
 from transformers.generation.utils import GenerationMode
 
+from .constrained import FSMLogitsProcessor
 from .logits_process import FusedLogitsWarper
 
 
@@ -53,7 +55,12 @@ class TokenSelector:
 
     @classmethod
     def create(
-        cls, input_ids: torch.Tensor, generation_config: GenerationConfig, model: GenerationMixin, max_seq_length: int
+        cls,
+        input_ids: torch.Tensor,
+        generation_config: GenerationConfig,
+        model: GenerationMixin,
+        max_seq_length: int,
+        logits_processor: Optional[LogitsProcessorList] = None,
     ) -> "TokenSelector":
         r"""Creates the `TokenSelector` for a specific generation configuration.
 
@@ -66,6 +73,9 @@ class TokenSelector:
                 The model provides the internal helpers allowing to select the logits processors and stopping criterias.
             max_seq_length (`int`):
                 The maximum number of input + generated tokens for this model. It depends on the model compilation parameters.
+            logits_processor (`Optional[transformers.generation.LogitsProcessorList]`, defaults to `None`):
+                Custom logits processors that complement the default logits processors built from the generation
+                configuration (e.g. an `FSMLogitsProcessor` to constrain the generated text).
         Return:
             `torch.LongTensor`: A `torch.LongTensor` containing the selected tokens.
         """
@@ -108,7 +118,7 @@ class TokenSelector:
             input_ids_seq_length=input_ids.shape[-1],
             encoder_input_ids=input_ids,
             prefix_allowed_tokens_fn=None,
-            logits_processor=LogitsProcessorList(),
+            logits_processor=LogitsProcessorList() if logits_processor is None else logits_processor,
         )
         stopping_criteria = model._get_stopping_criteria(generation_config, stopping_criteria=StoppingCriteriaList())
 
@@ -165,3 +175,248 @@ class TokenSelector:
         # Convert the filtered tokens to actual vocabulary tokens
         next_tokens = torch.gather(next_token_indices, 1, next_tokens)
         return next_tokens.squeeze(1)
+
+
+class BatchedTokenSelector:
+    """Implements a vectorized token selection for a batch of sequences with heterogeneous generation parameters.
+
+    Each row of the batch has its own greedy or sampling mode, temperature, top-k, top-p and repetition penalty
+    parameters, stored as tensors, so that the next tokens of all rows can be selected from the full
+    `[batch_size, vocab_size]` logits with a handful of tensor operations.
+
+    The parameters of a row are extracted from the `TokenSelector` of the corresponding sequence.
+    The tokens allowed by the `FSMLogitsProcessor` of constrained rows are applied as a single boolean mask.
+    The other logits processors that cannot be vectorized (other than the repetition penalty) are applied row by row.
+
+    Args:
+        batch_size (`int`):
+            The number of rows of the batch.
+    """
+
+    def __init__(self, batch_size: int):
+        self.do_sample = torch.zeros(batch_size, dtype=torch.bool)
+        self.temperature = torch.ones(batch_size)
+        self.top_k = torch.zeros(batch_size, dtype=torch.int64)
+        self.top_p = torch.ones(batch_size)
+        self.repetition_penalty = torch.ones(batch_size)
+        self.row_processors: List[Optional[LogitsProcessorList]] = [None] * batch_size
+        self.fsm_processors: List[Optional[FSMLogitsProcessor]] = [None] * batch_size
+
+    def set(self, row: int, selector: TokenSelector):
+        """Set the parameters of a row from the `TokenSelector` of a sequence.
+
+        Args:
+            row (`int`):
+                The index of the row.
+            selector (`TokenSelector`):
+                The token selector of the sequence assigned to the row.
+        """
+        self.do_sample[row] = selector.mode == GenerationMode.SAMPLE
+        warper = selector.logits_warper
+        self.temperature[row] = 1.0 if warper is None else warper.temperature
+        self.top_k[row] = 0 if warper is None else warper.top_k
+        self.top_p[row] = 1.0 if warper is None else warper.top_p
+        self.repetition_penalty[row] = 1.0
+        self.fsm_processors[row] = None
+        processors = LogitsProcessorList()
+        for processor in selector.logits_processor:
+            if isinstance(processor, RepetitionPenaltyLogitsProcessor):
+                self.repetition_penalty[row] = processor.penalty
+            elif isinstance(processor, FSMLogitsProcessor):
+                self.fsm_processors[row] = processor
+            else:
+                processors.append(processor)
+        self.row_processors[row] = processors if len(processors) > 0 else None
+
+    def select(
+        self,
+        logits: torch.Tensor,
+        input_ids: Optional[torch.LongTensor] = None,
+        rows: Optional[torch.LongTensor] = None,
+    ) -> torch.LongTensor:
+        """Select the next tokens of all rows from the candidate logits.
+
+        Args:
+            logits (`torch.Tensor` of shape `(batch_size, vocab_size)`):
+                The logits corresponding to the generated tokens.
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                The tokens of each sequence, used to apply the repetition penalty and row-specific logits processors.
+                Negative values are considered as padding and ignored.
+            rows (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The indices of the rows whose parameters apply to each row of the logits. Defaults to all rows.
+
+        Return:
+            `torch.LongTensor`: A `torch.LongTensor` containing the selected tokens.
+        """
+        if rows is None:
+            rows = torch.arange(logits.shape[0])
+        scores = self._process(logits, input_ids, rows)
+        next_tokens = torch.argmax(scores, dim=-1)
+        do_sample = self.do_sample[rows]
+        if torch.any(do_sample):
+            # Only the sampling rows are involved in the (more expensive) sampling operations
+            sample_indices = torch.nonzero(do_sample).squeeze(-1)
+            sample_rows = rows[sample_indices]
+            sorted_scores, sorted_indices = self._warp(
+                scores[sample_indices], self.temperature[sample_rows], self.top_k[sample_rows], self.top_p[sample_rows]
+            )
+            probs = torch.nn.functional.softmax(sorted_scores, dim=-1)
+            next_sorted_tokens = torch.multinomial(probs, num_samples=1)
+            # Convert the filtered tokens to actual vocabulary tokens
+            next_tokens[sample_indices] = torch.gather(sorted_indices, 1, next_sorted_tokens).squeeze(1)
+        return next_tokens
+
+    def probabilities(
+        self,
+        logits: torch.Tensor,
+        input_ids: Optional[torch.LongTensor] = None,
+        rows: Optional[torch.LongTensor] = None,
+    ) -> torch.Tensor:
+        """Evaluate the probability distributions the next tokens of all rows are selected from.
+
+        The distribution of a greedy row gives a probability of one to its best token.
+
+        Args:
+            logits (`torch.Tensor` of shape `(batch_size, vocab_size)`):
+                The logits corresponding to the generated tokens.
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                The tokens of each sequence, used to apply the repetition penalty and row-specific logits processors.
+                Negative values are considered as padding and ignored.
+            rows (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The indices of the rows whose parameters apply to each row of the logits. Defaults to all rows.
+
+        Return:
+            `torch.Tensor`: A `(batch_size, vocab_size)` tensor containing the probabilities of each token.
+        """
+        if rows is None:
+            rows = torch.arange(logits.shape[0])
+        scores = self._process(logits, input_ids, rows)
+        probs = torch.zeros_like(scores, dtype=torch.float)
+        probs.scatter_(1, torch.argmax(scores, dim=-1, keepdim=True), 1.0)
+        do_sample = self.do_sample[rows]
+        if torch.any(do_sample):
+            sample_indices = torch.nonzero(do_sample).squeeze(-1)
+            sample_rows = rows[sample_indices]
+            sorted_scores, sorted_indices = self._warp(
+                scores[sample_indices], self.temperature[sample_rows], self.top_k[sample_rows], self.top_p[sample_rows]
+            )
+            sample_probs = torch.zeros_like(probs[sample_indices])
+            sample_probs.scatter_(1, sorted_indices, torch.nn.functional.softmax(sorted_scores.float(), dim=-1))
+            probs[sample_indices] = sample_probs
+        return probs
+
+    @staticmethod
+    def accept(
+        draft_tokens: torch.LongTensor, draft_probs: torch.Tensor, target_probs: torch.Tensor
+    ) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """Verify the tokens proposed by a draft model using the distributions of the target model.
+
+        This is the rejection sampling scheme of speculative decoding: each draft token `x` is accepted with a
+        probability of `min(1, p(x) / q(x))`, where `p` and `q` are the target and draft distributions.
+        The first rejected token is replaced by a token sampled from the normalized `max(p - q, 0)` distribution,
+        and if all draft tokens are accepted, an additional token is sampled from the last target distribution.
+        The selected tokens then follow the target distributions exactly.
+
+        For greedy rows, both distributions are one-hot: this simply accepts the longest prefix of draft tokens
+        matching the best target tokens.
+
+        Args:
+            draft_tokens (`torch.LongTensor` of shape `(batch_size, k)`):
+                The tokens proposed by the draft model.
+            draft_probs (`torch.Tensor` of shape `(batch_size, k, vocab_size)`):
+                The draft distributions each draft token was selected from.
+            target_probs (`torch.Tensor` of shape `(batch_size, k + 1, vocab_size)`):
+                The target distributions of the token following each prefix of the draft tokens.
+
+        Return:
+            A tuple containing the number of accepted draft tokens of each row, and the `(batch_size,)`
+            next token following the accepted draft tokens of each row.
+        """
+        batch_size, k = draft_tokens.shape
+        index = draft_tokens.unsqueeze(-1)
+        p = torch.gather(target_probs[:, :k], 2, index).squeeze(-1)
+        q = torch.gather(draft_probs, 2, index).squeeze(-1)
+        accepted = torch.rand(p.shape) * q < p
+        # The number of accepted tokens is the position of the first rejected token
+        n_accepted = torch.cumprod(accepted.int(), dim=-1).sum(dim=-1)
+        batch_indices = torch.arange(batch_size)
+        next_probs = target_probs[batch_indices, n_accepted]
+        rejected = n_accepted < k
+        if torch.any(rejected):
+            # Sample the rejected tokens from the residual distributions
+            residual_probs = next_probs[rejected] - draft_probs[batch_indices[rejected], n_accepted[rejected]]
+            residual_probs = residual_probs.clamp(min=0)
+            # The residual distribution is zero only if both distributions are identical (up to rounding errors)
+            empty = residual_probs.sum(dim=-1) <= 0
+            residual_probs[empty] = next_probs[rejected][empty]
+            next_probs[rejected] = residual_probs
+        next_tokens = torch.multinomial(next_probs, num_samples=1).squeeze(1)
+        return n_accepted, next_tokens
+
+    def _process(self, logits: torch.Tensor, input_ids: Optional[torch.LongTensor], rows: torch.LongTensor):
+        """Apply the row-specific logits processors, the constraints and the repetition penalty."""
+        scores = logits
+        fsm_indices = []
+        fsm_masks = []
+        for i, row in enumerate(rows.tolist()):
+            processors = self.row_processors[row]
+            if processors is not None:
+                row_input_ids = input_ids[i : i + 1]
+                row_input_ids = row_input_ids[row_input_ids >= 0].unsqueeze(0)
+                if scores is logits:
+                    scores = logits.clone()
+                scores[i : i + 1] = processors(row_input_ids, scores[i : i + 1])
+            if self.fsm_processors[row] is not None:
+                fsm_indices.append(i)
+                fsm_masks.append(self.fsm_processors[row].mask(input_ids[i : i + 1], logits.shape[-1]))
+        if len(fsm_indices) > 0:
+            # The tokens rejected by the constraints of all rows are masked at once
+            fsm_indices = torch.tensor(fsm_indices)
+            scores = scores.index_put(
+                (fsm_indices,), scores[fsm_indices].masked_fill(~torch.cat(fsm_masks), float("-Inf"))
+            )
+        repetition_penalty = self.repetition_penalty[rows]
+        if input_ids is not None and torch.any(repetition_penalty != 1.0):
+            scores = self._apply_repetition_penalty(input_ids, scores, repetition_penalty)
+        return scores
+
+    @staticmethod
+    def _apply_repetition_penalty(
+        input_ids: torch.LongTensor, scores: torch.Tensor, penalty: torch.Tensor
+    ) -> torch.Tensor:
+        # Padding tokens are replaced by a valid token of the same row: since all the scattered values of a
+        # same token are identical, they do not penalize any additional token.
+        row_max = input_ids.max(dim=-1, keepdim=True).values.clamp(min=0)
+        input_ids = torch.where(input_ids < 0, row_max, input_ids)
+        token_scores = torch.gather(scores, 1, input_ids)
+        penalty = penalty[:, None]
+        # Same formula as transformers RepetitionPenaltyLogitsProcessor
+        token_scores = torch.where(token_scores < 0, token_scores * penalty, token_scores / penalty)
+        return scores.scatter(1, input_ids, token_scores)
+
+    @staticmethod
+    def _warp(
+        scores: torch.Tensor, temperature: torch.Tensor, top_k: torch.LongTensor, top_p: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """Apply the temperature, top-k and top-p of each row.
+
+        Return:
+            The sorted scores of the best candidates of each row (rejected candidates have a score of `-Inf`)
+            and the corresponding vocabulary indices.
+        """
+        vocab_size = scores.shape[-1]
+        scores = scores / temperature[:, None]
+        # Evaluate the top-k candidates for the largest top-k: rows without top-k filtering require the whole vocabulary
+        top_k = torch.where((top_k > 0) & (top_k < vocab_size), top_k, vocab_size)
+        max_k = int(top_k.max())
+        sorted_scores, sorted_indices = torch.topk(scores, max_k)
+        # Reject the candidates beyond the top-k of each row
+        positions = torch.arange(max_k)[None, :]
+        keep_mask = positions < top_k[:, None]
+        # Reject the candidates whose better candidates have a cumulated probability above top_p
+        probs = sorted_scores.masked_fill(~keep_mask, float("-Inf")).softmax(dim=-1)
+        better_probs = probs.cumsum(dim=-1) - probs
+        keep_mask &= (better_probs < top_p[:, None]) | (top_p[:, None] >= 1.0)
+        # The best candidate is always kept
+        keep_mask[:, 0] = True
+        return sorted_scores.masked_fill(~keep_mask, float("-Inf")), sorted_indices
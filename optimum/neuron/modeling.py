@@ -16,6 +16,7 @@
 
 import copy
 import logging
+from collections import deque
 from typing import TYPE_CHECKING, Dict, Optional, Union
 
 import torch
@@ -31,6 +32,7 @@ from transformers import (
 from transformers.file_utils import add_start_docstrings, add_start_docstrings_to_model_forward
 from transformers.generation import (
     GenerationMixin,
+    LogitsProcessorList,
 )
 from transformers.modeling_outputs import (
     BaseModelOutputWithPooling,
@@ -42,7 +44,7 @@ from transformers.modeling_outputs import (
 )
 from transformers.utils import ModelOutput
 
-from .generation import TokenSelector
+from .generation import PromptLookupIndex, TokenSelector
 from .modeling_base import NeuronBaseModel
 from .modeling_decoder import NeuronDecoderModel
 
@@ -52,6 +54,7 @@ if TYPE_CHECKING:
     from tempfile import TemporaryDirectory
 
     from transformers import GenerationConfig, PretrainedConfig
+    from transformers.generation.streamers import BaseStreamer
 
 
 logger = logging.getLogger(__name__)
@@ -581,8 +584,16 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
     ):
         super().__init__(model, config, model_path, generation_config)
         self.cur_len = 0
-        self.batch_size = model.config.batch_size
-        self.max_length = model.config.n_positions
+        self.batch_size = config.neuron["batch_size"]
+        # The batch sizes the model was compiled for, the largest being batch_size
+        self.batch_sizes = config.neuron.get("batch_sizes", None) or [self.batch_size]
+        self.max_length = config.neuron["sequence_length"]
+        # The sequence lengths the model was compiled for, the largest being max_length
+        self.sequence_length_buckets = config.neuron.get("sequence_length_buckets", None) or [self.max_length]
+        # With continuous batching, each sequence has its own KV cache row that can be updated independently
+        self.continuous_batching = config.neuron.get("continuous_batching", False)
+        # The number of tokens of each sequence evaluated at once by speculative_forward (0 if not supported)
+        self.speculation_length = config.neuron.get("speculation_length", 0)
         # The generate method from GenerationMixin expects the device attribute to be set
         self.device = torch.device("cpu")
 
@@ -612,9 +623,55 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
             return ModelOutput([("logits", out_logits)])
         return (out_logits,)
 
+    def speculative_forward(
+        self,
+        input_ids: torch.Tensor,
+        cache_ids: torch.Tensor,
+        start_ids: torch.Tensor = None,
+        return_dict: bool = True,
+    ):
+        """Evaluate the logits of several new tokens of each sequence, storing their keys and values in the KV cache.
+
+        This is typically used to verify the tokens proposed by a draft model in speculative decoding.
+        The model must have been exported with `speculation_length` equal to the number of new tokens.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, speculation_length)`):
+                The new tokens of each sequence.
+            cache_ids (`torch.LongTensor` of shape `(batch_size, speculation_length)`):
+                The positions of the new tokens in the KV cache.
+            start_ids (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The indices of the KV cache rows corresponding to each sequence (continuous batching only).
+
+        Return:
+            The `(batch_size, speculation_length, vocab_size)` logits of the token following each new token.
+        """
+        speculation_length = input_ids.shape[-1]
+        if speculation_length != self.speculation_length:
+            raise ValueError(
+                f"The model was exported to evaluate {self.speculation_length} tokens at once"
+                f" (speculation_length), but {speculation_length} tokens were passed."
+            )
+        out_logits = self.model.speculative_forward(input_ids, cache_ids, start_ids, speculation_length)
+        # transformers-neuronx returns the logits as (speculation_length, vocab_size, batch_size)
+        out_logits = out_logits.permute(2, 0, 1)
+        if return_dict:
+            return ModelOutput([("logits", out_logits)])
+        return (out_logits,)
+
     def prepare_inputs_for_generation(
         self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None, **kwargs
     ) -> Dict[str, torch.Tensor]:
+        if self.continuous_batching:
+            if attention_mask is None:
+                attention_mask = torch.ones_like(input_ids)
+            if self.cur_len > 0:
+                model_inputs = self.prepare_inputs_for_decode(input_ids, attention_mask)
+            else:
+                model_inputs = self.prepare_inputs_for_prefill(input_ids, attention_mask)
+            self.cur_len += model_inputs["input_ids"].shape[-1]
+            return model_inputs
+
         # convert attention_mask to start_ids
         start_ids = None
         if attention_mask is not None:
@@ -639,6 +696,86 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
 
         return model_inputs
 
+    def prepare_inputs_for_prefill(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        seq_ids: Optional[torch.Tensor] = None,
+        cache_offsets: Optional[torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        """Prepare the inputs to encode the context of a batch of sequences.
+
+        For static batching, the inputs must cover the whole static batch and the KV cache is rebuilt entirely.
+        For continuous batching, only the KV cache rows corresponding to the specified sequences are updated.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The left-padded tokens of the sequences to encode.
+            attention_mask (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                Mask to avoid performing attention on padding token indices.
+            seq_ids (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The indices of the KV cache rows corresponding to each sequence (continuous batching only).
+                Defaults to the first `batch_size` rows.
+            cache_offsets (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The number of tokens already stored in the KV cache row of each sequence, before the input tokens
+                (continuous batching only). Defaults to zero, i.e. the inputs are the first tokens of each sequence.
+
+        Return:
+            A dictionary of model inputs.
+        """
+        if not self.continuous_batching:
+            if cache_offsets is not None:
+                raise ValueError("Cache offsets are only supported for models exported with continuous batching.")
+            _, start_ids = attention_mask.max(axis=1)
+            # cache_ids will be set directly by the parallel context encoding code
+            return {"input_ids": input_ids, "cache_ids": None, "start_ids": start_ids}
+        if seq_ids is None:
+            seq_ids = torch.arange(input_ids.shape[0])
+        # Continuous batching requires right-padded inputs
+        input_lengths = attention_mask.sum(axis=1)
+        max_length = input_lengths.max()
+        padded_input_ids = torch.full(
+            [input_ids.shape[0], max_length], fill_value=self.config.eos_token_id, dtype=input_ids.dtype
+        )
+        cache_ids = torch.zeros([input_ids.shape[0], max_length], dtype=torch.int32)
+        for i, input_length in enumerate(input_lengths):
+            padded_input_ids[i, :input_length] = input_ids[i, -input_length:]
+            cache_offset = 0 if cache_offsets is None else cache_offsets[i]
+            cache_ids[i, :input_length] = torch.arange(cache_offset, cache_offset + input_length)
+        return {"input_ids": padded_input_ids, "cache_ids": cache_ids, "start_ids": seq_ids}
+
+    def prepare_inputs_for_decode(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor, seq_ids: Optional[torch.Tensor] = None
+    ) -> Dict[str, torch.Tensor]:
+        """Prepare the inputs to generate the next token of a batch of sequences.
+
+        The attention mask must include the positions of the tokens stored in the KV cache and
+        the position of the new input token.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The tokens of the sequences: only the last token of each sequence is evaluated.
+            attention_mask (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                Mask to avoid performing attention on padding token indices.
+            seq_ids (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                The indices of the KV cache rows corresponding to each sequence (continuous batching only).
+                Defaults to the first `batch_size` rows.
+
+        Return:
+            A dictionary of model inputs.
+        """
+        input_ids = input_ids[:, -1:]
+        if not self.continuous_batching:
+            _, start_ids = attention_mask.max(axis=1)
+            # All sequences share the same KV cache index
+            cache_ids = torch.as_tensor([attention_mask.shape[-1] - 1], dtype=torch.int32)
+            return {"input_ids": input_ids, "cache_ids": cache_ids, "start_ids": start_ids}
+        if seq_ids is None:
+            seq_ids = torch.arange(input_ids.shape[0])
+        # Each sequence stores its new key and values right after its own cached tokens
+        cache_ids = attention_mask.sum(axis=1, keepdim=True).type(torch.int32) - 1
+        return {"input_ids": input_ids, "cache_ids": cache_ids, "start_ids": seq_ids}
+
     def can_generate(self) -> bool:
         """Returns True to validate the check made in `GenerationMixin.generate()`."""
         return True
@@ -648,6 +785,9 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
         input_ids: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
         generation_config: Optional["GenerationConfig"] = None,
+        prompt_lookup_num_tokens: Optional[int] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        streamer: Optional["BaseStreamer"] = None,
         **kwargs,
     ) -> torch.LongTensor:
         r"""
@@ -673,9 +813,26 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
                 priority: 1) from the `generation_config.json` model file, if it exists; 2) from the model
                 configuration. Please note that unspecified parameters will inherit [`~transformers.generation.GenerationConfig`]'s
                 default values, whose documentation should be checked to parameterize generation.
+            prompt_lookup_num_tokens (`int`, *optional*):
+                If specified, the maximum number of tokens proposed at each step by looking up the last tokens of
+                each sequence in its prompt, and verified at once by the model (prompt lookup decoding).
+                This requires a model exported with continuous batching and a `speculation_length` of this value plus one.
+            logits_processor (`LogitsProcessorList`, *optional*):
+                Custom logits processors that complement the default logits processors built from the generation
+                configuration. Pass an `FSMLogitsProcessor` to constrain the generated text to a regular expression
+                or a JSON schema.
+            streamer (`BaseStreamer`, *optional*):
+                Streamer object that will be used to stream the generated sequences. The prompts are passed first
+                through `streamer.put(input_ids)`, then the tokens of each step as a `(batch_size,)` tensor through
+                `streamer.put(next_tokens)` as soon as they are selected (finished sequences receive padding tokens).
+                This is not supported with prompt lookup decoding, nor when generating more sequences than the
+                model batch size.
 
         Returns:
             `torch.Tensor`: A  `torch.FloatTensor`.
+
+        For models exported with continuous batching, the number of prompts can exceed the model batch size: each
+        KV cache row is then reassigned to the next pending prompt as soon as its sequence is finished.
         """
         # The actual generation configuration is a combination of config and parameters
         generation_config = copy.deepcopy(self.generation_config if generation_config is None else generation_config)
@@ -684,7 +841,7 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
         self._validate_model_kwargs(model_kwargs)
 
         # Instantiate a TokenSelector for the specified configuration
-        selector = TokenSelector.create(input_ids, generation_config, self, self.max_length)
+        selector = TokenSelector.create(input_ids, generation_config, self, self.max_length, logits_processor)
 
         # Verify that the inputs are compatible with the model static input dimensions
         batch_size, sequence_length = input_ids.shape
@@ -694,13 +851,43 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
             )
         padded_input_ids = input_ids
         padded_attention_mask = attention_mask
-        if batch_size > self.batch_size:
+        if batch_size > self.batch_size and (not self.continuous_batching or prompt_lookup_num_tokens is not None):
             raise ValueError(
-                f"The specified batch_size ({batch_size}) exceeds the model static batch size ({self.batch_size})"
+                f"The specified batch_size ({batch_size}) exceeds the model static batch size ({self.batch_size})."
+                " Only models exported with continuous batching can generate more sequences, without prompt lookup."
+            )
+        elif prompt_lookup_num_tokens is not None:
+            if not self.continuous_batching or self.speculation_length != prompt_lookup_num_tokens + 1:
+                raise ValueError(
+                    "Prompt lookup decoding requires a model exported with continuous batching and"
+                    f" speculation_length={prompt_lookup_num_tokens + 1}."
+                )
+            if streamer is not None:
+                raise ValueError("Streaming is not supported with prompt lookup decoding.")
+            # Each sequence is generated in its own KV cache row: the inputs do not need to be padded
+            self.reset_generation()
+            return self.generate_tokens_with_prompt_lookup(
+                input_ids, selector, prompt_lookup_num_tokens, attention_mask=attention_mask
             )
-        elif batch_size < self.batch_size:
-            logger.warning("Inputs will be padded to match the model static batch size. This will increase latency.")
-            padding_shape = [self.batch_size - batch_size, sequence_length]
+        elif batch_size > self.batch_size:
+            if streamer is not None:
+                raise ValueError("Streaming is not supported when generating more sequences than the batch size.")
+            if len(model_kwargs) > 0:
+                raise ValueError(
+                    f"Model kwargs ({list(model_kwargs)}) are not supported when generating more sequences than the"
+                    " batch size."
+                )
+            # The KV cache rows are reassigned to the pending sequences as soon as they are finished
+            self.reset_generation()
+            return self.generate_tokens_continuous(input_ids, selector, attention_mask=attention_mask)
+        elif batch_size not in self.batch_sizes:
+            # The inputs are evaluated by the graph of the smallest compiled batch size that can hold them
+            padded_batch_size = min(size for size in self.batch_sizes if size > batch_size)
+            logger.warning(
+                f"Inputs will be padded to match the model static batch size ({padded_batch_size})."
+                " This will increase latency."
+            )
+            padding_shape = [padded_batch_size - batch_size, sequence_length]
             padding = torch.full(padding_shape, fill_value=self.config.eos_token_id, dtype=torch.int64)
             padded_input_ids = torch.cat([input_ids, padding])
             if attention_mask is not None:
@@ -714,6 +901,7 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
             selector,
             batch_size,
             attention_mask=padded_attention_mask,
+            streamer=streamer,
             **model_kwargs,
         )
         return output_ids[:batch_size, :]
@@ -724,6 +912,7 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
         selector: TokenSelector,
         batch_size: int,
         attention_mask: Optional[torch.Tensor] = None,
+        streamer: Optional["BaseStreamer"] = None,
         **model_kwargs,
     ) -> torch.LongTensor:
         r"""
@@ -738,6 +927,8 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
                 The actual input batch size. Used to avoid generating tokens for padded inputs.
             attention_mask (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
                 Mask to avoid performing attention on padding token indices.
+            streamer (`BaseStreamer`, *optional*):
+                Streamer object receiving the prompts of the actual inputs, then their next tokens at each step.
             model_kwargs:
                 Additional model specific kwargs will be forwarded to the `forward` function of the model.
 
@@ -749,8 +940,28 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
         unfinished_sequences = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
         unfinished_sequences[:batch_size] = 1
 
+        # the generated tokens are written in preallocated buffers: each step only exposes views of their first
+        # columns to the model and to the selector, instead of concatenating the new tokens to the previous ones
+        padded_batch_size, cursor = input_ids.shape
+        max_length = max(selector.stopping_criteria.max_length or self.max_length, cursor + 1)
+        input_ids_buffer = input_ids.new_full((padded_batch_size, max_length), selector.pad_token_id)
+        input_ids_buffer[:, :cursor] = input_ids
+        attention_mask_buffer = None
+        if attention_mask is not None:
+            # the mask of the generated tokens is set in advance
+            attention_mask_buffer = attention_mask.new_ones((padded_batch_size, max_length))
+            attention_mask_buffer[:, :cursor] = attention_mask
+
+        # the streamed tensors are views of the padded batch: they do not require any copy
+        if streamer is not None:
+            streamer.put(input_ids[:batch_size])
+
         # auto-regressive generation
         while True:
+            input_ids = input_ids_buffer[:, :cursor]
+            if attention_mask_buffer is not None:
+                attention_mask = attention_mask_buffer[:, :cursor]
+
             # prepare model inputs
             model_inputs = self.prepare_inputs_for_generation(input_ids, attention_mask, **model_kwargs)
 
@@ -766,13 +977,13 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
 
             # finished sentences should have their next token be a padding token
             next_tokens = next_tokens * unfinished_sequences + selector.pad_token_id * (1 - unfinished_sequences)
+            if streamer is not None:
+                streamer.put(next_tokens[:batch_size])
 
-            # update inputs for the next step
-            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
-            if attention_mask is not None:
-                attention_mask = torch.cat(
-                    [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
-                )
+            # write the new tokens in the next column of the buffer
+            input_ids_buffer[:, cursor] = next_tokens
+            cursor += 1
+            input_ids = input_ids_buffer[:, :cursor]
 
             # if eos_token was found in one sentence, set sentence to finished
             unfinished_sequences = unfinished_sequences * next_tokens.ne(selector.eos_token_id)
@@ -782,7 +993,191 @@ class NeuronModelForCausalLM(NeuronDecoderModel, GenerationMixin):
                 break
 
             # stop if we exceed the maximum length
-            if selector.stopping_criteria(input_ids, None):
+            if cursor == max_length or selector.stopping_criteria(input_ids, None):
                 break
 
+        if streamer is not None:
+            streamer.end()
+
         return input_ids
+
+    def generate_tokens_continuous(
+        self,
+        input_ids: torch.LongTensor,
+        selector: TokenSelector,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.LongTensor:
+        r"""
+        Generate tokens using sampling or greedy search for any number of sequences.
+
+        Each KV cache row (continuous batching only) generates one sequence at a time: as soon as a sequence is
+        finished, the prompts of the next pending sequences are encoded in the rows that became available, so that
+        the model batch stays fully occupied until there are no more pending sequences.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(num_sequences, sequence_length)`):
+                The sequences used as prompts for the generation.
+            selector (`TokenSelector`):
+                The object implementing the generation logic based on transformers processors and stopping criterias.
+            attention_mask (`torch.Tensor` of shape `(num_sequences, sequence_length)`, *optional*):
+                Mask to avoid performing attention on padding token indices.
+
+        Return:
+            `torch.LongTensor`: A `torch.LongTensor` containing the generated tokens, in the order of the prompts.
+        """
+        num_sequences, sequence_length = input_ids.shape
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        prompt_lengths = attention_mask.sum(axis=1).tolist()
+        # The generated tokens are written in a preallocated buffer, after the padded prompt of each sequence: the
+        # cursor of each sequence is the index of its next token. Each sequence generates at most the tokens that fit
+        # in its KV cache row.
+        buffer_length = max(sequence_length + self.max_length - min(prompt_lengths), sequence_length + 1)
+        output_ids = input_ids.new_full((num_sequences, buffer_length), selector.pad_token_id)
+        output_ids[:, :sequence_length] = input_ids
+        cursors = [sequence_length] * num_sequences
+        pending = deque(range(num_sequences))
+        # The sequence generated in each KV cache row
+        rows = {}
+        free_rows = list(range(self.batch_size))
+        while len(pending) > 0 or len(rows) > 0:
+            if len(pending) > 0 and len(free_rows) > 0:
+                # Encode the prompts of the next pending sequences: the other rows wait until the next step
+                step_rows = free_rows[: len(pending)]
+                free_rows = free_rows[len(step_rows) :]
+                for row in step_rows:
+                    rows[row] = pending.popleft()
+                sequences = torch.tensor([rows[row] for row in step_rows])
+                model_inputs = self.prepare_inputs_for_prefill(
+                    input_ids[sequences], attention_mask[sequences], torch.tensor(step_rows)
+                )
+            else:
+                # Generate the next token of each active sequence, stored after its cached tokens
+                step_rows = list(rows)
+                sequences = [rows[row] for row in step_rows]
+                inputs = torch.stack([output_ids[i, cursors[i] - 1 : cursors[i]] for i in sequences])
+                cache_offsets = torch.tensor([prompt_lengths[i] + cursors[i] - sequence_length - 1 for i in sequences])
+                model_inputs = self.prepare_inputs_for_prefill(
+                    inputs, torch.ones_like(inputs), torch.tensor(step_rows), cache_offsets=cache_offsets
+                )
+            logits = self(**model_inputs, return_dict=True).logits[:, -1, :]
+            # The tokens of sequences of the same length are selected at once
+            groups = {}
+            for step_row, row in enumerate(step_rows):
+                groups.setdefault(cursors[rows[row]], []).append(step_row)
+            for cursor, group in groups.items():
+                sequences = [rows[step_rows[step_row]] for step_row in group]
+                if len(sequences) == 1:
+                    group_input_ids = output_ids[sequences[0] : sequences[0] + 1, :cursor]
+                else:
+                    group_input_ids = output_ids[sequences, :cursor]
+                next_tokens = selector.select(group_input_ids, logits[group])
+                for step_row, i, next_token in zip(group, sequences, next_tokens.tolist()):
+                    output_ids[i, cursor] = next_token
+                    cursors[i] += 1
+                    if (
+                        next_token == selector.eos_token_id
+                        or selector.stopping_criteria(output_ids[i : i + 1, : cursors[i]], None)
+                        or prompt_lengths[i] + cursors[i] - sequence_length >= self.max_length
+                    ):
+                        # The row of the finished sequence is available for the next pending sequence
+                        row = step_rows[step_row]
+                        del rows[row]
+                        free_rows.append(row)
+        # Finished sequences are padded with the padding token
+        return output_ids[:, : max(cursors)]
+
+    def generate_tokens_with_prompt_lookup(
+        self,
+        input_ids: torch.LongTensor,
+        selector: TokenSelector,
+        num_tokens: int,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.LongTensor:
+        r"""
+        Generate tokens using sampling or greedy search, verifying several proposed tokens at each step.
+
+        The proposed tokens of each sequence are the tokens following the last occurrence of its last tokens in its
+        prompt. They are evaluated at once with the next token by `speculative_forward`, and accepted as long as they
+        match the tokens selected from the corresponding logits, so that the generated tokens are the same as
+        without speculation for greedy search, and follow the same distributions for sampling.
+
+        Each sequence is stored in its own KV cache row (continuous batching only), at its own position.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
+                The sequence used as a prompt for the generation.
+            selector (`TokenSelector`):
+                The object implementing the generation logic based on transformers processors and stopping criterias.
+            num_tokens (`int`):
+                The maximum number of tokens proposed for each sequence at each step.
+            attention_mask (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
+                Mask to avoid performing attention on padding token indices.
+
+        Return:
+            `torch.LongTensor`: A `torch.LongTensor` containing the generated tokens.
+        """
+        batch_size, sequence_length = input_ids.shape
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        seq_ids = torch.arange(batch_size)
+        # The unpadded token ids of each sequence, and the corresponding prompt n-grams
+        token_ids = [ids[mask == 1].tolist() for ids, mask in zip(input_ids, attention_mask)]
+        lookup_indices = [PromptLookupIndex(ids) for ids in token_ids]
+        generated = [[] for _ in range(batch_size)]
+        proposals = [[] for _ in range(batch_size)]
+        model_inputs = self.prepare_inputs_for_prefill(input_ids, attention_mask, seq_ids)
+        logits = self(**model_inputs, return_dict=True).logits[:, -1:, :]
+        active = list(range(batch_size))
+        while True:
+            # Select the next tokens of each active sequence, as long as they match the proposed tokens
+            next_active = []
+            for i, sequence_logits in zip(active, logits):
+                for step in range(sequence_logits.shape[0]):
+                    sequence = torch.cat([input_ids[i], torch.tensor(generated[i], dtype=input_ids.dtype)])
+                    next_token = int(selector.select(sequence[None, :], sequence_logits[step : step + 1])[0])
+                    generated[i].append(next_token)
+                    token_ids[i].append(next_token)
+                    sequence = torch.cat([sequence, sequence.new_tensor([next_token])])
+                    if (
+                        next_token == selector.eos_token_id
+                        or selector.stopping_criteria(sequence[None, :], None)
+                        or len(token_ids[i]) >= self.max_length
+                    ):
+                        break
+                    if step >= len(proposals[i]) or next_token != proposals[i][step]:
+                        next_active.append(i)
+                        break
+            active = next_active
+            if len(active) == 0:
+                break
+            # All sequences are evaluated with the same number of positions: tokens are proposed only if
+            # the proposed tokens of every sequence fit in the KV cache
+            can_propose = all(len(token_ids[i]) + num_tokens <= self.max_length for i in active)
+            for i in active:
+                proposals[i] = lookup_indices[i].propose(token_ids[i], num_tokens) if can_propose else []
+            # Evaluate the pending token of each sequence, stored after its cached tokens, and its proposed tokens
+            cache_offsets = torch.tensor([len(token_ids[i]) - 1 for i in active])
+            if any(len(proposals[i]) > 0 for i in active):
+                # Proposals are padded to the number of tokens the model was compiled for
+                inputs = torch.full([len(active), num_tokens + 1], fill_value=selector.pad_token_id)
+                for row, i in enumerate(active):
+                    inputs[row, 0] = token_ids[i][-1]
+                    inputs[row, 1 : len(proposals[i]) + 1] = torch.tensor(proposals[i], dtype=inputs.dtype)
+                model_inputs = self.prepare_inputs_for_prefill(
+                    inputs, torch.ones_like(inputs), seq_ids[active], cache_offsets=cache_offsets
+                )
+                logits = self.speculative_forward(**model_inputs, return_dict=True).logits
+            else:
+                inputs = torch.tensor([[token_ids[i][-1]] for i in active])
+                model_inputs = self.prepare_inputs_for_prefill(
+                    inputs, torch.ones_like(inputs), seq_ids[active], cache_offsets=cache_offsets
+                )
+                logits = self(**model_inputs, return_dict=True).logits
+        # Finished sequences are padded with the padding token
+        max_generated = max(len(tokens) for tokens in generated)
+        output_ids = torch.full([batch_size, sequence_length + max_generated], fill_value=selector.pad_token_id)
+        output_ids[:, :sequence_length] = input_ids
+        for i, tokens in enumerate(generated):
+            output_ids[i, sequence_length : sequence_length + len(tokens)] = torch.tensor(tokens)
+        return output_ids
@@ -19,18 +19,23 @@ import os
 import shutil
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import TYPE_CHECKING, Optional, Tuple, Union
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import torch
 from huggingface_hub import HfApi, HfFolder, snapshot_download
 from huggingface_hub.utils import is_google_colab
+from packaging import version
 from transformers import AutoConfig, AutoModel, GenerationConfig
 
 from ..exporters.neuron.model_configs import *  # noqa: F403
 from ..exporters.tasks import TasksManager
 from ..modeling_base import OptimizedModel
 from .utils import is_transformers_neuronx_available
-from .utils.version_utils import check_compiler_compatibility, get_neuronxcc_version
+from .utils.version_utils import (
+    check_compiler_compatibility,
+    get_neuronxcc_version,
+    get_transformers_neuronx_version,
+)
 
 
 if is_transformers_neuronx_available():
@@ -44,6 +49,14 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# The first transformers-neuronx release supporting each optional compilation feature
+TRANSFORMERS_NEURONX_MIN_VERSIONS = {
+    "Multiple batch sizes": "0.9.474",
+    "Sequence length buckets": "0.9.474",
+    "Continuous batching": "0.9.474",
+    "Speculative decoding": "0.9.474",
+}
+
 
 def get_exporter(config, task):
     return TasksManager.get_exporter_config_constructor(model_type=config.model_type, exporter="neuron", task=task)()
@@ -103,10 +116,12 @@ class NeuronDecoderModel(OptimizedModel):
         local_files_only: bool = False,
         trust_remote_code: bool = False,
         task: Optional[str] = None,
-        batch_size: Optional[int] = 1,
-        sequence_length: Optional[int] = None,
+        batch_size: Optional[Union[int, List[int]]] = 1,
+        sequence_length: Optional[Union[int, List[int]]] = None,
         num_cores: Optional[int] = 2,
         auto_cast_type: Optional[str] = "fp32",
+        continuous_batching: Optional[bool] = False,
+        speculation_length: Optional[int] = 0,
         **kwargs,
     ) -> "NeuronDecoderModel":
         if not is_transformers_neuronx_available():
@@ -115,6 +130,18 @@ class NeuronDecoderModel(OptimizedModel):
         if task is None:
             task = TasksManager.infer_task_from_model(cls.auto_model_class)
 
+        # If several batch sizes are specified, the model is compiled for each of them
+        batch_sizes = None
+        if isinstance(batch_size, (list, tuple)):
+            if len(batch_size) == 0 or min(batch_size) <= 0:
+                raise ValueError(f"Invalid batch sizes {batch_size}.")
+            batch_sizes = sorted(set(batch_size))
+            batch_size = batch_sizes[-1]
+            if len(batch_sizes) == 1:
+                batch_sizes = None
+            elif continuous_batching:
+                raise ValueError("A model exported with continuous batching can only be compiled for one batch size.")
+
         # Instantiate the transformers model checkpoint
         model = TasksManager.get_model_from_task(
             task=task,
@@ -141,13 +168,27 @@ class NeuronDecoderModel(OptimizedModel):
             # Note: for older models, max_position_embeddings is an alias for n_positions
             sequence_length = config.max_position_embeddings
 
+        # If several sequence lengths are specified, the model is compiled for each of them (buckets)
+        sequence_length_buckets = None
+        if isinstance(sequence_length, (list, tuple)):
+            if len(sequence_length) == 0 or min(sequence_length) <= 0:
+                raise ValueError(f"Invalid sequence length buckets {sequence_length}.")
+            sequence_length_buckets = sorted(set(sequence_length))
+            sequence_length = sequence_length_buckets[-1]
+            if len(sequence_length_buckets) == 1:
+                sequence_length_buckets = None
+
         # Update the config
         config.neuron = {
             "task": task,
             "batch_size": batch_size,
+            "batch_sizes": batch_sizes,
             "num_cores": num_cores,
             "auto_cast_type": auto_cast_type,
             "sequence_length": sequence_length,
+            "sequence_length_buckets": sequence_length_buckets,
+            "continuous_batching": continuous_batching,
+            "speculation_length": speculation_length,
             "compiler_type": "neuronx-cc",
             "compiler_version": get_neuronxcc_version(),
         }
@@ -196,11 +237,33 @@ class NeuronDecoderModel(OptimizedModel):
         # Evaluate the configuration passed during export
         task = neuron_config["task"]
         batch_size = neuron_config["batch_size"]
+        # Models exported before multiple batch sizes were introduced are compiled for batch_size only
+        batch_sizes = neuron_config.get("batch_sizes", None)
         sequence_length = neuron_config["sequence_length"]
+        # Models exported before buckets were introduced are compiled for sequence_length only
+        sequence_length_buckets = neuron_config.get("sequence_length_buckets", None)
         num_cores = neuron_config["num_cores"]
         auto_cast_type = neuron_config["auto_cast_type"]
+        # Models exported before continuous batching was introduced use a single KV cache index
+        continuous_batching = neuron_config.get("continuous_batching", False)
+        speculation_length = neuron_config.get("speculation_length", 0)
 
         check_compiler_compatibility(neuron_config["compiler_type"], neuron_config["compiler_version"])
+        # Fail with a clear error before compilation if a feature is not supported by transformers-neuronx
+        requested_features = {
+            "Multiple batch sizes": batch_sizes is not None,
+            "Sequence length buckets": sequence_length_buckets is not None,
+            "Continuous batching": continuous_batching,
+            "Speculative decoding": speculation_length > 0,
+        }
+        transformers_neuronx_version = get_transformers_neuronx_version()
+        for feature, requested in requested_features.items():
+            min_version = TRANSFORMERS_NEURONX_MIN_VERSIONS[feature]
+            if requested and version.parse(transformers_neuronx_version) < version.parse(min_version):
+                raise RuntimeError(
+                    f"{feature} requires transformers-neuronx {min_version} or later, but you have"
+                    f" {transformers_neuronx_version}, please upgrade it."
+                )
 
         exporter = get_exporter(config, task)
 
@@ -208,14 +271,33 @@ class NeuronDecoderModel(OptimizedModel):
 
         # transformers-neuronx uses f32/f16 instead of fp32/fp16
         auto_cast_type = auto_cast_type.replace("p", "")
+        neuronx_kwargs = {}
+        if continuous_batching:
+            # Each sequence of the batch gets its own KV cache row, indexed by its sequence id
+            from transformers_neuronx.config import ContinuousBatchingConfig, NeuronConfig
+
+            continuous_batching_config = ContinuousBatchingConfig(batch_size_for_shared_caches=batch_size)
+            neuronx_kwargs["neuron_config"] = NeuronConfig(continuous_batching=continuous_batching_config)
+        n_positions = sequence_length
+        if sequence_length_buckets is not None:
+            # A context encoding and a token generation graph are compiled for each bucket, sharing the same weights
+            # and KV cache: each forward uses the graph of the smallest bucket covering the positions of its tokens.
+            n_positions = sequence_length_buckets
+            neuronx_kwargs["context_length_estimate"] = sequence_length_buckets
+        # The graphs of each batch size share the same weights, but each has its own KV cache
         neuronx_model = exporter.neuronx_class.from_pretrained(
             checkpoint_path,
-            batch_size=batch_size,
-            n_positions=sequence_length,
+            batch_size=batch_size if batch_sizes is None else batch_sizes,
+            n_positions=n_positions,
             tp_degree=num_cores,
             amp=auto_cast_type,
+            **neuronx_kwargs,
         )
 
+        if speculation_length > 0:
+            # Compile an additional graph evaluating speculation_length tokens of each sequence at once
+            neuronx_model.enable_speculative_decoder(speculation_length)
+
         if compiled_path is not None:
             # Specify the path where compiled artifacts are stored before conversion
             neuronx_model._load_compiled_artifacts(compiled_path)
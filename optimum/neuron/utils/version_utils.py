@@ -25,6 +25,7 @@ _neuroncc_version: Optional[str] = None
 _torch_xla_version: Optional[str] = None
 _neuronx_distributed_version: Optional[str] = None
 _torch_version: Optional[str] = None
+_transformers_neuronx_version: Optional[str] = None
 
 
 def get_neuronxcc_version() -> str:
@@ -87,6 +88,18 @@ def get_torch_version() -> str:
     return _torch_version
 
 
+def get_transformers_neuronx_version() -> str:
+    global _transformers_neuronx_version
+    if _transformers_neuronx_version is not None:
+        return _transformers_neuronx_version
+    try:
+        import transformers_neuronx
+    except ImportError:
+        raise ModuleNotFoundError("`transformers_neuronx` python package is not installed.")
+    _transformers_neuronx_version = transformers_neuronx.__version__
+    return _transformers_neuronx_version
+
+
 def check_compiler_compatibility(compiler_type: str, compiler_version: str):
     if compiler_type == "neuron-cc":
         compiler_available_fn = is_neuron_available
@@ -55,6 +55,7 @@ EXTRAS_REQUIRE = {
         "wheel",
         "neuronx-cc==2.11.0.34",
         "torch-neuronx==1.13.1.1.12.1",
+        # Multiple batch sizes, sequence length buckets, continuous batching and speculative decoding require 0.9.474
         "transformers-neuronx==0.8.268",
         "torch==1.13.1.*",
         "torchvision==0.14.*",
@@ -13,11 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from tempfile import TemporaryDirectory
+from types import SimpleNamespace
 
 import pytest
-from transformers import AutoTokenizer
+import torch
+from transformers import AutoTokenizer, GPT2Config, GPT2LMHeadModel
 
-from optimum.neuron import NeuronModelForCausalLM
+from optimum.neuron import NeuronModelForCausalLM, modeling_decoder
 from optimum.neuron.utils.testing_utils import requires_neuronx
 from optimum.utils.testing_utils import USER
 
@@ -73,3 +75,31 @@ def check_neuron_model(neuron_model, batch_size=None, sequence_length=None, num_
         assert neuron_config["num_cores"] == num_cores
     if auto_cast_type:
         assert neuron_config["auto_cast_type"] == auto_cast_type
+
+
+@pytest.fixture
+def cpu_neuron_model(monkeypatch):
+    """Return a factory of `NeuronModelForCausalLM` instances running on CPU (see `create_cpu_neuron_model`)."""
+    from generation_utils import CPUNeuronxModel, create_cpu_neuron_model
+
+    monkeypatch.setattr(modeling_decoder, "is_transformers_neuronx_available", lambda: True)
+    monkeypatch.setattr(modeling_decoder, "NeuronxPretrainedModel", CPUNeuronxModel, raising=False)
+    monkeypatch.setattr(modeling_decoder, "get_transformers_neuronx_version", lambda: "0.9.474")
+    return create_cpu_neuron_model
+
+
+@pytest.fixture
+def cpu_export_model_path(cpu_neuron_model, monkeypatch, tmp_path):
+    """Return the path of a tiny transformers checkpoint, whose export instantiates a `CPUNeuronxModel`."""
+    from generation_utils import CPUNeuronxModel
+
+    monkeypatch.setattr(modeling_decoder, "save_split", torch.save, raising=False)
+    monkeypatch.setattr(modeling_decoder, "get_neuronxcc_version", lambda: "cpu")
+    monkeypatch.setattr(modeling_decoder, "check_compiler_compatibility", lambda compiler_type, compiler_version: None)
+    monkeypatch.setattr(
+        modeling_decoder, "get_exporter", lambda config, task: SimpleNamespace(neuronx_class=CPUNeuronxModel)
+    )
+    config = GPT2Config(vocab_size=64, n_positions=128, n_embd=16, n_layer=1, n_head=2, eos_token_id=0)
+    torch.manual_seed(0)
+    GPT2LMHeadModel(config).save_pretrained(tmp_path)
+    return tmp_path
@@ -12,6 +12,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from types import SimpleNamespace
+
+import torch
+from transformers import AutoModelForCausalLM, GPT2Config, GPT2LMHeadModel
+
+from optimum.neuron import NeuronModelForCausalLM
 
 
 def check_neuron_model(neuron_model, batch_size=None, sequence_length=None, num_cores=None, auto_cast_type=None):
@@ -25,3 +31,130 @@ def check_neuron_model(neuron_model, batch_size=None, sequence_length=None, num_
         assert neuron_config["num_cores"] == num_cores
     if auto_cast_type:
         assert neuron_config["auto_cast_type"] == auto_cast_type
+
+
+class CPUNeuronxModel:
+    """A CPU stand-in for a transformers-neuronx model, to test `NeuronModelForCausalLM` without Neuron devices.
+
+    The tokens stored in each row of the emulated KV cache are kept in a `[batch_size, max_length]` buffer, and each
+    forward evaluates the whole context of each row with a transformers model. Like a compiled model, it rejects
+    inputs whose batch size it was not compiled for, or whose positions exceed its static KV cache.
+    """
+
+    def __init__(self, model, batch_size, max_length, continuous_batching=False, batch_sizes=None):
+        self.model = model
+        self.config = SimpleNamespace(batch_size=batch_size, n_positions=max_length)
+        self.max_length = max_length
+        self.continuous_batching = continuous_batching
+        self.batch_sizes = batch_sizes or [batch_size]
+        self.cache = torch.full([batch_size, max_length], fill_value=-1, dtype=torch.int64)
+        self.start_ids = torch.zeros([batch_size], dtype=torch.int64)
+        # The input shapes of each forward
+        self.forwards = []
+
+    @classmethod
+    def from_pretrained(cls, checkpoint_path, batch_size, n_positions, tp_degree, amp, **kwargs):
+        """Emulate the instantiation of a transformers-neuronx model from an exported checkpoint.
+
+        The compilation parameters are kept in `compile_kwargs`.
+        """
+        batch_sizes = batch_size if isinstance(batch_size, list) else [batch_size]
+        max_length = n_positions[-1] if isinstance(n_positions, list) else n_positions
+        model = AutoModelForCausalLM.from_pretrained(checkpoint_path).eval()
+        neuronx_model = cls(model, batch_sizes[-1], max_length, batch_sizes=batch_sizes)
+        neuronx_model.compile_kwargs = {"batch_size": batch_size, "n_positions": n_positions, **kwargs}
+        return neuronx_model
+
+    def enable_speculative_decoder(self, speculation_length):
+        pass
+
+    def to_neuron(self):
+        pass
+
+    def _logits(self, contexts, num_positions):
+        """Return the logits of the last positions of each context."""
+        with torch.no_grad():
+            return torch.stack([self.model(context[None, :]).logits[0, -num_positions:] for context in contexts])
+
+    def _store(self, input_ids, cache_ids, start_ids):
+        """Store the tokens in the KV cache rows and return the positions of the last stored tokens."""
+        self.forwards.append(tuple(input_ids.shape))
+        if self.continuous_batching:
+            last_positions = []
+            for tokens, positions, row in zip(input_ids.tolist(), cache_ids.tolist(), start_ids.tolist()):
+                # The inputs are right-padded: the padding tokens are stored at position 0
+                length = 1
+                while length < len(positions) and positions[length] > positions[length - 1]:
+                    length += 1
+                if positions[length - 1] >= self.max_length:
+                    raise ValueError(f"Position {positions[length - 1]} exceeds the KV cache ({self.max_length}).")
+                self.cache[row, positions[:length]] = torch.tensor(tokens[:length])
+                self.cache[row, positions[length - 1] + 1 :] = -1
+                last_positions.append(positions[length - 1])
+            return last_positions
+        if input_ids.shape[0] not in self.batch_sizes:
+            raise ValueError(f"The model was not compiled for batch size {input_ids.shape[0]}.")
+        if cache_ids is None:
+            self.cache[:] = -1
+            self.cache[: input_ids.shape[0], : input_ids.shape[-1]] = input_ids
+            self.start_ids[: input_ids.shape[0]] = 0 if start_ids is None else start_ids
+            return [input_ids.shape[-1] - 1] * input_ids.shape[0]
+        position = int(cache_ids[0])
+        if position >= self.max_length:
+            raise ValueError(f"Position {position} exceeds the KV cache ({self.max_length}).")
+        self.cache[: input_ids.shape[0], position] = input_ids[:, 0]
+        return [position] * input_ids.shape[0]
+
+    def _contexts(self, rows, last_positions):
+        if self.continuous_batching:
+            return [self.cache[row, : position + 1] for row, position in zip(rows, last_positions)]
+        return [self.cache[row, self.start_ids[row] : position + 1] for row, position in zip(rows, last_positions)]
+
+    def forward(self, input_ids, cache_ids, start_ids):
+        last_positions = self._store(input_ids, cache_ids, start_ids)
+        rows = start_ids.tolist() if self.continuous_batching else range(input_ids.shape[0])
+        return self._logits(self._contexts(rows, last_positions), 1)[:, -1, :]
+
+    def speculative_forward(self, input_ids, cache_ids, start_ids, speculation_length):
+        last_positions = self._store(input_ids, cache_ids, start_ids)
+        logits = self._logits(self._contexts(start_ids.tolist(), last_positions), speculation_length)
+        # The logits are returned as (speculation_length, vocab_size, batch_size)
+        return logits.permute(1, 2, 0)
+
+
+def create_cpu_neuron_model(
+    batch_size=2,
+    sequence_length=64,
+    continuous_batching=False,
+    speculation_length=0,
+    batch_sizes=None,
+    vocab_size=64,
+):
+    """Instantiate a `NeuronModelForCausalLM` backed by a `CPUNeuronxModel` wrapping a tiny random GPT2 model.
+
+    `modeling_decoder.NeuronxPretrainedModel` must be patched to `CPUNeuronxModel` (see the `cpu_neuron_model`
+    fixture).
+    """
+    config = GPT2Config(vocab_size=vocab_size, n_positions=128, n_embd=16, n_layer=1, n_head=2, eos_token_id=0)
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(config).eval()
+    config.neuron = {
+        "batch_size": batch_size,
+        "batch_sizes": batch_sizes,
+        "sequence_length": sequence_length,
+        "continuous_batching": continuous_batching,
+        "speculation_length": speculation_length,
+    }
+    neuronx_model = CPUNeuronxModel(model, batch_size, sequence_length, continuous_batching, batch_sizes)
+    return NeuronModelForCausalLM(neuronx_model, config, None), model
+
+
+def left_pad(prompts):
+    """Return the left-padded input ids and attention mask of a list of prompt tensors."""
+    padded_length = max(len(prompt) for prompt in prompts)
+    input_ids = torch.zeros([len(prompts), padded_length], dtype=torch.int64)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, prompt in enumerate(prompts):
+        input_ids[i, padded_length - len(prompt) :] = prompt
+        attention_mask[i, padded_length - len(prompt) :] = 1
+    return input_ids, attention_mask
@@ -0,0 +1,129 @@
+import pytest
+import torch
+from transformers.generation import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, StoppingCriteriaList
+from transformers.generation.utils import GenerationMode
+
+from optimum.neuron.generation import BatchedTokenSelector, FusedLogitsWarper, TokenSelector
+
+
+def create_selector(do_sample=False, temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0):
+    logits_processor = LogitsProcessorList()
+    if repetition_penalty != 1.0:
+        logits_processor.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+    return TokenSelector(
+        mode=GenerationMode.SAMPLE if do_sample else GenerationMode.GREEDY_SEARCH,
+        logits_processor=logits_processor,
+        stopping_criteria=StoppingCriteriaList(),
+        eos_token_id=0,
+        pad_token_id=0,
+        logits_warper=FusedLogitsWarper(temperature, top_k, top_p) if do_sample else None,
+    )
+
+
+@pytest.mark.parametrize("batch_size", [1, 4, 32])
+def test_greedy(batch_size):
+    vocab_size = 1000
+    selector = BatchedTokenSelector(batch_size)
+    for i in range(batch_size):
+        selector.set(i, create_selector())
+    logits = torch.rand(batch_size, vocab_size)
+    assert torch.equal(selector.select(logits), torch.argmax(logits, dim=-1))
+
+
+def test_repetition_penalty():
+    batch_size, vocab_size, seq_length = 4, 100, 10
+    penalties = [1.0, 1.2, 0.8, 2.0]
+    selectors = [create_selector(repetition_penalty=penalty) for penalty in penalties]
+    selector = BatchedTokenSelector(batch_size)
+    for i in range(batch_size):
+        selector.set(i, selectors[i])
+    logits = torch.randn(batch_size, vocab_size)
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_length))
+    # The last row is padded
+    input_ids[-1, :5] = -1
+    next_tokens = selector.select(logits, input_ids=input_ids)
+    for i in range(batch_size):
+        row_input_ids = input_ids[i : i + 1]
+        row_input_ids = row_input_ids[row_input_ids >= 0].unsqueeze(0)
+        assert next_tokens[i] == selectors[i].select(row_input_ids, logits[i : i + 1].clone())[0]
+
+
+def test_mixed_greedy_and_sampling():
+    batch_size, vocab_size = 4, 1000
+    selector = BatchedTokenSelector(batch_size)
+    selector.set(0, create_selector())
+    selector.set(1, create_selector(do_sample=True, top_k=1))
+    selector.set(2, create_selector())
+    selector.set(3, create_selector(do_sample=True, top_k=5, temperature=0.5))
+    logits = torch.arange(vocab_size, dtype=torch.float).repeat(batch_size, 1)
+    for _ in range(10):
+        next_tokens = selector.select(logits)
+        # Greedy and top-1 sampling rows always select the best token
+        assert torch.all(next_tokens[:3] == vocab_size - 1)
+        # Sampling rows only select one of the top-k tokens
+        assert next_tokens[3] >= vocab_size - 5
+
+
+def test_rows():
+    batch_size, vocab_size = 4, 100
+    selector = BatchedTokenSelector(batch_size)
+    for i in range(batch_size):
+        selector.set(i, create_selector(do_sample=(i == 2), top_k=1))
+    logits = torch.rand(2, vocab_size)
+    # Only the rows 1 and 2 are selected
+    next_tokens = selector.select(logits, rows=torch.tensor([2, 1]))
+    assert torch.equal(next_tokens, torch.argmax(logits, dim=-1))
+
+
+def test_top_p():
+    selector = BatchedTokenSelector(2)
+    selector.set(0, create_selector(do_sample=True, top_p=0.5))
+    selector.set(1, create_selector(do_sample=True, top_k=3, top_p=0.7))
+    # The best token has a probability of 0.6, the next ones 0.2
+    probs = torch.tensor([[0.1, 0.6, 0.2, 0.05, 0.05], [0.05, 0.05, 0.2, 0.6, 0.1]])
+    logits = torch.log(probs)
+    for _ in range(20):
+        next_tokens = selector.select(logits)
+        assert next_tokens[0] == 1
+        assert next_tokens[1] in (2, 3)
+
+
+def test_probabilities():
+    selector = BatchedTokenSelector(2)
+    selector.set(0, create_selector())
+    selector.set(1, create_selector(do_sample=True, top_k=2, temperature=0.5))
+    probs = torch.tensor([[0.1, 0.6, 0.3], [0.1, 0.3, 0.6]])
+    next_probs = selector.probabilities(torch.log(probs))
+    # The greedy row selects its best token
+    assert torch.equal(next_probs[0], torch.tensor([0.0, 1.0, 0.0]))
+    # The sampling row only keeps its top-2 tokens, with a temperature of 0.5
+    expected = torch.tensor([0.0, 0.3**2, 0.6**2])
+    assert torch.allclose(next_probs[1], expected / expected.sum())
+
+
+def test_accept_greedy():
+    vocab_size = 10
+    # The target model always predicts the next token of the 0, 1, 2, ... sequence
+    target_tokens = torch.tensor([[1, 2, 3, 4], [1, 2, 3, 4], [1, 2, 3, 4]])
+    target_probs = torch.nn.functional.one_hot(target_tokens, vocab_size).float()
+    draft_tokens = torch.tensor([[1, 2, 3], [1, 5, 3], [7, 2, 3]])
+    draft_probs = torch.nn.functional.one_hot(draft_tokens, vocab_size).float()
+    n_accepted, next_tokens = BatchedTokenSelector.accept(draft_tokens, draft_probs, target_probs)
+    assert n_accepted.tolist() == [3, 1, 0]
+    assert next_tokens.tolist() == [4, 2, 1]
+
+
+def test_accept_preserves_target_distribution():
+    n_samples = 20000
+    draft_probs = torch.tensor([0.6, 0.3, 0.1, 0.0])
+    target_probs = torch.tensor([0.2, 0.3, 0.1, 0.4])
+    draft_tokens = torch.multinomial(draft_probs, n_samples, replacement=True).unsqueeze(-1)
+    n_accepted, next_tokens = BatchedTokenSelector.accept(
+        draft_tokens,
+        draft_probs.expand(n_samples, 1, -1),
+        target_probs.expand(n_samples, 2, -1),
+    )
+    # The first generated token is either the accepted draft token or the replacement token
+    tokens = torch.where(n_accepted == 1, draft_tokens[:, 0], next_tokens)
+    frequencies = torch.bincount(tokens, minlength=4) / n_samples
+    assert torch.allclose(frequencies, target_probs, atol=0.02)
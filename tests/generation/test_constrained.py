@@ -0,0 +1,228 @@
+import json
+import re
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models
+from transformers import PreTrainedTokenizerFast
+from transformers.generation import LogitsProcessorList, StoppingCriteriaList
+from transformers.generation.utils import GenerationMode
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from optimum.neuron.generation import (
+    BatchedTokenSelector,
+    FSMIndex,
+    FSMLogitsProcessor,
+    RegexFSM,
+    TokenSelector,
+    json_schema_to_regex,
+)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tokens = (
+        ["<eos>"] + list('abcdefghijklmnopqrstuvwxyz0123456789 {}[]":,.-') + ["ab", "true", "false", '{"', '":', "12"]
+    )
+    tokenizer = Tokenizer(models.WordLevel({token: i for i, token in enumerate(tokens)}, unk_token="<eos>"))
+    tokenizer.decoder = decoders.Fuse()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>")
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        r"[a-z]+@[a-z]+\.(com|org)",
+        r"(ab|a)*b?",
+        r"\d{2,4}-\d{2}",
+        r"[^\"]{0,5}x",
+        r".*end",
+        r"(?:foo|bar){2,}",
+        r"^a{3}$",
+        r"[a-c]+?.{1,3}[ab]{2}1??",
+    ],
+)
+def test_regex_fsm(pattern):
+    fsm = RegexFSM(pattern)
+    strings = [
+        "",
+        "a",
+        "ab",
+        "abab",
+        "abb",
+        "x",
+        "xx",
+        "12-34",
+        "1234-56",
+        "a@b.com",
+        "a@b.net",
+        "the end",
+        "foobar",
+        "aaa",
+        "bbba",
+    ]
+    for string in strings:
+        assert fsm.matches(string) == bool(re.fullmatch(pattern, string)), string
+
+
+@pytest.mark.parametrize(
+    "pattern", [r"(?=a)b", r"(a)\1", r"a)", r"[b-a]", r"*a", r"[a-c]++.{1,3}[ab]{2}1?", r"a*+", r"a?+b", r"a{1,2}+"]
+)
+def test_unsupported_regex(pattern):
+    with pytest.raises(ValueError):
+        RegexFSM(pattern)
+
+
+def test_json_schema_to_regex():
+    schema = {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "maxLength": 10},
+            "age": {"type": "integer"},
+            "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 2},
+        },
+        "required": ["age"],
+    }
+    fsm = RegexFSM(json_schema_to_regex(json.dumps(schema)))
+    assert fsm.matches('{"age": 3}')
+    assert fsm.matches('{"name": "bob", "age": -12, "tags": ["a", "b"]}')
+    # Missing required property
+    assert not fsm.matches('{"name": "bob"}')
+    # Invalid integer, too many items and properties in a different order
+    assert not fsm.matches('{"age": 01}')
+    assert not fsm.matches('{"age": 1, "tags": ["a", "b", "a"]}')
+    assert not fsm.matches('{"age": 1, "name": "bob"}')
+
+
+@pytest.mark.parametrize(
+    "pattern, matching, not_matching",
+    [
+        (r"^[a-z]{2}-\d$", ["ab-1"], ["xab-1", "ab-12", "ab"]),
+        # Unanchored patterns match anywhere in the string
+        (r"\d-\d", ["1-2", "a 1-2 b"], ["1-", "a-2"]),
+        (r"^id", ["id", "id-3"], ["xid"]),
+        (r"[0-9]\$", ["1$", "a1$b"], ["1"]),
+    ],
+)
+def test_json_schema_pattern(pattern, matching, not_matching):
+    schema = {"type": "object", "properties": {"code": {"type": "string", "pattern": pattern}}, "required": ["code"]}
+    fsm = RegexFSM(json_schema_to_regex(schema))
+    for value in matching:
+        assert fsm.matches(json.dumps({"code": value}))
+    for value in not_matching:
+        assert not fsm.matches(json.dumps({"code": value}))
+
+
+def test_json_schema_pattern_inner_anchor():
+    with pytest.raises(ValueError, match="anchors"):
+        json_schema_to_regex({"type": "string", "pattern": "a|^b"})
+
+
+def test_fsm_index(tokenizer, tmp_path):
+    pattern = r'\{"ok": (true|false), "n": [0-9]{1,3}\}'
+    index = FSMIndex.from_regex(pattern, tokenizer, cache_dir=tmp_path)
+    # The index is loaded from the cache the second time
+    assert len(list(tmp_path.iterdir())) == 1
+    cached_index = FSMIndex.from_regex(pattern, tokenizer, cache_dir=tmp_path)
+    assert torch.equal(cached_index.masks, index.masks)
+    # Random logits always produce a matching text
+    vocab_size = len(tokenizer) + 3
+    torch.manual_seed(0)
+    for _ in range(10):
+        processor = FSMLogitsProcessor(index)
+        input_ids = torch.tensor([[1, 2]])
+        while input_ids[0, -1] != tokenizer.eos_token_id:
+            scores = processor(input_ids, torch.randn(1, vocab_size))
+            input_ids = torch.cat([input_ids, torch.argmax(scores, dim=-1, keepdim=True)], dim=-1)
+        text = "".join(tokenizer.convert_ids_to_tokens(input_ids[0, 2:-1].tolist()))
+        assert re.fullmatch(pattern, text)
+
+
+def test_fsm_index_no_match(tokenizer, tmp_path):
+    # There is no token for upper case characters
+    with pytest.raises(ValueError):
+        FSMIndex.from_regex("[A-Z]+", tokenizer, cache_dir=tmp_path)
+
+
+def test_batched_constraints(tokenizer, tmp_path):
+    index = FSMIndex.from_regex("(ab|12)+", tokenizer, cache_dir=tmp_path)
+    batch_size, vocab_size = 3, len(tokenizer)
+
+    def create_selector(processor=None):
+        return TokenSelector(
+            mode=GenerationMode.GREEDY_SEARCH,
+            logits_processor=LogitsProcessorList([] if processor is None else [processor]),
+            stopping_criteria=StoppingCriteriaList(),
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+
+    selectors = [
+        create_selector(FSMLogitsProcessor(index, 1)),
+        create_selector(),
+        create_selector(FSMLogitsProcessor(index, 3)),
+    ]
+    selector = BatchedTokenSelector(batch_size)
+    for i in range(batch_size):
+        selector.set(i, selectors[i])
+    ab = tokenizer.convert_tokens_to_ids("ab")
+    # The rows are padded with -1
+    input_ids = torch.tensor([[5, ab, -1], [5, 6, 7], [5, 6, ab]])
+    logits = torch.randn(batch_size, vocab_size)
+    next_tokens = selector.select(logits, input_ids=input_ids)
+    for i in range(batch_size):
+        row_input_ids = input_ids[i : i + 1]
+        row_input_ids = row_input_ids[row_input_ids >= 0].unsqueeze(0)
+        assert next_tokens[i] == selectors[i].select(row_input_ids, logits[i : i + 1].clone())[0]
+    assert next_tokens[0] in tokenizer.convert_tokens_to_ids(["a", "1", "ab", "12", "<eos>"])
+    assert next_tokens[2] in tokenizer.convert_tokens_to_ids(["a", "1", "ab", "12"])
+
+
+def test_fsm_processor_states(tokenizer, tmp_path):
+    index = FSMIndex.from_regex("(ab|12)+", tokenizer, cache_dir=tmp_path)
+    a, b, ab = tokenizer.convert_tokens_to_ids(["a", "b", "ab"])
+    processor = FSMLogitsProcessor(index, 1)
+
+    def walk(tokens):
+        state = 0
+        for token in tokens:
+            state = index.next_state(state, token)
+        return state
+
+    # The rows grow, are replaced by another sequence, or shrink between calls
+    for input_ids in [[[5, a, b], [5, ab, -1]], [[5, a, b, ab], [5, ab, a, -1]], [[5, ab, -1, -1], [5, a, -1, -1]]]:
+        states = processor.states(torch.tensor(input_ids))
+        expected = [walk([token for token in row[1:] if token >= 0]) for row in input_ids]
+        assert states.tolist() == expected
+
+
+@pytest.fixture(scope="module")
+def byte_level_tokenizer():
+    # A byte-level vocabulary: each byte has its own token, and only some multi-byte characters are merged
+    byte_encoder = bytes_to_unicode()
+    merges = ["é", " é", "ab"]
+    tokens = ["<eos>"] + [byte_encoder[byte] for byte in range(256)]
+    tokens += ["".join(byte_encoder[byte] for byte in merge.encode()) for merge in merges]
+    tokenizer = Tokenizer(models.WordLevel({token: i for i, token in enumerate(tokens)}, unk_token="<eos>"))
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>")
+
+
+@pytest.mark.parametrize("pattern", [r"(é|日本)+x", r"[^a-z]{2}ü?", r'"[^"]{1,4}"'])
+def test_fsm_index_multi_byte_characters(byte_level_tokenizer, tmp_path, pattern):
+    tokenizer = byte_level_tokenizer
+    index = FSMIndex.from_regex(pattern, tokenizer, cache_dir=tmp_path)
+    # The characters without a token of their own are generated one byte at a time
+    vocab_size = len(tokenizer)
+    torch.manual_seed(0)
+    texts = set()
+    for _ in range(20):
+        processor = FSMLogitsProcessor(index)
+        input_ids = torch.tensor([[1]])
+        while input_ids[0, -1] != tokenizer.eos_token_id:
+            scores = processor(input_ids, torch.randn(1, vocab_size) * 10)
+            input_ids = torch.cat([input_ids, torch.argmax(scores, dim=-1, keepdim=True)], dim=-1)
+        text = tokenizer.decode(input_ids[0, 1:-1])
+        assert re.fullmatch(pattern, text), text
+        texts.add(text)
+    assert any(re.search(r"[^\x00-\x7f]", text) for text in texts)
@@ -14,9 +14,10 @@
 # limitations under the License.
 
 import pytest
+import torch
 from generation_utils import check_neuron_model
 
-from optimum.neuron import NeuronModelForCausalLM
+from optimum.neuron import NeuronModelForCausalLM, modeling_decoder
 from optimum.neuron.utils.testing_utils import is_inferentia_test, requires_neuronx
 
 
@@ -47,3 +48,126 @@ def test_model_export(export_model_id, batch_size, sequence_length, num_cores, a
 def test_model_from_path(neuron_model_path):
     model = NeuronModelForCausalLM.from_pretrained(neuron_model_path)
     check_neuron_model(model)
+
+
+@is_inferentia_test
+@requires_neuronx
+def test_model_export_sequence_length_buckets(export_model_id, tmp_path):
+    model = NeuronModelForCausalLM.from_pretrained(
+        export_model_id, export=True, batch_size=1, sequence_length=[128, 64], num_cores=2
+    )
+    check_neuron_model(model, sequence_length=128)
+    assert model.config.neuron["sequence_length_buckets"] == [64, 128]
+    model.save_pretrained(tmp_path)
+    model = NeuronModelForCausalLM.from_pretrained(tmp_path)
+    assert model.sequence_length_buckets == [64, 128]
+    assert model.max_length == 128
+    # Sequences spanning both buckets can be generated
+    input_ids = torch.ones((1, 32), dtype=torch.int64)
+    output_ids = model.generate(input_ids, do_sample=False, min_length=100, max_length=100)
+    assert output_ids.shape == (1, 100)
+
+
+def test_model_export_sequence_length_buckets_cpu(cpu_export_model_path):
+    model = NeuronModelForCausalLM.from_pretrained(
+        cpu_export_model_path, export=True, batch_size=1, sequence_length=[128, 64, 128]
+    )
+    check_neuron_model(model, sequence_length=128)
+    assert model.config.neuron["sequence_length_buckets"] == [64, 128]
+    assert model.sequence_length_buckets == [64, 128]
+    assert model.max_length == 128
+    # A context encoding and a token generation graph are compiled for each bucket
+    assert model.model.compile_kwargs["n_positions"] == [64, 128]
+    assert model.model.compile_kwargs["context_length_estimate"] == [64, 128]
+    input_ids = torch.ones((1, 32), dtype=torch.int64)
+    output_ids = model.generate(input_ids, do_sample=False, min_length=100, max_length=100)
+    assert output_ids.shape == (1, 100)
+    # A single bucket is a regular sequence length
+    model = NeuronModelForCausalLM.from_pretrained(cpu_export_model_path, export=True, sequence_length=[64])
+    check_neuron_model(model, sequence_length=64)
+    assert model.config.neuron["sequence_length_buckets"] is None
+    assert model.model.compile_kwargs == {"batch_size": 1, "n_positions": 64}
+
+
+@pytest.mark.parametrize("sequence_length", [[], [0, 64]])
+def test_model_export_invalid_sequence_length_buckets(cpu_export_model_path, sequence_length):
+    with pytest.raises(ValueError, match="Invalid sequence length buckets"):
+        NeuronModelForCausalLM.from_pretrained(cpu_export_model_path, export=True, sequence_length=sequence_length)
+
+
+@pytest.mark.parametrize(
+    "export_kwargs, feature",
+    [
+        ({"batch_size": [1, 2]}, "Multiple batch sizes"),
+        ({"sequence_length": [64, 128]}, "Sequence length buckets"),
+        ({"batch_size": 2, "continuous_batching": True}, "Continuous batching"),
+        ({"speculation_length": 4}, "Speculative decoding"),
+    ],
+)
+def test_model_export_unsupported_transformers_neuronx(cpu_export_model_path, monkeypatch, export_kwargs, feature):
+    monkeypatch.setattr(modeling_decoder, "get_transformers_neuronx_version", lambda: "0.8.268")
+    with pytest.raises(RuntimeError, match=f"{feature} requires transformers-neuronx"):
+        NeuronModelForCausalLM.from_pretrained(cpu_export_model_path, export=True, **export_kwargs)
+    # The features that are not requested do not require a recent version
+    NeuronModelForCausalLM.from_pretrained(cpu_export_model_path, export=True, sequence_length=64)
+
+
+@is_inferentia_test
+@requires_neuronx
+def test_model_export_batch_sizes(export_model_id, tmp_path):
+    model = NeuronModelForCausalLM.from_pretrained(
+        export_model_id, export=True, batch_size=[4, 1], sequence_length=100, num_cores=2
+    )
+    check_neuron_model(model, batch_size=4)
+    assert model.config.neuron["batch_sizes"] == [1, 4]
+    model.save_pretrained(tmp_path)
+    model = NeuronModelForCausalLM.from_pretrained(tmp_path)
+    assert model.batch_sizes == [1, 4]
+    # Each batch is evaluated by the graph of the smallest batch size that can hold it
+    for batch_size in [1, 3, 4]:
+        input_ids = torch.ones((batch_size, 10), dtype=torch.int64)
+        output_ids = model.generate(input_ids, do_sample=False, max_new_tokens=10)
+        assert output_ids.shape[0] == batch_size
+
+
+def test_model_export_batch_sizes_cpu(cpu_export_model_path):
+    model = NeuronModelForCausalLM.from_pretrained(
+        cpu_export_model_path, export=True, batch_size=[4, 1, 2, 4], sequence_length=64
+    )
+    check_neuron_model(model, batch_size=4)
+    assert model.config.neuron["batch_sizes"] == [1, 2, 4]
+    assert model.batch_sizes == [1, 2, 4]
+    # A graph is compiled for each batch size
+    assert model.model.compile_kwargs["batch_size"] == [1, 2, 4]
+    # Each batch is evaluated by the graph of the smallest batch size that can hold it
+    for batch_size, compiled_batch_size in [(1, 1), (2, 2), (3, 4), (4, 4)]:
+        input_ids = torch.ones((batch_size, 10), dtype=torch.int64)
+        output_ids = model.generate(input_ids, do_sample=False, max_new_tokens=5)
+        assert output_ids.shape[0] == batch_size
+        assert model.model.forwards[-1][0] == compiled_batch_size
+    # A single batch size is a regular batch size
+    model = NeuronModelForCausalLM.from_pretrained(cpu_export_model_path, export=True, batch_size=[2])
+    check_neuron_model(model, batch_size=2)
+    assert model.config.neuron["batch_sizes"] is None
+    assert model.model.compile_kwargs["batch_size"] == 2
+
+
+@pytest.mark.parametrize("batch_size", [[], [0, 2]])
+def test_model_export_invalid_batch_sizes(cpu_export_model_path, batch_size):
+    with pytest.raises(ValueError, match="Invalid batch sizes"):
+        NeuronModelForCausalLM.from_pretrained(cpu_export_model_path, export=True, batch_size=batch_size)
+
+
+def test_model_export_continuous_batching_batch_sizes_cpu(cpu_export_model_path):
+    with pytest.raises(ValueError, match="only be compiled for one batch size"):
+        NeuronModelForCausalLM.from_pretrained(
+            cpu_export_model_path, export=True, batch_size=[1, 4], continuous_batching=True
+        )
+
+
+@requires_neuronx
+def test_model_export_continuous_batching_batch_sizes(export_model_id):
+    with pytest.raises(ValueError, match="only be compiled for one batch size"):
+        NeuronModelForCausalLM.from_pretrained(
+            export_model_id, export=True, batch_size=[1, 4], sequence_length=100, continuous_batching=True
+        )
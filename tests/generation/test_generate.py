@@ -15,12 +15,32 @@
 
 import pytest
 import torch
+from generation_utils import left_pad
 from transformers import AutoTokenizer
+from transformers.generation.streamers import BaseStreamer
 
 from optimum.neuron import NeuronModelForCausalLM
 from optimum.neuron.utils.testing_utils import is_inferentia_test, requires_neuronx
 
 
+class RecordingStreamer(BaseStreamer):
+    def __init__(self, model=None):
+        self.values = []
+        self.ended = False
+        # The number of forwards of a CPU model before each call
+        self.model = model
+        self.forwards = []
+
+    def put(self, value):
+        assert not self.ended
+        self.values.append(value.clone())
+        if self.model is not None:
+            self.forwards.append(len(self.model.model.forwards))
+
+    def end(self):
+        self.ended = True
+
+
 def _test_model_generation(model, tokenizer, batch_size, input_length, **gen_kwargs):
     input_ids = torch.ones((batch_size, input_length), dtype=torch.int64)
     with torch.inference_mode():
@@ -59,3 +79,117 @@ def test_model_generation_input_dimensions(neuron_model_path):
     # Using an incompatible input length
     with pytest.raises(ValueError, match="The input sequence length"):
         _test_model_generation(model, tokenizer, model.batch_size, input_length=model.max_length * 2)
+
+
+@is_inferentia_test
+@requires_neuronx
+def test_model_generation_prompt_lookup_requirements(neuron_model_path):
+    model = NeuronModelForCausalLM.from_pretrained(neuron_model_path)
+    tokenizer = AutoTokenizer.from_pretrained(neuron_model_path)
+    # The model was not exported with a speculation length
+    with pytest.raises(ValueError, match="Prompt lookup decoding requires"):
+        _test_model_generation(model, tokenizer, model.batch_size, 10, prompt_lookup_num_tokens=3)
+
+
+@is_inferentia_test
+@requires_neuronx
+def test_model_generation_streamer(neuron_model_path):
+    model = NeuronModelForCausalLM.from_pretrained(neuron_model_path)
+
+    input_ids = torch.ones((model.batch_size, 10), dtype=torch.int64)
+    streamer = RecordingStreamer()
+    with torch.inference_mode():
+        output_ids = model.generate(input_ids, do_sample=False, max_new_tokens=10, streamer=streamer)
+    assert streamer.ended
+    # The prompts are streamed first, then the tokens of each step
+    assert torch.equal(streamer.values[0], input_ids)
+    assert torch.equal(torch.stack(streamer.values[1:], dim=-1), output_ids[:, input_ids.shape[-1] :])
+
+
+@is_inferentia_test
+@requires_neuronx
+def test_model_generation_continuous_batching(export_model_id):
+    model = NeuronModelForCausalLM.from_pretrained(
+        export_model_id, export=True, batch_size=2, sequence_length=100, num_cores=2, continuous_batching=True
+    )
+    tokenizer = AutoTokenizer.from_pretrained(export_model_id)
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    prompts = ["It was a bright cold day", "Hello", "The quick brown fox jumps over", "Once upon a time", "I"]
+    with torch.inference_mode():
+        # More prompts than the model batch size are generated, and returned in the order of the prompts
+        tokens = tokenizer(prompts, return_tensors="pt", padding=True)
+        output_ids = model.generate(**tokens, do_sample=False, max_new_tokens=10)
+        assert output_ids.shape[0] == len(prompts)
+        for prompt, sequence in zip(prompts, output_ids):
+            single_tokens = tokenizer(prompt, return_tensors="pt")
+            single_output_ids = model.generate(**single_tokens, do_sample=False, max_new_tokens=10)
+            assert tokenizer.decode(sequence, skip_special_tokens=True) == tokenizer.decode(
+                single_output_ids[0], skip_special_tokens=True
+            )
+
+
+def test_model_generation_continuous_refill(cpu_neuron_model):
+    model, reference_model = cpu_neuron_model(batch_size=2, continuous_batching=True)
+    torch.manual_seed(1)
+    # More prompts than KV cache rows, of different lengths: rows are refilled as soon as a sequence is finished
+    prompts = [torch.randint(1, 64, [length]) for length in [5, 12, 3, 9, 7]]
+    input_ids, attention_mask = left_pad(prompts)
+    max_new_tokens = 10
+    outputs = model.generate(input_ids, attention_mask=attention_mask, do_sample=False, max_new_tokens=max_new_tokens)
+    # Several sequences were prefilled in each KV cache row
+    assert sum(1 for shape in model.model.forwards if shape[-1] > 1) > 1
+    for prompt, output in zip(prompts, outputs):
+        expected = reference_model.generate(
+            prompt[None, :], do_sample=False, max_new_tokens=max_new_tokens, pad_token_id=0
+        )[0, len(prompt) :]
+        generated = output[input_ids.shape[-1] :]
+        assert generated[: len(expected)].tolist() == expected.tolist()
+        assert torch.all(generated[len(expected) :] == model.generation_config.eos_token_id)
+    with pytest.raises(ValueError, match="not supported when generating more sequences"):
+        model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens, cache_ids=None)
+
+
+def test_model_generation_streamer_order(cpu_neuron_model):
+    model, _ = cpu_neuron_model(batch_size=3)
+    # The inputs are padded to the model batch size, but only the actual sequences are streamed
+    input_ids = torch.randint(1, 64, [2, 6])
+    streamer = RecordingStreamer(model)
+    output_ids = model.generate(input_ids, do_sample=False, max_new_tokens=8, streamer=streamer)
+    assert streamer.ended
+    assert torch.equal(streamer.values[0], input_ids)
+    assert torch.equal(torch.stack(streamer.values[1:], dim=-1), output_ids[:, input_ids.shape[-1] :])
+    # The prompts are streamed before the first forward, and the tokens of each step before the next forward
+    assert streamer.forwards == list(range(len(streamer.values)))
+    # Streaming is not supported when the rows of a continuous batching model are refilled
+    model, _ = cpu_neuron_model(batch_size=1, continuous_batching=True)
+    with pytest.raises(ValueError, match="Streaming is not supported"):
+        model.generate(input_ids, max_new_tokens=8, streamer=RecordingStreamer())
+
+
+@pytest.mark.parametrize("continuous_batching", [False, True], ids=["static", "continuous"])
+def test_model_generation_max_length(cpu_neuron_model, continuous_batching):
+    sequence_length = 32
+    model, reference_model = cpu_neuron_model(
+        batch_size=2, sequence_length=sequence_length, continuous_batching=continuous_batching
+    )
+    torch.manual_seed(2)
+    prompts = [torch.randint(1, 64, [length]) for length in [4, 9]]
+    input_ids, attention_mask = left_pad(prompts)
+    # The tokens are generated up to the model maximum length
+    output_ids = model.generate(input_ids, attention_mask=attention_mask, do_sample=False, max_new_tokens=64)
+    assert output_ids.shape[-1] == sequence_length
+    max_new_tokens = sequence_length - input_ids.shape[-1]
+    for prompt, output in zip(prompts, output_ids):
+        expected = reference_model.generate(
+            prompt[None, :], do_sample=False, max_new_tokens=max_new_tokens, pad_token_id=0
+        )[0, len(prompt) :]
+        generated = output[input_ids.shape[-1] :]
+        assert generated[: len(expected)].tolist() == expected.tolist()
+        assert torch.all(generated[len(expected) :] == model.generation_config.eos_token_id)
+    if not continuous_batching:
+        # Without attention mask, the prompts are evaluated as they are, padding included
+        output_ids = model.generate(input_ids, do_sample=False, max_new_tokens=4)
+        expected = reference_model.generate(
+            input_ids, attention_mask=torch.ones_like(input_ids), do_sample=False, max_new_tokens=4, pad_token_id=0
+        )
+        assert output_ids[:, : expected.shape[-1]].tolist() == expected.tolist()
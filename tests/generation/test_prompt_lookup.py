@@ -0,0 +1,62 @@
+import pytest
+import torch
+from generation_utils import left_pad
+
+from optimum.neuron.generation import PromptLookupIndex
+
+
+def test_propose():
+    index = PromptLookupIndex([1, 2, 3, 4, 2, 3, 5, 6])
+    # The longest n-gram is matched first
+    assert index.propose([7, 1, 2, 3], 2) == [4, 2]
+    # The last occurrence of an n-gram is preferred
+    assert index.propose([7, 9, 2, 3], 3) == [5, 6]
+    # Shorter n-grams are matched if no longer n-gram matches
+    assert index.propose([7, 9, 4], 2) == [2, 3]
+    # Proposals stop at the end of the prompt
+    assert index.propose([9, 5], 4) == [6]
+
+
+def test_propose_no_match():
+    index = PromptLookupIndex([1, 2, 3])
+    assert index.propose([4, 5], 2) == []
+    # The last token of the prompt has no continuation
+    assert index.propose([3], 2) == []
+    assert index.propose([], 2) == []
+
+
+def test_max_ngram_size():
+    index = PromptLookupIndex([1, 2, 3, 9, 2, 3, 4], max_ngram_size=1)
+    assert index.propose([1, 2, 3], 1) == [4]
+    with pytest.raises(ValueError):
+        PromptLookupIndex([1, 2, 3], max_ngram_size=0)
+
+
+@pytest.mark.parametrize("long_first", [True, False], ids=["long-first", "long-last"])
+def test_generate_near_max_length(cpu_neuron_model, long_first):
+    sequence_length = 64
+    num_tokens = 4
+    model, reference_model = cpu_neuron_model(
+        sequence_length=sequence_length, continuous_batching=True, speculation_length=num_tokens + 1
+    )
+    # The short prompt is followed by its own greedy continuation, so that tokens are proposed for it
+    # while the long prompt reaches the end of the KV cache
+    short_prompt = reference_model.generate(torch.arange(1, 11)[None, :], do_sample=False, max_new_tokens=20)[0]
+    long_prompt = torch.arange(sequence_length - num_tokens - 1) % 24 + 1
+    prompts = [long_prompt, short_prompt] if long_first else [short_prompt, long_prompt]
+    padded_length = len(long_prompt)
+    input_ids, attention_mask = left_pad(prompts)
+    outputs = model.generate(
+        input_ids,
+        attention_mask=attention_mask,
+        do_sample=False,
+        max_new_tokens=sequence_length,
+        prompt_lookup_num_tokens=num_tokens,
+    )
+    # Tokens are proposed at the first step, before the long prompt reaches the end of the KV cache
+    assert model.model.forwards[1] == (len(prompts), num_tokens + 1)
+    for prompt, output in zip(prompts, outputs):
+        expected = reference_model.generate(
+            prompt[None, :], do_sample=False, max_new_tokens=sequence_length - padded_length, pad_token_id=0
+        )[0, len(prompt) :]
+        assert output[padded_length:][: len(expected)].tolist() == expected.tolist()
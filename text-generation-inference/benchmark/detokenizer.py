@@ -0,0 +1,85 @@
+"""Compare the cost of producing streamed token texts for a batch of generated sequences.
+
+The legacy path decodes each new token alone, then decodes it again with the previous token to
+detect missing leading spaces. The incremental path uses the IncrementalDetokenizer of each slot.
+
+Usage:
+
+    python detokenizer.py --tokenizer gpt2 --batch-sizes 4 8 16 32 --new-tokens 256
+"""
+import argparse
+import time
+from typing import List
+
+import torch
+from text_generation_server.detokenizer import IncrementalDetokenizer
+from transformers import AutoTokenizer
+
+
+def legacy_decode(tokenizer, token_ids: List[int], text: str) -> str:
+    next_token = token_ids[-1]
+    next_token_text = tokenizer.decode(next_token)
+    if not text.endswith(" ") and not next_token_text.startswith(" "):
+        # Some tokenizers do not prepend spaces automatically when decoding a single token
+        contextual_text = tokenizer.decode(token_ids[-2:])
+        if contextual_text[: -len(next_token_text)].endswith(" "):
+            next_token_text = " " + next_token_text
+    return next_token_text
+
+
+def run(tokenizer, sequences: List[List[int]], prompt_length: int, incremental: bool):
+    texts = [""] * len(sequences)
+    detokenizers = []
+    if incremental:
+        for sequence in sequences:
+            detokenizer = IncrementalDetokenizer(tokenizer)
+            detokenizer.reset(sequence[:prompt_length])
+            detokenizers.append(detokenizer)
+    start = time.perf_counter()
+    for length in range(prompt_length + 1, len(sequences[0]) + 1):
+        for i, sequence in enumerate(sequences):
+            if incremental:
+                texts[i] += detokenizers[i].decode(sequence[:length])
+            else:
+                texts[i] += legacy_decode(tokenizer, sequence[:length], texts[i])
+    elapsed = time.perf_counter() - start
+    return elapsed, texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", type=str, default="gpt2", help="The tokenizer model id or path.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--prompt-length", type=int, default=32)
+    parser.add_argument("--new-tokens", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    torch.manual_seed(args.seed)
+    length = args.prompt_length + args.new_tokens
+    steps = args.new_tokens
+    print(
+        f"{'batch_size':>10} {'legacy (ms/step)':>18} {'incremental (ms/step)':>22} {'speedup':>8} {'mismatches':>10}"
+    )
+    for batch_size in args.batch_sizes:
+        sequences = torch.randint(0, tokenizer.vocab_size, [batch_size, length]).tolist()
+        legacy_time, _ = run(tokenizer, sequences, args.prompt_length, incremental=False)
+        incremental_time, texts = run(tokenizer, sequences, args.prompt_length, incremental=True)
+        # The incremental texts must be a prefix of the full decoded text (the end might be an incomplete character)
+        mismatches = 0
+        for sequence, text in zip(sequences, texts):
+            prompt_text, full_text = (
+                tokenizer.decode(ids, skip_special_tokens=False, clean_up_tokenization_spaces=False)
+                for ids in (sequence[: args.prompt_length], sequence)
+            )
+            if not full_text[len(prompt_text) :].startswith(text):
+                mismatches += 1
+        print(
+            f"{batch_size:>10} {legacy_time * 1000 / steps:>18.3f} {incremental_time * 1000 / steps:>22.3f}"
+            f" {legacy_time / incremental_time:>8.2f} {mismatches:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
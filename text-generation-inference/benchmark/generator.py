@@ -0,0 +1,218 @@
+"""Replay an arrival trace of requests through a NeuronGenerator backed by a simulated model.
+
+The model is a `SimulatedModelForCausalLM`: it produces deterministic logits and waits for a configurable
+simulated latency at each forward, so that the overhead of the generator loop can be measured without
+Neuron hardware. The requests are submitted through `prefill`, `decode` and `filter` as the router would.
+
+The trace is a JSON lines file, each line describing a request:
+
+    {"arrival": 0.25, "prompt_length": 120, "max_new_tokens": 64, "parameters": {"do_sample": true, "top_k": 50}}
+
+where `arrival` is the time of the request in seconds since the beginning of the trace. If no trace is specified,
+requests are generated with Poisson arrivals (the generated trace can be saved with `--save-trace`).
+
+Usage:
+
+    python generator.py --model-id gpt2 --batch-size 8 --max-length 1024 --forward-latency 0.02 --requests 200
+    python generator.py --model-id gpt2 --trace trace.jsonl --decode-steps 4 --prefix-cache
+"""
+import argparse
+import json
+import random
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+import numpy as np
+from text_generation_server.cpu_model import SimulatedModelForCausalLM
+from text_generation_server.generator import NeuronGenerator
+from text_generation_server.pb.generate_pb2 import (
+    Batch,
+    NextTokenChooserParameters,
+    Request,
+    StoppingCriteriaParameters,
+)
+from transformers import AutoTokenizer
+
+
+DEFAULT_PARAMETERS = {
+    "temperature": 1.0,
+    "top_k": 0,
+    "top_p": 1.0,
+    "typical_p": 1.0,
+    "do_sample": False,
+    "seed": 0,
+    "repetition_penalty": 1.0,
+}
+
+
+def synthetic_trace(args) -> List[Dict[str, Any]]:
+    random.seed(args.seed)
+    trace = []
+    arrival = 0.0
+    for _ in range(args.requests):
+        arrival += random.expovariate(args.rate)
+        parameters = {"do_sample": True, "top_k": 50, "temperature": 0.8} if random.random() < args.sampling else {}
+        trace.append(
+            {
+                "arrival": round(arrival, 4),
+                "prompt_length": random.randint(*args.prompt_length),
+                "max_new_tokens": random.randint(*args.new_tokens),
+                "parameters": parameters,
+            }
+        )
+    return trace
+
+
+def create_request(index: int, record: Dict[str, Any], tokenizer, prompt_length: int) -> Request:
+    # The prompt is the text of random tokens, truncated to the expected number of tokens
+    prompt_length = min(record["prompt_length"], prompt_length)
+    token_ids = np.random.default_rng(index).integers(0, tokenizer.vocab_size, prompt_length + 8).tolist()
+    parameters = dict(DEFAULT_PARAMETERS, **record.get("parameters", {}))
+    return Request(
+        id=index,
+        inputs=tokenizer.decode(token_ids),
+        truncate=prompt_length,
+        parameters=NextTokenChooserParameters(**parameters),
+        stopping_parameters=StoppingCriteriaParameters(max_new_tokens=record["max_new_tokens"]),
+    )
+
+
+def replay(generator: NeuronGenerator, requests: List[Request], arrivals: List[float]):
+    """Submit the requests at their arrival time, and return the timestamps of the tokens of each request.
+
+    Return:
+        The tokens timestamps of each request, and for each generator call its duration, the time spent in the
+        model and the number of generated tokens.
+    """
+    model = generator.model
+    batch_size = model.batch_size
+    waiting = deque(range(len(requests)))
+    queued = deque()
+    pending = set()
+    token_times = {request.id: [] for request in requests}
+    calls = []
+    cached_batch = None
+    batch_id = 0
+    start = time.perf_counter()
+
+    def run(method, *args):
+        forward_time = model.forward_time
+        call_start = time.perf_counter()
+        generations, next_batch = method(*args)
+        end = time.perf_counter()
+        for generation in generations:
+            token_times[generation.request_id].append(end - start)
+            if generation.generated_text is not None:
+                pending.remove(generation.request_id)
+        calls.append((end - call_start, model.forward_time - forward_time, len(generations)))
+        return generations, next_batch
+
+    while len(waiting) > 0 or len(queued) > 0 or len(pending) > 0:
+        now = time.perf_counter() - start
+        while len(waiting) > 0 and arrivals[waiting[0]] <= now:
+            queued.append(waiting.popleft())
+        if len(pending) == 0 and len(queued) == 0:
+            time.sleep(arrivals[waiting[0]] - now)
+            continue
+        batches = [] if cached_batch is None else [cached_batch]
+        free = batch_size - len(pending)
+        if len(queued) > 0 and free > 0:
+            new_requests = [requests[queued.popleft()] for _ in range(min(free, len(queued)))]
+            pending.update(request.id for request in new_requests)
+            batch_id += 1
+            _, prefill_batch = run(generator.prefill, Batch(id=batch_id, requests=new_requests))
+            if prefill_batch is not None:
+                batches.append(prefill_batch)
+        if len(batches) == 0:
+            cached_batch = None
+            continue
+        size = sum(len(batch.request_ids) for batch in batches)
+        generations, cached_batch = run(generator.decode, batches)
+        if cached_batch is not None and len(cached_batch.request_ids) < size:
+            # The router removes the finished requests from its batch
+            filter_start = time.perf_counter()
+            cached_batch = generator.filter(cached_batch.id, list(cached_batch.request_ids))
+            calls.append((time.perf_counter() - filter_start, 0.0, 0))
+    return token_times, calls, time.perf_counter() - start
+
+
+def percentiles(values: List[float], scale: float = 1.0) -> str:
+    if len(values) == 0:
+        return "-"
+    p50, p90, p99 = (np.percentile(values, q) * scale for q in (50, 90, 99))
+    return f"{p50:10.2f} {p90:10.2f} {p99:10.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-id", type=str, default="gpt2", help="The model whose config and tokenizer are used.")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-length", type=int, default=1024)
+    parser.add_argument("--static", action="store_true", help="Simulate a model without continuous batching.")
+    parser.add_argument("--forward-latency", type=float, default=0.02, help="The duration of a forward (s).")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="The duration per input token (s).")
+    parser.add_argument("--trace", type=str, help="The JSON lines file of the requests to replay.")
+    parser.add_argument("--save-trace", type=str, help="Save the generated trace to this JSON lines file.")
+    parser.add_argument("--requests", type=int, default=100, help="The number of generated requests.")
+    parser.add_argument("--rate", type=float, default=10.0, help="The arrival rate of generated requests (1/s).")
+    parser.add_argument("--prompt-length", type=int, nargs=2, default=[16, 256])
+    parser.add_argument("--new-tokens", type=int, nargs=2, default=[16, 128])
+    parser.add_argument("--sampling", type=float, default=0.5, help="The fraction of generated sampling requests.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--decode-steps", type=int, default=1)
+    parser.add_argument("--prefix-cache", action="store_true")
+    parser.add_argument("--prefill-chunk-size", type=int)
+    parser.add_argument("--max-prefill-padding", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.trace is None:
+        trace = synthetic_trace(args)
+    else:
+        with open(args.trace) as f:
+            trace = [json.loads(line) for line in f if len(line.strip()) > 0]
+    if args.save_trace is not None:
+        with open(args.save_trace, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in trace)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+    model = SimulatedModelForCausalLM.from_pretrained(
+        args.model_id,
+        batch_size=args.batch_size,
+        max_length=args.max_length,
+        continuous_batching=not args.static,
+        forward_latency=args.forward_latency,
+        token_latency=args.token_latency,
+    )
+    generator = NeuronGenerator(
+        model,
+        tokenizer,
+        decode_steps=args.decode_steps,
+        prefix_cache=args.prefix_cache,
+        prefill_chunk_size=args.prefill_chunk_size,
+        max_prefill_padding=args.max_prefill_padding,
+    )
+    requests = [create_request(i, record, tokenizer, args.max_length // 2) for i, record in enumerate(trace)]
+    token_times, calls, duration = replay(generator, requests, [record["arrival"] for record in trace])
+
+    arrivals = {request.id: record["arrival"] for request, record in zip(requests, trace)}
+    ttft = [times[0] - arrivals[i] for i, times in token_times.items()]
+    itl = [b - a for times in token_times.values() for a, b in zip(times, times[1:])]
+    request_throughput = [
+        (len(times) - 1) / (times[-1] - times[0]) for times in token_times.values() if times[-1] > times[0]
+    ]
+    overhead = [(call - forward) / n for call, forward, n in calls if n > 0]
+    generated_tokens = sum(len(times) for times in token_times.values())
+    total_overhead = sum(call - forward for call, forward, _ in calls)
+    print(f"{len(requests)} requests, {generated_tokens} tokens in {duration:.2f} s")
+    print(f"throughput: {generated_tokens / duration:.1f} tokens/s")
+    print(f"host overhead: {total_overhead * 1000 / generated_tokens:.3f} ms/token")
+    print(f"{'':>30} {'p50':>10} {'p90':>10} {'p99':>10}")
+    print(f"{'time to first token (ms)':>30} {percentiles(ttft, 1000)}")
+    print(f"{'inter-token latency (ms)':>30} {percentiles(itl, 1000)}")
+    print(f"{'request throughput (tokens/s)':>30} {percentiles(request_throughput)}")
+    print(f"{'host overhead (ms/token)':>30} {percentiles(overhead, 1000)}")
+
+
+if __name__ == "__main__":
+    main()
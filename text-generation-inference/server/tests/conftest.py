@@ -0,0 +1,53 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+
+CORPUS = [
+    "the quick brown fox jumps over the lazy dog",
+    "hello world, how are you doing today?",
+    "été à Paris 🙂 日本語",
+]
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    """A small byte-level BPE tokenizer, whose multi-byte characters are split across several tokens."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300, special_tokens=["<eos>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(CORPUS * 50, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>")
+
+
+def save_random_model(tokenizer, path, n_layer: int, seed: int) -> str:
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=128,
+        n_embd=32,
+        n_layer=n_layer,
+        n_head=2,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(seed)
+    model = GPT2LMHeadModel(config)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def model_path(tokenizer, tmp_path_factory):
+    """A tiny random GPT2 checkpoint, saved with its tokenizer to be loaded as a `CPUModelForCausalLM`."""
+    return save_random_model(tokenizer, tmp_path_factory.mktemp("tiny-gpt2"), n_layer=2, seed=0)
+
+
+@pytest.fixture(scope="session")
+def draft_model_path(tokenizer, tmp_path_factory):
+    """A smaller random GPT2 checkpoint sharing the same tokenizer, whose outputs differ from the model ones."""
+    return save_random_model(tokenizer, tmp_path_factory.mktemp("tiny-gpt2-draft"), n_layer=1, seed=1)
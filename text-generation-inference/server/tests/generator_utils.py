@@ -0,0 +1,75 @@
+from typing import Dict, List
+
+import torch
+from text_generation_server.generator import NeuronGenerator
+from text_generation_server.pb.generate_pb2 import (
+    Batch,
+    NextTokenChooserParameters,
+    Request,
+    StoppingCriteriaParameters,
+)
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+PROMPTS = [
+    "the quick brown fox",
+    "hello world, how are you doing today?",
+    "the lazy dog jumps over the quick brown fox",
+    "été à Paris",
+    "hello",
+    "how are you doing today? the quick brown fox jumps over the lazy dog",
+]
+
+
+def create_request(id: int, inputs: str, max_new_tokens: int = 20, do_sample: bool = False) -> Request:
+    parameters = NextTokenChooserParameters(
+        temperature=1.0, top_k=0, top_p=1.0, typical_p=1.0, do_sample=do_sample, seed=0, repetition_penalty=1.0
+    )
+    stopping_parameters = StoppingCriteriaParameters(max_new_tokens=max_new_tokens)
+    return Request(id=id, inputs=inputs, parameters=parameters, stopping_parameters=stopping_parameters)
+
+
+def create_generator(model_path: str, batch_size: int = 2, continuous_batching: bool = True, **kwargs):
+    cpu_model_kwargs = {"batch_size": batch_size, "max_length": 128, "continuous_batching": continuous_batching}
+    return NeuronGenerator.from_pretrained(model_path, None, cpu_model_kwargs, **kwargs)
+
+
+def generate(generator: NeuronGenerator, batches: List[List[Request]]) -> Dict[int, List[int]]:
+    """Submit each list of requests in its own prefill, followed by a decode, as the router would.
+
+    Return:
+        The generated token ids of each request.
+    """
+    tokens = {}
+    cached_batch = None
+    for batch_id, requests in enumerate(batches + [[]] * 1000):
+        if len(requests) == 0 and cached_batch is None:
+            break
+        pending_batches = [] if cached_batch is None else [cached_batch]
+        if len(requests) > 0:
+            generations, batch = generator.prefill(Batch(id=batch_id, requests=requests))
+            for generation in generations:
+                tokens.setdefault(generation.request_id, []).append(generation.token_id)
+            if batch is not None:
+                pending_batches.append(batch)
+        if len(pending_batches) == 0:
+            continue
+        generations, cached_batch = generator.decode(pending_batches)
+        for generation in generations:
+            tokens.setdefault(generation.request_id, []).append(generation.token_id)
+    return tokens
+
+
+def greedy_reference(model_path: str, prompts: List[str], max_new_tokens: int) -> List[List[int]]:
+    """Generate each prompt alone with the transformers model."""
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    references = []
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        with torch.no_grad():
+            output_ids = model.generate(
+                input_ids, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id
+            )
+        references.append(output_ids[0, input_ids.shape[-1] :].tolist())
+    return references
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from generator_utils import PROMPTS, create_generator, greedy_reference
+from text_generation_server.batch import _create_request, generate_jsonl
+from transformers import AutoTokenizer
+
+
+def write_prompts(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def read_completions(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    path = tmp_path / "prompts.jsonl"
+    # The third prompt overrides the default maximum number of generated tokens
+    records = [{"inputs": prompt} for prompt in PROMPTS]
+    records[2]["parameters"] = {"max_new_tokens": 3}
+    write_prompts(path, records)
+    return path
+
+
+def test_generate_jsonl(model_path, input_path, tmp_path):
+    output_path = tmp_path / "completions.jsonl"
+    stats = generate_jsonl(create_generator(model_path), 2, input_path, output_path, max_new_tokens=6)
+    completions = {completion["index"]: completion for completion in read_completions(output_path)}
+    assert sorted(completions) == list(range(len(PROMPTS)))
+    assert stats["completions"] == len(PROMPTS)
+    assert stats["generated_tokens"] == sum(completion["generated_tokens"] for completion in completions.values())
+    assert completions[2]["generated_tokens"] == 3
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    for i, tokens in enumerate(greedy_reference(model_path, PROMPTS, 6)):
+        tokens = tokens[:3] if i == 2 else tokens
+        assert completions[i]["generated_text"] == tokenizer.decode(tokens)
+        assert completions[i]["generated_tokens"] == len(tokens)
+
+
+def test_generate_jsonl_resume(model_path, input_path, tmp_path):
+    output_path = tmp_path / "completions.jsonl"
+    generate_jsonl(create_generator(model_path), 2, input_path, output_path, max_new_tokens=6)
+    with open(output_path) as f:
+        lines = f.readlines()
+    # The previous run was interrupted while writing its third completion
+    with open(output_path, "w") as f:
+        f.write("".join(lines[:2]) + lines[2][: len(lines[2]) // 2])
+    with pytest.raises(ValueError, match="already exists"):
+        generate_jsonl(create_generator(model_path), 2, input_path, output_path)
+    stats = generate_jsonl(create_generator(model_path), 2, input_path, output_path, max_new_tokens=6, resume=True)
+    assert stats["completions"] == len(PROMPTS) - 2
+    completions = read_completions(output_path)
+    assert sorted(completion["index"] for completion in completions) == list(range(len(PROMPTS)))
+    # The completions of the previous run are kept, and the missing ones are identical to an uninterrupted run
+    assert completions[:2] == [json.loads(line) for line in lines[:2]]
+    expected = {completion["index"]: completion for completion in map(json.loads, lines)}
+    assert all(completion == expected[completion["index"]] for completion in completions)
+
+
+@pytest.mark.parametrize(
+    "record, message",
+    [
+        (["hello"], "expecting a JSON object"),
+        ({"prompt": "hello"}, "expecting a JSON object"),
+        ({"inputs": 3}, "expecting a JSON object"),
+        (
+            {"inputs": "hello", "parameters": {"best_of": 2, "stop": ["."]}},
+            r"unsupported generation parameters \['best_of', 'stop'\]",
+        ),
+    ],
+)
+def test_create_request_invalid(record, message):
+    with pytest.raises(ValueError, match=f"Line 7: {message}"):
+        _create_request(7, record, 20)
+
+
+def test_create_request_seed():
+    request = _create_request(0, {"inputs": "hello", "parameters": {"max_new_tokens": 5, "truncate": 10}}, 20)
+    assert request.stopping_parameters.max_new_tokens == 5
+    assert request.truncate == 10
+    assert not request.parameters.do_sample
+    assert request.parameters.seed == 0
+    # Each sampled request gets its own seed, unless it is specified
+    sampled = {"inputs": "hello", "parameters": {"do_sample": True}}
+    seeds = {_create_request(i, sampled, 20).parameters.seed for i in range(4)}
+    assert len(seeds) == 4
+    seeded = {"inputs": "hello", "parameters": {"do_sample": True, "seed": 42}}
+    assert _create_request(0, seeded, 20).parameters.seed == 42
@@ -0,0 +1,65 @@
+import pytest
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+from text_generation_server.pb.generate_pb2 import Batch
+
+
+@pytest.mark.parametrize("prefill_chunk_size", [1, 5, 64])
+def test_chunked_prefill_outputs(model_path, prefill_chunk_size):
+    generator = create_generator(model_path, batch_size=2, prefill_chunk_size=prefill_chunk_size)
+    max_new_tokens = 6
+    requests = [create_request(i, prompt, max_new_tokens=max_new_tokens) for i, prompt in enumerate(PROMPTS)]
+    tokens = generate(generator, [requests[:3], requests[3:4], requests[4:]])
+    assert [tokens[i] for i in range(len(PROMPTS))] == greedy_reference(model_path, PROMPTS, max_new_tokens)
+
+
+def test_chunked_prefill_with_prefix_cache(model_path):
+    generator = create_generator(model_path, batch_size=2, prefill_chunk_size=3, prefix_cache=True)
+    max_new_tokens = 6
+    prompts = PROMPTS + [prompt + " the quick brown fox" for prompt in PROMPTS]
+    requests = [create_request(i, prompt, max_new_tokens=max_new_tokens) for i, prompt in enumerate(prompts)]
+    tokens = generate(generator, [[request] for request in requests])
+    assert generator.prefix_cache.hits > 0
+    assert [tokens[i] for i in range(len(prompts))] == greedy_reference(model_path, prompts, max_new_tokens)
+
+
+def test_chunked_prefill_interleaving(model_path):
+    prefill_chunk_size = 4
+    generator = create_generator(model_path, batch_size=2, prefill_chunk_size=prefill_chunk_size)
+    # Record the number of prompt tokens encoded by each prefill forward
+    chunks = []
+    prepare_inputs_for_prefill = generator.model.prepare_inputs_for_prefill
+
+    def record_chunks(input_ids, attention_mask, *args, **kwargs):
+        chunks.append(int(attention_mask.sum()))
+        return prepare_inputs_for_prefill(input_ids, attention_mask, *args, **kwargs)
+
+    generator.model.prepare_inputs_for_prefill = record_chunks
+    short_request = create_request(0, "hello", max_new_tokens=20)
+    generations, short_batch = generator.prefill(Batch(id=0, requests=[short_request]))
+    assert [generation.request_id for generation in generations] == [0]
+    long_prompt = PROMPTS[-1]
+    long_request = create_request(1, long_prompt, max_new_tokens=20)
+    prompt_length = len(generator.tokenizer(long_prompt).input_ids)
+    # The first chunk of the long prompt is encoded, but no token is generated for it yet
+    generations, long_batch = generator.prefill(Batch(id=1, requests=[long_request]))
+    assert generations == []
+    assert long_batch.request_ids == [1]
+    # The short request keeps generating a token at each decode, while the next chunks of the long prompt are encoded
+    num_chunks = (prompt_length + prefill_chunk_size - 1) // prefill_chunk_size
+    batches = [short_batch, long_batch]
+    for _ in range(num_chunks - 2):
+        generations, cached_batch = generator.decode(batches)
+        assert [generation.request_id for generation in generations] == [0]
+        batches = [cached_batch]
+    # The first token of the long request is generated with the last chunk of its prompt
+    generations, cached_batch = generator.decode(batches)
+    assert sorted(generation.request_id for generation in generations) == [0, 1, 1]
+    # Each chunk is within the budget, and each prompt is encoded exactly once
+    assert chunks[0] == len(generator.tokenizer(short_request.inputs).input_ids)
+    assert all(chunk <= prefill_chunk_size for chunk in chunks[1:])
+    assert sum(chunks[1:]) == prompt_length
+
+
+def test_invalid_prefill_chunk_size(model_path):
+    with pytest.raises(ValueError, match="chunk size"):
+        create_generator(model_path, prefill_chunk_size=0)
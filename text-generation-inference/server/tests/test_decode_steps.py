@@ -0,0 +1,33 @@
+from collections import Counter
+
+import pytest
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+from text_generation_server.pb.generate_pb2 import Batch
+
+
+@pytest.mark.parametrize("continuous_batching", [True, False])
+@pytest.mark.parametrize("decode_steps", [2, 4])
+def test_decode_steps_outputs(model_path, continuous_batching, decode_steps):
+    generator = create_generator(
+        model_path, batch_size=2, continuous_batching=continuous_batching, decode_steps=decode_steps
+    )
+    # The requests finish at different steps, and the queued requests are prefilled in between
+    max_new_tokens = [3, 7, 5, 6]
+    requests = [create_request(i, PROMPTS[i], max_new_tokens=max_new_tokens[i]) for i in range(len(max_new_tokens))]
+    tokens = generate(generator, [requests])
+    for i, reference in enumerate(greedy_reference(model_path, PROMPTS[: len(requests)], max(max_new_tokens))):
+        assert tokens[i] == reference[: max_new_tokens[i]]
+
+
+def test_decode_steps_stop_on_finished_request(model_path):
+    generator = create_generator(model_path, batch_size=2, decode_steps=4)
+    requests = [create_request(0, PROMPTS[0], max_new_tokens=3), create_request(1, PROMPTS[1], max_new_tokens=7)]
+    generations, batch = generator.prefill(Batch(id=0, requests=requests))
+    # The first request finishes after the second step: the call returns without performing the other steps
+    generations, batch = generator.decode([batch])
+    assert Counter(generation.request_id for generation in generations) == {0: 2, 1: 2}
+    assert generations[-1].generated_text is not None
+    # The remaining request performs all the steps
+    generations, batch = generator.decode([batch])
+    assert Counter(generation.request_id for generation in generations) == {1: 4}
+    assert batch is None
@@ -0,0 +1,42 @@
+import pytest
+import torch
+from text_generation_server.detokenizer import IncrementalDetokenizer
+
+
+TEXTS = ["the quick brown fox jumps over the lazy dog", "hello world, how are you?", "été à Paris 🙂 日本語"]
+
+
+def stream(detokenizer, token_ids, prompt_length):
+    detokenizer.reset(token_ids[:prompt_length])
+    return [detokenizer.decode(token_ids[: i + 1]) for i in range(prompt_length, len(token_ids))]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("prompt_length", [0, 1, 3])
+def test_incremental_decode(tokenizer, text, prompt_length):
+    token_ids = tokenizer(text).input_ids
+    texts = stream(IncrementalDetokenizer(tokenizer, max_prefix_tokens=4), token_ids, prompt_length)
+    assert "".join(texts) == tokenizer.decode(token_ids[prompt_length:])
+
+
+def test_incomplete_characters(tokenizer):
+    # Each emoji byte is a separate token: the text is only emitted with the last byte
+    token_ids = tokenizer.convert_tokens_to_ids(list("ðŁĻĤ"))
+    assert tokenizer.decode(token_ids) == "🙂"
+    assert stream(IncrementalDetokenizer(tokenizer), token_ids, 0) == ["", "", "", "🙂"]
+
+
+def test_random_tokens(tokenizer):
+    torch.manual_seed(0)
+    for max_prefix_tokens in [1, 2, 8]:
+        detokenizer = IncrementalDetokenizer(tokenizer, max_prefix_tokens=max_prefix_tokens)
+        for _ in range(20):
+            token_ids = torch.randint(1, len(tokenizer), [40]).tolist()
+            texts = stream(detokenizer, token_ids, 10)
+            # The emitted texts never contain incomplete characters
+            assert not any(text.endswith("�") for text in texts[:-1] if text)
+            text = "".join(texts)
+            full_text = tokenizer.decode(token_ids)
+            # The emitted text is the text of the sequence after its prompt, except for a trailing incomplete
+            # character that has not been emitted yet
+            assert full_text.endswith(text) or full_text.rstrip("�").endswith(text)
@@ -0,0 +1,71 @@
+from generator_utils import PROMPTS, create_generator, create_request
+from text_generation_server.generator import (
+    ACTIVE_SLOTS,
+    FORWARD_DURATION,
+    GENERATED_TOKENS,
+    PREPARE_INPUTS_DURATION,
+)
+from text_generation_server.metrics import MetricsRegistry
+from text_generation_server.pb.generate_pb2 import Batch
+
+
+def test_histogram_samples():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("duration_seconds", "A duration.", {"phase": "prefill"}, buckets=(0.1, 1.0))
+    # A value equal to a bound is counted in its bucket
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value)
+    assert histogram.samples() == [
+        'duration_seconds_bucket{phase="prefill",le="0.1"} 2',
+        'duration_seconds_bucket{phase="prefill",le="1.0"} 3',
+        'duration_seconds_bucket{phase="prefill",le="+Inf"} 4',
+        'duration_seconds_sum{phase="prefill"} 2.65',
+        'duration_seconds_count{phase="prefill"} 4',
+    ]
+
+
+def test_registry_expose():
+    registry = MetricsRegistry()
+    counter = registry.counter("tokens_total", "Number of tokens.")
+    # The same series is returned for the same name and labels, whatever their order
+    gauge = registry.gauge("slots", "Number of slots.", {"state": "active", "model": "a"})
+    assert registry.gauge("slots", "Number of slots.", {"model": "a", "state": "active"}) is gauge
+    registry.gauge("slots", "Number of slots.", {"state": "empty", "model": "a"}).set(3)
+    counter.inc()
+    counter.inc(2)
+    gauge.set(1)
+    # The help and type of a metric are only written once for all its series
+    assert registry.expose() == "\n".join(
+        [
+            "# HELP slots Number of slots.",
+            "# TYPE slots gauge",
+            'slots{state="active",model="a"} 1',
+            'slots{state="empty",model="a"} 3',
+            "# HELP tokens_total Number of tokens.",
+            "# TYPE tokens_total counter",
+            "tokens_total 3",
+            "",
+        ]
+    )
+
+
+def test_generator_metrics(model_path):
+    generator = create_generator(model_path, batch_size=2)
+    prefills = FORWARD_DURATION["prefill"].count
+    decodes = FORWARD_DURATION["decode"].count
+    prepared_decodes = PREPARE_INPUTS_DURATION["decode"].count
+    generated_tokens = GENERATED_TOKENS.value
+    max_new_tokens = 5
+    requests = [create_request(i, prompt, max_new_tokens=max_new_tokens) for i, prompt in enumerate(PROMPTS[:2])]
+    generations, batch = generator.prefill(Batch(id=0, requests=requests))
+    assert FORWARD_DURATION["prefill"].count == prefills + 1
+    assert FORWARD_DURATION["decode"].count == decodes
+    assert ACTIVE_SLOTS.value == 2
+    # A decode for each of the remaining tokens of both requests
+    for _ in range(max_new_tokens - 1):
+        generations, batch = generator.decode([batch])
+    assert batch is None
+    assert FORWARD_DURATION["decode"].count == decodes + max_new_tokens - 1
+    assert PREPARE_INPUTS_DURATION["decode"].count == prepared_decodes + max_new_tokens - 1
+    assert GENERATED_TOKENS.value == generated_tokens + 2 * max_new_tokens
+    assert ACTIVE_SLOTS.value == 0
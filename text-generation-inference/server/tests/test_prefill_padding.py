@@ -0,0 +1,52 @@
+import pytest
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+
+
+def record_prefills(generator):
+    """Record the request ids and the padding fraction of each prefill forward."""
+    prefills = []
+    prepare_inputs_for_prefill = generator.model.prepare_inputs_for_prefill
+
+    def record(input_ids, attention_mask, seq_ids, *args, **kwargs):
+        request_ids = [generator.slots[seq_id].request_id for seq_id in seq_ids.tolist()]
+        prefills.append((request_ids, 1 - float(attention_mask.sum()) / attention_mask.numel()))
+        return prepare_inputs_for_prefill(input_ids, attention_mask, seq_ids, *args, **kwargs)
+
+    generator.model.prepare_inputs_for_prefill = record
+    return prefills
+
+
+@pytest.mark.parametrize(
+    "max_prefill_padding, expected_groups",
+    [
+        # The prompts have 10, 19, 23, 6, 3 and 34 tokens
+        (1.0, [[4, 3, 0, 1, 2, 5]]),
+        (0.3, [[4, 3], [0, 1, 2], [5]]),
+        (0.0, [[4], [3], [0], [1], [2], [5]]),
+    ],
+)
+def test_prefill_groups(model_path, max_prefill_padding, expected_groups):
+    generator = create_generator(model_path, batch_size=len(PROMPTS), max_prefill_padding=max_prefill_padding)
+    prefills = record_prefills(generator)
+    max_new_tokens = 5
+    requests = [create_request(i, prompt, max_new_tokens=max_new_tokens) for i, prompt in enumerate(PROMPTS)]
+    tokens = generate(generator, [requests])
+    # The new requests are sorted by length and prefilled in groups within the padding budget
+    assert [request_ids for request_ids, _ in prefills] == expected_groups
+    assert all(padding <= max_prefill_padding for _, padding in prefills)
+    # Each request gets the same tokens as if it was generated alone
+    assert [tokens[i] for i in range(len(PROMPTS))] == greedy_reference(model_path, PROMPTS, max_new_tokens)
+
+
+def test_group_by_length(model_path):
+    generator = create_generator(model_path, max_prefill_padding=0.3)
+    assert generator._group_by_length([5, 1, 4, 1]) == [[1, 3], [2, 0]]
+    assert generator._group_by_length([7]) == [[0]]
+    generator.max_prefill_padding = 0.5
+    assert generator._group_by_length([5, 1, 4, 1]) == [[1, 3, 2, 0]]
+
+
+@pytest.mark.parametrize("max_prefill_padding", [-0.1, 1.5])
+def test_invalid_max_prefill_padding(model_path, max_prefill_padding):
+    with pytest.raises(ValueError, match="prefill padding"):
+        create_generator(model_path, max_prefill_padding=max_prefill_padding)
@@ -0,0 +1,104 @@
+import random
+
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+from text_generation_server.prefix_cache import PrefixCache
+
+
+def common_prefix_length(a, b):
+    length = 0
+    while length < min(len(a), len(b)) and a[length] == b[length]:
+        length += 1
+    return length
+
+
+def test_match():
+    cache = PrefixCache()
+    assert cache.match([1, 2, 3]) == (0, None)
+    cache.insert(0, [1, 2, 3, 4])
+    cache.insert(1, [1, 2, 5])
+    # The edge [1, 2, 3, 4] is split at [1, 2]
+    assert cache.match([1, 2, 3, 4, 5]) == (4, 0)
+    assert cache.match([1, 2, 5, 6]) == (3, 1)
+    assert cache.match([1, 2, 3, 7]) == (3, 0)
+    assert cache.match([9]) == (0, None)
+    # Among the rows sharing the longest prefix, the most recently released is selected
+    assert cache.match([1, 2, 7]) == (2, 1)
+    cache.insert(0, [1, 2, 3, 4])
+    assert cache.match([1, 2, 7]) == (2, 0)
+
+
+def test_remove():
+    cache = PrefixCache()
+    cache.insert(0, [1, 2, 3])
+    cache.insert(1, [1, 2, 4])
+    cache.remove(0)
+    assert len(cache) == 1
+    assert cache.match([1, 2, 3]) == (2, 1)
+    cache.remove(1)
+    assert len(cache) == 0
+    assert cache.match([1, 2, 3]) == (0, None)
+    # Removing a row that is not cached is a no-op
+    cache.remove(1)
+    # Inserting a row replaces its previous tokens
+    cache.insert(2, [5, 6])
+    cache.insert(2, [7, 8])
+    assert cache.match([5, 6]) == (0, None)
+    assert cache.match([7, 8]) == (2, 2)
+
+
+def test_acquire():
+    cache = PrefixCache()
+    cache.insert(0, [1, 2, 3])
+    cache.insert(1, [4, 5, 6])
+    # The row sharing a prefix is selected and removed from the cache
+    assert cache.acquire([1, 2, 7], [0, 1, 2]) == (0, 2)
+    assert len(cache) == 1
+    # At least the last token of the sequence must be encoded
+    cache.insert(0, [1, 2, 3])
+    assert cache.acquire([1, 2, 3], [0, 1, 2]) == (0, 2)
+    # Without a matching row, rows that are not cached are preferred
+    cache.insert(0, [1, 2, 3])
+    assert cache.acquire([7, 8], [0, 1, 2]) == (2, 0)
+    # Then the least recently released row is evicted
+    assert cache.acquire([7, 8], [0, 1]) == (1, 0)
+    assert len(cache) == 1
+    # A matching row that is not free is ignored
+    assert cache.acquire([1, 2, 3], [3]) == (3, 0)
+    assert cache.lookups == 5
+    assert cache.hits == 2
+    assert cache.saved_tokens == 4
+    assert cache.hit_rate == 2 / 5
+
+
+def test_random_operations():
+    random.seed(0)
+    cache = PrefixCache()
+    rows = {}
+    for _ in range(2000):
+        row_id = random.randrange(8)
+        if random.random() < 0.2:
+            cache.remove(row_id)
+            rows.pop(row_id, None)
+        else:
+            rows[row_id] = [random.randrange(3) for _ in range(random.randint(0, 6))]
+            cache.insert(row_id, rows[row_id])
+        assert len(cache) == len(rows)
+        token_ids = [random.randrange(3) for _ in range(random.randint(1, 6))]
+        length, row_id = cache.match(token_ids)
+        expected_length = max([common_prefix_length(tokens, token_ids) for tokens in rows.values()], default=0)
+        assert length == expected_length
+        if length > 0:
+            assert common_prefix_length(rows[row_id], token_ids) == length
+        else:
+            assert row_id is None
+
+
+def test_generate_with_prefix_cache(model_path):
+    generator = create_generator(model_path, batch_size=2, prefix_cache=True)
+    max_new_tokens = 6
+    # The prompts share prefixes with the prompts of previous requests
+    prompts = PROMPTS + [prompt + " the quick brown fox" for prompt in PROMPTS]
+    requests = [create_request(i, prompt, max_new_tokens=max_new_tokens) for i, prompt in enumerate(prompts)]
+    tokens = generate(generator, [[request] for request in requests])
+    assert generator.prefix_cache.hits > 0
+    assert [tokens[i] for i in range(len(prompts))] == greedy_reference(model_path, prompts, max_new_tokens)
@@ -0,0 +1,43 @@
+import pytest
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+from text_generation_server.pb.generate_pb2 import Batch
+
+
+@pytest.mark.parametrize("continuous_batching", [True, False])
+def test_queued_requests(model_path, continuous_batching):
+    generator = create_generator(model_path, batch_size=2, continuous_batching=continuous_batching)
+    requests = [create_request(i, prompt, max_new_tokens=5 + i) for i, prompt in enumerate(PROMPTS)]
+    # Only two requests fit in the batch: the others are queued but still listed in the cached batch
+    generations, batch = generator.prefill(Batch(id=0, requests=requests[:4]))
+    assert sorted(generation.request_id for generation in generations) == [0, 1]
+    assert [request.id for request in generator.queue] == [2, 3]
+    assert list(batch.request_ids) == [0, 1, 2, 3]
+    # New requests are queued behind the queued requests, even if they do not fit in the batch
+    generations, _ = generator.prefill(Batch(id=1, requests=requests[4:]))
+    assert len(generations) == 0
+    assert [request.id for request in generator.queue] == [2, 3, 4, 5]
+    generator.clear()
+    assert len(generator.queue) == 0
+
+
+@pytest.mark.parametrize("continuous_batching", [True, False])
+def test_queued_requests_outputs(model_path, continuous_batching):
+    generator = create_generator(model_path, batch_size=2, continuous_batching=continuous_batching)
+    max_new_tokens = 8
+    requests = [create_request(i, prompt, max_new_tokens=max_new_tokens) for i, prompt in enumerate(PROMPTS)]
+    # The queued requests are prefilled during decode as soon as slots are released
+    tokens = generate(generator, [requests[:3], requests[3:]])
+    references = greedy_reference(model_path, PROMPTS, max_new_tokens)
+    assert [tokens[i] for i in range(len(PROMPTS))] == references
+    assert len(generator.queue) == 0
+
+
+def test_filter_queued_requests(model_path):
+    generator = create_generator(model_path, batch_size=1)
+    requests = [create_request(i, prompt) for i, prompt in enumerate(PROMPTS[:3])]
+    generator.prefill(Batch(id=0, requests=requests))
+    assert [request.id for request in generator.queue] == [1, 2]
+    # Cancelled requests are removed from the queue
+    batch = generator.filter(0, [0, 2])
+    assert list(batch.request_ids) == [0, 2]
+    assert [request.id for request in generator.queue] == [2]
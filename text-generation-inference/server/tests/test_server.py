@@ -0,0 +1,122 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+from text_generation_server.server import TextGenerationService, _run_replicas, _visible_cores
+
+
+def write_rank(path, rank: int, text: str):
+    """Write the file of a replica atomically, so that it is complete as soon as it is listed."""
+    tmp_path = path.parent / f"{path.name}-{rank}.tmp"
+    tmp_path.write_text(text)
+    tmp_path.replace(path / str(rank))
+
+
+@pytest.mark.parametrize(
+    "rank, cores_per_replica, visible_cores", [(0, 2, "0-1"), (1, 2, "2-3"), (3, 1, "3-3"), (2, 8, "16-23")]
+)
+def test_visible_cores(rank, cores_per_replica, visible_cores):
+    assert _visible_cores(rank, cores_per_replica) == visible_cores
+
+
+def test_run_replicas(tmp_path, monkeypatch):
+    # The variable set by the user is overridden in each replica
+    monkeypatch.setenv("NEURON_RT_VISIBLE_CORES", "0-7")
+    replicas = 3
+
+    def serve_replica(rank: int):
+        write_rank(tmp_path, rank, f"{os.getpid()} {os.environ['NEURON_RT_VISIBLE_CORES']}")
+        if rank > 0:
+            # The other replicas serve until they are terminated
+            time.sleep(60)
+        while len(list(tmp_path.iterdir())) < replicas:
+            time.sleep(0.01)
+
+    start = time.monotonic()
+    _run_replicas(serve_replica, replicas, cores_per_replica=2)
+    # When the first replica terminates, the other ones are terminated too
+    assert time.monotonic() - start < 30
+    pids, visible_cores = zip(*[(tmp_path / str(rank)).read_text().split() for rank in range(replicas)])
+    # Each replica runs in its own process, bound to its own cores
+    assert len(set(pids) | {str(os.getpid())}) == replicas + 1
+    assert visible_cores == ("0-1", "2-3", "4-5")
+    assert os.environ["NEURON_RT_VISIBLE_CORES"] == "0-7"
+
+
+def test_run_replicas_without_cores(tmp_path, monkeypatch):
+    monkeypatch.delenv("NEURON_RT_VISIBLE_CORES", raising=False)
+
+    def serve_replica(rank: int):
+        write_rank(tmp_path, rank, os.environ.get("NEURON_RT_VISIBLE_CORES", "none"))
+        # Terminating a replica terminates the other ones: wait until they are all started
+        while len(list(tmp_path.iterdir())) < 2:
+            time.sleep(0.01)
+
+    _run_replicas(serve_replica, 2, cores_per_replica=None)
+    assert [(tmp_path / str(rank)).read_text() for rank in range(2)] == ["none", "none"]
+
+
+def test_run_replicas_failure():
+    def serve_replica(rank: int):
+        if rank == 1:
+            raise RuntimeError("Unable to load the model")
+        time.sleep(60)
+
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="replica-1 failed"):
+        _run_replicas(serve_replica, 2, cores_per_replica=1)
+    assert time.monotonic() - start < 30
+
+
+def test_service_run_order():
+    service = TextGenerationService(generator=None, server_urls=[])
+    calls = []
+
+    def call(i: int):
+        # The calls submitted first would finish last if they were run concurrently
+        time.sleep(0.01 * (10 - i))
+        calls.append((i, threading.current_thread().name))
+        return i
+
+    async def submit():
+        return await asyncio.gather(*[service._run(call, i) for i in range(10)])
+
+    assert asyncio.run(submit()) == list(range(10))
+    # The calls are executed one at a time in the order they were received, in the same dedicated thread
+    assert [i for i, _ in calls] == list(range(10))
+    assert len({name for _, name in calls}) == 1
+    assert calls[0][1] != threading.current_thread().name
+    service.executor.shutdown()
+
+
+def test_service_run_does_not_block_event_loop():
+    service = TextGenerationService(generator=None, server_urls=[])
+    released = threading.Event()
+
+    async def submit():
+        # The blocking call is only released by a coroutine, that could not run if the event loop was blocked
+        blocking_call = asyncio.ensure_future(service._run(released.wait, 5))
+        await asyncio.sleep(0.05)
+        released.set()
+        return await blocking_call
+
+    assert asyncio.run(submit())
+    service.executor.shutdown()
+
+
+def test_service_run_exception():
+    service = TextGenerationService(generator=None, server_urls=[])
+
+    def fail():
+        raise ValueError("Unable to decode tokens")
+
+    async def submit():
+        with pytest.raises(ValueError, match="Unable to decode"):
+            await service._run(fail)
+        # The model thread keeps serving the next calls
+        return await service._run(sum, [1, 2])
+
+    assert asyncio.run(submit()) == 3
+    service.executor.shutdown()
@@ -0,0 +1,75 @@
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+from text_generation_server.pb.generate_pb2 import Batch
+
+
+def record_calls(generator):
+    """Record the number of rows of each prefill forward and the request ids of the KV cache rows copies."""
+    prefills = []
+    copies = []
+    prepare_inputs_for_prefill = generator.model.prepare_inputs_for_prefill
+    copy_kv_cache = generator.model.copy_kv_cache
+
+    def record_prefill(input_ids, *args, **kwargs):
+        prefills.append(input_ids.shape[0])
+        return prepare_inputs_for_prefill(input_ids, *args, **kwargs)
+
+    def record_copy(seq_id, target_seq_ids, length):
+        request_ids = [generator.slots[target].request_id for target in target_seq_ids.tolist()]
+        copies.append((generator.slots[seq_id].request_id, sorted(request_ids), length))
+        return copy_kv_cache(seq_id, target_seq_ids, length)
+
+    generator.model.prepare_inputs_for_prefill = record_prefill
+    generator.model.copy_kv_cache = record_copy
+    return prefills, copies
+
+
+def test_shared_prefill(model_path):
+    generator = create_generator(model_path, batch_size=4)
+    prefills, copies = record_calls(generator)
+    prompts = [PROMPTS[0], PROMPTS[1], PROMPTS[0], PROMPTS[0]]
+    max_new_tokens = [4, 6, 8, 3]
+    requests = [create_request(i, prompts[i], max_new_tokens=max_new_tokens[i]) for i in range(len(prompts))]
+    tokens = generate(generator, [requests])
+    # A single row is encoded for the identical prompts, and its KV cache row is copied to the other slots
+    assert prefills == [2]
+    prompt_length = len(generator.tokenizer(PROMPTS[0]).input_ids)
+    assert copies == [(0, [2, 3], prompt_length)]
+    # Each request is then decoded independently
+    references = greedy_reference(model_path, PROMPTS[:2], max(max_new_tokens))
+    for i in range(len(prompts)):
+        assert tokens[i] == references[PROMPTS.index(prompts[i])][: max_new_tokens[i]]
+
+
+def test_shared_prefill_cancellation(model_path):
+    generator = create_generator(model_path, batch_size=3)
+    prefills, copies = record_calls(generator)
+    tokens = {}
+
+    def collect(generations):
+        for generation in generations:
+            tokens.setdefault(generation.request_id, []).append(generation.token_id)
+
+    max_new_tokens = 8
+    requests = [create_request(i, PROMPTS[0], max_new_tokens=max_new_tokens) for i in range(3)]
+    generations, batch = generator.prefill(Batch(id=0, requests=requests))
+    collect(generations)
+    assert prefills == [1]
+    assert copies == [(0, [1, 2], len(generator.tokenizer(PROMPTS[0]).input_ids))]
+    # The request whose prompt was encoded is cancelled: the requests sharing its KV cache row are not affected
+    batch = generator.filter(batch.id, [1, 2])
+    for _ in range(2):
+        generations, batch = generator.decode([batch])
+        collect(generations)
+    # Another request is cancelled, and a new request with the same prompt reuses a released slot
+    batch = generator.filter(batch.id, [1])
+    generations, new_batch = generator.prefill(Batch(id=1, requests=[create_request(3, PROMPTS[0], 4)]))
+    collect(generations)
+    batches = [batch, new_batch]
+    while len(batches) > 0:
+        generations, batch = generator.decode(batches)
+        collect(generations)
+        batches = [] if batch is None else [batch]
+    reference = greedy_reference(model_path, PROMPTS[:1], max_new_tokens)[0]
+    assert tokens[1] == reference
+    assert tokens[3] == reference[:4]
+    assert len(tokens[0]) == 1 and len(tokens[2]) == 3
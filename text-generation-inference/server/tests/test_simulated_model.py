@@ -0,0 +1,61 @@
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+import pytest
+from text_generation_server.cpu_model import SimulatedModelForCausalLM
+from text_generation_server.generator import NeuronGenerator
+from transformers import AutoTokenizer
+
+
+BENCHMARK_PATH = Path(__file__).parents[2] / "benchmark" / "generator.py"
+
+
+@pytest.fixture(scope="module")
+def benchmark():
+    spec = importlib.util.spec_from_file_location("benchmark_generator", BENCHMARK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+TRACE = [
+    {"arrival": 0.0, "prompt_length": 12, "max_new_tokens": 5},
+    {"arrival": 0.0, "prompt_length": 4, "max_new_tokens": 3, "parameters": {"do_sample": True, "top_k": 50}},
+    {"arrival": 0.01, "prompt_length": 20, "max_new_tokens": 6},
+    {"arrival": 0.02, "prompt_length": 8, "max_new_tokens": 2},
+    {"arrival": 0.05, "prompt_length": 6, "max_new_tokens": 4},
+]
+
+
+@pytest.mark.parametrize("continuous_batching", [True, False])
+def test_replay_trace(model_path, benchmark, continuous_batching):
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = SimulatedModelForCausalLM.from_pretrained(
+        model_path, batch_size=2, max_length=64, continuous_batching=continuous_batching, forward_latency=0.001
+    )
+    generator = NeuronGenerator(model, tokenizer, decode_steps=2)
+    requests = [benchmark.create_request(i, record, tokenizer, 32) for i, record in enumerate(TRACE)]
+    token_times, calls, duration = benchmark.replay(generator, requests, [record["arrival"] for record in TRACE])
+    # The simulated model never generates the end of sequence token: each request gets all its tokens
+    assert [len(token_times[i]) for i in range(len(TRACE))] == [record["max_new_tokens"] for record in TRACE]
+    for i, record in enumerate(TRACE):
+        assert token_times[i][0] >= record["arrival"]
+        assert token_times[i] == sorted(token_times[i])
+    # The time spent in the model is part of the duration of each call
+    assert sum(n for _, _, n in calls) == sum(record["max_new_tokens"] for record in TRACE)
+    assert all(forward <= call for call, forward, _ in calls)
+    assert model.forward_time <= duration
+
+
+def test_benchmark_main(model_path, benchmark, tmp_path, monkeypatch, capsys):
+    trace_path = tmp_path / "trace.jsonl"
+    trace_path.write_text("".join(json.dumps(record) + "\n" for record in TRACE))
+    argv = ["generator.py", "--model-id", model_path, "--trace", str(trace_path), "--batch-size", "2"]
+    argv += ["--max-length", "64", "--forward-latency", "0.001", "--prefix-cache"]
+    monkeypatch.setattr(sys, "argv", argv)
+    benchmark.main()
+    output = capsys.readouterr().out
+    assert output.startswith(f"{len(TRACE)} requests, {sum(record['max_new_tokens'] for record in TRACE)} tokens")
+    assert "time to first token (ms)" in output
@@ -0,0 +1,46 @@
+import pytest
+from generator_utils import PROMPTS, create_generator, create_request, generate, greedy_reference
+from text_generation_server.generator import SPECULATION_ACCEPTED_TOKENS, SPECULATION_PROPOSED_TOKENS
+from text_generation_server.pb.generate_pb2 import Batch
+
+
+@pytest.mark.parametrize("speculation_length", [1, 4])
+@pytest.mark.parametrize("draft", ["model", "draft_model", "prompt_lookup"])
+def test_speculative_greedy_outputs(model_path, draft_model_path, draft, speculation_length):
+    kwargs = {"prompt_lookup": True} if draft == "prompt_lookup" else {"draft_model_id": model_path}
+    if draft == "draft_model":
+        kwargs["draft_model_id"] = draft_model_path
+    generator = create_generator(model_path, batch_size=2, speculation_length=speculation_length, **kwargs)
+    proposed, accepted = SPECULATION_PROPOSED_TOKENS.value, SPECULATION_ACCEPTED_TOKENS.value
+    # The numbers of new tokens are not multiples of the number of tokens generated by a speculative step
+    requests = [create_request(i, prompt, max_new_tokens=7 + i) for i, prompt in enumerate(PROMPTS)]
+    tokens = generate(generator, [requests[:3], requests[3:]])
+    for i, prompt in enumerate(PROMPTS):
+        assert tokens[i] == greedy_reference(model_path, [prompt], 7 + i)[0]
+    if draft == "model":
+        # The proposed tokens are generated by the model itself: they are all accepted
+        assert SPECULATION_ACCEPTED_TOKENS.value - accepted == SPECULATION_PROPOSED_TOKENS.value - proposed > 0
+
+
+def test_speculative_finish_in_accepted_tokens(model_path):
+    generator = create_generator(model_path, batch_size=2, draft_model_id=model_path, speculation_length=4)
+    # The proposed tokens are generated by the model itself: after the prefill, the first speculative step accepts
+    # all of them and generates the second to sixth tokens
+    prompt = "you"
+    reference = greedy_reference(model_path, [prompt], 20)[0]
+    # A request reaching its maximum number of tokens in the middle of the accepted tokens
+    generations, batch = generator.prefill(Batch(id=0, requests=[create_request(0, prompt, max_new_tokens=3)]))
+    generations, batch = generator.decode([batch])
+    assert [generation.token_id for generation in generations] == reference[1:3]
+    assert generations[-1].generated_text.generated_tokens == 3
+    assert batch is None
+    # A request generating the end of sequence token in the middle of the accepted tokens
+    eos_index = next(i for i, token in enumerate(reference) if token not in reference[:i] and i > 0)
+    assert eos_index < 5
+    generator.tokenizer.eos_token = generator.tokenizer.convert_ids_to_tokens(reference[eos_index])
+    generations, batch = generator.prefill(Batch(id=1, requests=[create_request(1, prompt, max_new_tokens=20)]))
+    generations, batch = generator.decode([batch])
+    # The tokens accepted after the end of sequence are discarded, and the slot is released
+    assert [generation.token_id for generation in generations] == reference[1 : eos_index + 1]
+    assert generations[-1].generated_text.generated_tokens == eos_index + 1
+    assert batch is None
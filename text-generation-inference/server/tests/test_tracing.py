@@ -0,0 +1,89 @@
+import json
+import time
+
+import pytest
+from generator_utils import PROMPTS, create_generator, create_request
+from text_generation_server import generator as generator_module
+from text_generation_server.pb.generate_pb2 import Batch
+from text_generation_server.tracing import RequestTracer
+
+
+def read_traces(path, count, timeout=10.0):
+    """Wait for the background thread to export the expected number of traces."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if path.exists():
+            lines = path.read_text().splitlines()
+            if len(lines) >= count:
+                return [json.loads(line) for line in lines]
+        time.sleep(0.01)
+    raise TimeoutError(f"{count} trace(s) were not exported in {path}.")
+
+
+def attributes(item):
+    return {attribute["key"]: list(attribute["value"].values())[0] for attribute in item["attributes"]}
+
+
+def test_request_traces(model_path, tmp_path, monkeypatch):
+    tracer = RequestTracer()
+    monkeypatch.setattr(generator_module, "TRACER", tracer)
+    path = tmp_path / "traces.jsonl"
+    tracer.start_export(path=str(path), sample_rate=1.0, **{"replica.rank": 0})
+    generator = create_generator(model_path, batch_size=2)
+    max_new_tokens = 4
+    generations, batch = generator.prefill(Batch(id=0, requests=[create_request(0, PROMPTS[0], max_new_tokens)]))
+    generations, batch = generator.decode([batch])
+    # The prefill of the second request pauses the generation of the first one
+    generations, new_batch = generator.prefill(Batch(id=1, requests=[create_request(1, PROMPTS[1], max_new_tokens)]))
+    batches = [batch, new_batch]
+    while len(batches) > 0:
+        generations, batch = generator.decode(batches)
+        batches = [] if batch is None else [batch]
+    traces = {}
+    for trace in read_traces(path, 2):
+        resource_spans = trace["resourceSpans"][0]
+        assert attributes(resource_spans["resource"]) == {
+            "service.name": "text-generation-server",
+            "replica.rank": "0",
+        }
+        spans = resource_spans["scopeSpans"][0]["spans"]
+        root = spans[0]
+        traces[int(attributes(root)["request.id"])] = spans
+        # The root span covers the whole lifetime of the request, the other spans are its children
+        assert root["name"] == "request"
+        assert "parentSpanId" not in root
+        for span in spans[1:]:
+            assert span["traceId"] == root["traceId"]
+            assert span["parentSpanId"] == root["spanId"]
+            assert int(root["startTimeUnixNano"]) <= int(span["startTimeUnixNano"]) <= int(span["endTimeUnixNano"])
+            assert int(span["endTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+        assert attributes(root)["generated_tokens"] == str(max_new_tokens)
+        # An event for each generated token
+        assert [event["name"] for event in root["events"]] == ["first_token"] + ["token"] * (max_new_tokens - 1)
+        assert "time_to_first_token_ms" in attributes(root)
+    assert sorted(traces) == [0, 1]
+    assert [span["name"] for span in traces[0]] == ["request", "queue", "prefill", "pause"]
+    assert [span["name"] for span in traces[1]] == ["request", "queue", "prefill"]
+    # The prefill spans record the composition of the prefilled batch
+    assert attributes(traces[0][2])["prefill.request_ids"] == {"values": [{"intValue": "0"}]}
+    assert attributes(traces[0][3])["prefill.request_ids"] == {"values": [{"intValue": "1"}]}
+    assert traces[0][3]["traceId"] != traces[1][2]["traceId"]
+
+
+def test_disabled_tracer():
+    tracer = RequestTracer()
+    assert not tracer.enabled
+    tracer.queued(0, max_new_tokens=4)
+    tracer.assigned(0, 0)
+    tracer.prefill([0], 0, 1)
+    tracer.token(0)
+    tracer.finished(0, "length")
+    assert len(tracer._traces) == 0
+
+
+@pytest.mark.parametrize(
+    "kwargs, message", [({}, "file or to a collector"), ({"path": "traces.jsonl", "sample_rate": 2}, "sample rate")]
+)
+def test_invalid_tracer_export(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        RequestTracer().start_export(**kwargs)
@@ -0,0 +1,178 @@
+"""Offline generation of the completions of a file of prompts, without the router.
+
+The prompts are read from a JSON lines file, each line being a JSON object with the same fields as the body of a
+`/generate` request (`{"inputs": "...", "parameters": {...}}`). They are streamed to a generator that keeps all its
+slots busy, and the completion of each prompt is appended to the output JSON lines file as soon as it is finished:
+
+```
+{"index": 12, "generated_text": "...", "generated_tokens": 20, "finish_reason": "length"}
+```
+
+where `index` is the line number of the prompt in the input file (starting at 0). As the completions are written in
+the order they finish, an interrupted run can be resumed by skipping the prompts whose completion is already written.
+"""
+import json
+import os
+import random
+import time
+from typing import Any, Dict, Iterator, Set
+
+from loguru import logger
+
+from .generator import FINISH_REASONS, Generator
+from .pb.generate_pb2 import (
+    Batch,
+    NextTokenChooserParameters,
+    Request,
+    StoppingCriteriaParameters,
+)
+
+
+# The default values of the generation parameters, as set by the router (except the seed of sampled requests, that
+# is drawn for each request)
+DEFAULT_PARAMETERS = {
+    "temperature": 1.0,
+    "top_k": 0,
+    "top_p": 1.0,
+    "typical_p": 1.0,
+    "do_sample": False,
+    "seed": 0,
+    "repetition_penalty": 1.0,
+}
+
+
+def _create_request(index: int, record: Dict[str, Any], max_new_tokens: int) -> Request:
+    """Convert a prompt record to a request identified by the index of its line."""
+    if not isinstance(record, dict) or not isinstance(record.get("inputs"), str):
+        raise ValueError(f"Line {index}: expecting a JSON object with a string 'inputs' field.")
+    parameters = dict(record.get("parameters") or {})
+    max_new_tokens = parameters.pop("max_new_tokens", None) or max_new_tokens
+    truncate = parameters.pop("truncate", None) or 0
+    unsupported = set(parameters) - set(DEFAULT_PARAMETERS)
+    if len(unsupported) > 0:
+        raise ValueError(f"Line {index}: unsupported generation parameters {sorted(unsupported)}.")
+    if parameters.get("do_sample") and parameters.get("seed") is None:
+        # Otherwise all sampled prompts would share the same random sequence
+        parameters["seed"] = random.randint(0, 2**64 - 1)
+    parameters = {
+        name: default if parameters.get(name) is None else parameters[name]
+        for name, default in DEFAULT_PARAMETERS.items()
+    }
+    return Request(
+        id=index,
+        inputs=record["inputs"],
+        truncate=truncate,
+        parameters=NextTokenChooserParameters(**parameters),
+        stopping_parameters=StoppingCriteriaParameters(max_new_tokens=max_new_tokens),
+    )
+
+
+def _read_requests(input_path: str, skip: Set[int], max_new_tokens: int) -> Iterator[Request]:
+    with open(input_path) as f:
+        for index, line in enumerate(f):
+            if index in skip or len(line.strip()) == 0:
+                continue
+            yield _create_request(index, json.loads(line), max_new_tokens)
+
+
+def _completed_indices(output_path: str) -> Set[int]:
+    """Return the indices of the prompts whose completion is already written in an output file.
+
+    A truncated last line (e.g. if the previous run was killed while writing it) is removed from the file.
+    """
+    completed = set()
+    with open(output_path, "rb+") as f:
+        length = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            completed.add(json.loads(line)["index"])
+            length += len(line)
+        f.truncate(length)
+    return completed
+
+
+def generate_jsonl(
+    generator: Generator,
+    batch_size: int,
+    input_path: str,
+    output_path: str,
+    max_new_tokens: int = 20,
+    resume: bool = False,
+) -> Dict[str, float]:
+    """Generate the completions of all the prompts of a JSON lines file.
+
+    Args:
+        generator (`Generator`):
+            The generator producing the completions.
+        batch_size (`int`):
+            The number of requests the generator can process concurrently: new prompts are submitted as soon as
+            requests finish, so that this number of requests is always being generated.
+        input_path (`str`):
+            The path of the JSON lines file containing the prompts.
+        output_path (`str`):
+            The path of the JSON lines file where the completions are appended.
+        max_new_tokens (`int`, defaults to 20):
+            The maximum number of generated tokens of the prompts that do not specify it in their parameters.
+        resume (`bool`, defaults to `False`):
+            Whether the completions of a previous run should be kept, only generating the missing ones.
+            Otherwise the output file must not exist.
+
+    Return:
+        A dictionary of statistics of the run: the number of completions, of generated tokens, the duration
+        and the throughput in tokens per second.
+    """
+    skip = set()
+    if os.path.exists(output_path):
+        if not resume:
+            raise ValueError(f"{output_path} already exists: remove it or resume the previous run.")
+        skip = _completed_indices(output_path)
+        logger.info(f"Resuming generation: skipping {len(skip)} completed prompt(s)")
+    requests = _read_requests(input_path, skip, max_new_tokens)
+    completions = 0
+    generated_tokens = 0
+    pending = 0
+    batch_id = 0
+    cached_batch = None
+    start = time.perf_counter()
+    with open(output_path, "a") as output:
+        while True:
+            # Top up the generator with new requests as soon as slots are available
+            new_requests = [request for _, request in zip(range(batch_size - pending), requests)]
+            if len(new_requests) > 0:
+                batch_id += 1
+                pending += len(new_requests)
+                generations, prefill_batch = generator.prefill(Batch(id=batch_id, requests=new_requests))
+                # The generator merges all pending requests in a single batch: any batch id can be used to decode
+                cached_batch = prefill_batch or cached_batch
+            elif pending > 0:
+                generations, cached_batch = generator.decode([cached_batch])
+            else:
+                break
+            for generation in generations:
+                generated_tokens += 1
+                generated_text = generation.generated_text
+                if generated_text is None:
+                    continue
+                completion = {
+                    "index": generation.request_id,
+                    "generated_text": generated_text.text,
+                    "generated_tokens": generated_text.generated_tokens,
+                    "finish_reason": FINISH_REASONS[generated_text.finish_reason],
+                }
+                output.write(json.dumps(completion) + "\n")
+                completions += 1
+                pending -= 1
+            output.flush()
+    duration = time.perf_counter() - start
+    stats = {
+        "completions": completions,
+        "generated_tokens": generated_tokens,
+        "duration": duration,
+        "tokens_per_second": generated_tokens / duration if duration > 0 else 0.0,
+    }
+    logger.info(
+        f"Generated {generated_tokens} token(s) for {completions} prompt(s) in {duration:.1f} s"
+        f" ({stats['tokens_per_second']:.1f} tokens/s)"
+    )
+    return stats
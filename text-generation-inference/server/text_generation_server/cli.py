@@ -1,3 +1,4 @@
+import os
 import sys
 from typing import Optional
 
@@ -8,6 +9,35 @@ from loguru import logger
 app = typer.Typer()
 
 
+def _check_generator_parameters(
+    decode_steps: int,
+    speculation_length: int,
+    prefill_chunk_size: Optional[int],
+    max_prefill_padding: float,
+    regex: Optional[str],
+    json_schema: Optional[str],
+) -> Optional[str]:
+    """Check the generator parameters shared by the `serve` and `batch` commands.
+
+    Return:
+        The JSON schema, read from its file if `json_schema` is a path.
+    """
+    if decode_steps < 1:
+        raise ValueError("The number of decode steps must be at least 1.")
+    if speculation_length < 1:
+        raise ValueError("The speculation length must be at least 1.")
+    if prefill_chunk_size is not None and prefill_chunk_size < 1:
+        raise ValueError("The prefill chunk size must be at least 1.")
+    if max_prefill_padding < 0 or max_prefill_padding > 1:
+        raise ValueError("The maximum prefill padding must be a fraction between 0 and 1.")
+    if regex is not None and json_schema is not None:
+        raise ValueError("The generated text can be constrained either by a regex or by a JSON schema, not both.")
+    if json_schema is not None and os.path.isfile(json_schema):
+        with open(json_schema) as f:
+            json_schema = f.read()
+    return json_schema
+
+
 @app.command()
 def serve(
     model_id: str,
@@ -17,6 +47,26 @@ def serve(
     uds_path: str = "/tmp/text-generation-server",
     logger_level: str = "INFO",
     json_output: bool = False,
+    replicas: int = 1,
+    cores_per_replica: Optional[int] = None,
+    cpu: bool = False,
+    cpu_batch_size: int = 4,
+    cpu_max_length: int = 256,
+    cpu_continuous_batching: bool = True,
+    decode_steps: int = 1,
+    metrics_port: Optional[int] = None,
+    metrics_file: Optional[str] = None,
+    prefix_cache: bool = False,
+    draft_model_id: Optional[str] = None,
+    speculation_length: int = 4,
+    prompt_lookup: bool = False,
+    prefill_chunk_size: Optional[int] = None,
+    max_prefill_padding: float = 1.0,
+    regex: Optional[str] = None,
+    json_schema: Optional[str] = None,
+    trace_file: Optional[str] = None,
+    trace_endpoint: Optional[str] = None,
+    trace_sample_rate: float = 0.1,
 ):
     """This is the main entry-point for the server CLI.
 
@@ -36,6 +86,61 @@ def serve(
             The server logger level. Defaults to *INFO*.
         json_output (`bool`):
             Use JSON format for log serialization.
+        replicas (`int`):
+            The number of model replicas, each one exposed on its own socket and driven by its own router.
+            Defaults to 1. Note that the router started by the text-generation-launcher only drives the replica
+            of rank 0: the replica of rank `i` needs a router started with `--master-shard-uds-path {uds_path}-{i}`.
+        cores_per_replica (`Optional[int]`):
+            The number of NeuronCores of each replica. Defaults to the number of cores of the model.
+        cpu (`bool`):
+            Serve a regular transformers model on CPU instead of a neuron model (for testing only).
+        cpu_batch_size (`int`):
+            The static batch size of the CPU model. Defaults to 4.
+        cpu_max_length (`int`):
+            The maximum number of tokens of each sequence of the CPU model. Defaults to 256.
+        cpu_continuous_batching (`bool`):
+            Whether the CPU model emulates continuous batching or not. Defaults to True.
+        decode_steps (`int`):
+            The maximum number of tokens generated for each request by a single decode call. Defaults to 1.
+            Additional steps are performed only as long as no request is finished.
+        metrics_port (`Optional[int]`):
+            If specified, the server metrics are exposed in the Prometheus format on this local HTTP port.
+        metrics_file (`Optional[str]`):
+            If specified, the server metrics are periodically written in the Prometheus format to this file.
+        prefix_cache (`bool`):
+            Reuse the KV cache of previous requests sharing a common prefix with new requests (e.g. a system prompt).
+            Only supported for models exported with continuous batching.
+        draft_model_id (`Optional[str]`):
+            The *model_id* of a smaller model sharing the same tokenizer, used to propose tokens that are verified
+            by the served model (speculative decoding). Only supported for models exported with continuous batching.
+        speculation_length (`int`):
+            The number of tokens proposed by the draft model or the prompt lookup at each decode step. Defaults to 4.
+            A neuron model must be exported with a `speculation_length` of this value plus one.
+        prompt_lookup (`bool`):
+            Propose the tokens verified by the served model by looking up the last tokens of each request in its
+            prompt instead of using a draft model. Only supported for models exported with continuous batching.
+        prefill_chunk_size (`Optional[int]`):
+            If specified, the prompts of new requests are encoded in chunks, with at most this number of prompt tokens
+            encoded by each prefill or decode call, so that long prompts do not stall the requests being decoded.
+            Only supported for models exported with continuous batching.
+        max_prefill_padding (`float`):
+            The maximum fraction of padding tokens in the inputs of a prefill forward. Defaults to 1.0.
+            Lower values prefill new requests of different lengths separately, trading additional forwards (and a
+            longer delay before the first token of the longest requests) for less padding.
+            Only supported for models exported with continuous batching.
+        regex (`Optional[str]`):
+            If specified, the generated text of all requests is constrained to match this regular expression.
+        json_schema (`Optional[str]`):
+            If specified, the generated text of all requests is constrained to be a JSON document following this
+            schema, passed either as a serialized JSON string or as the path to a JSON file.
+        trace_file (`Optional[str]`):
+            If specified, the traces of the requests (queue wait, prefills, pauses, tokens and finish reason) are
+            appended to this file as OpenTelemetry (OTLP) JSON lines.
+        trace_endpoint (`Optional[str]`):
+            If specified, the traces of the requests are posted to this OpenTelemetry collector OTLP/HTTP endpoint
+            (e.g. `http://localhost:4318/v1/traces`).
+        trace_sample_rate (`float`):
+            The fraction of the requests that are traced. Defaults to 0.1.
     """
     if sharded:
         raise ValueError("Sharding cannot be modified after the Neuron model has been compiled.")
@@ -58,7 +163,133 @@ def serve(
     # Import here after the logger is added to log potential import exceptions
     from .server import serve
 
-    serve(model_id, revision, uds_path)
+    cpu_model_kwargs = None
+    if cpu:
+        cpu_model_kwargs = {
+            "batch_size": cpu_batch_size,
+            "max_length": cpu_max_length,
+            "continuous_batching": cpu_continuous_batching,
+        }
+    json_schema = _check_generator_parameters(
+        decode_steps, speculation_length, prefill_chunk_size, max_prefill_padding, regex, json_schema
+    )
+    if trace_sample_rate < 0 or trace_sample_rate > 1:
+        raise ValueError("The trace sample rate must be a fraction between 0 and 1.")
+    serve(
+        model_id,
+        revision,
+        uds_path,
+        replicas,
+        cores_per_replica,
+        cpu_model_kwargs,
+        decode_steps,
+        metrics_port,
+        metrics_file,
+        prefix_cache,
+        draft_model_id,
+        speculation_length,
+        prompt_lookup,
+        prefill_chunk_size,
+        max_prefill_padding,
+        regex,
+        json_schema,
+        trace_file,
+        trace_endpoint,
+        trace_sample_rate,
+    )
+
+
+@app.command()
+def batch(
+    model_id: str,
+    input_path: str,
+    output_path: str,
+    revision: Optional[str] = None,
+    max_new_tokens: int = 20,
+    resume: bool = False,
+    logger_level: str = "INFO",
+    json_output: bool = False,
+    cpu: bool = False,
+    cpu_batch_size: int = 4,
+    cpu_max_length: int = 256,
+    cpu_continuous_batching: bool = True,
+    decode_steps: int = 1,
+    prefix_cache: bool = False,
+    draft_model_id: Optional[str] = None,
+    speculation_length: int = 4,
+    prompt_lookup: bool = False,
+    prefill_chunk_size: Optional[int] = None,
+    max_prefill_padding: float = 1.0,
+    regex: Optional[str] = None,
+    json_schema: Optional[str] = None,
+):
+    """Generate the completions of a JSON lines file of prompts offline, without the router.
+
+    Each line of the input file is a JSON object with the same fields as the body of a `/generate` request,
+    and the completion of each prompt is appended to the output file as soon as it is finished.
+
+    Args:
+        model_id (`str`):
+            The *model_id* of a model on the HuggingFace hub or the path to a local model.
+        input_path (`str`):
+            The path of the JSON lines file of prompts.
+        output_path (`str`):
+            The path of the JSON lines file of completions.
+        revision (`Optional[str]`, defaults to `None`):
+            The revision of the model on the HuggingFace hub.
+        max_new_tokens (`int`):
+            The maximum number of generated tokens of the prompts that do not specify it. Defaults to 20.
+        resume (`bool`):
+            Resume an interrupted run, only generating the completions missing from the output file.
+        logger_level (`str`):
+            The logger level. Defaults to *INFO*.
+        json_output (`bool`):
+            Use JSON format for log serialization.
+
+    The other parameters configure the model and the generator as for the `serve` command.
+    """
+    logger.remove()
+    logger.add(
+        sys.stdout,
+        format="{message}",
+        filter="text_generation_server",
+        level=logger_level,
+        serialize=json_output,
+        backtrace=True,
+        diagnose=False,
+    )
+
+    # Import here after the logger is added to log potential import exceptions
+    from .batch import generate_jsonl
+    from .generator import NeuronGenerator
+
+    cpu_model_kwargs = None
+    if cpu:
+        cpu_model_kwargs = {
+            "batch_size": cpu_batch_size,
+            "max_length": cpu_max_length,
+            "continuous_batching": cpu_continuous_batching,
+        }
+    json_schema = _check_generator_parameters(
+        decode_steps, speculation_length, prefill_chunk_size, max_prefill_padding, regex, json_schema
+    )
+    generator = NeuronGenerator.from_pretrained(
+        model_id,
+        revision,
+        cpu_model_kwargs,
+        decode_steps,
+        prefix_cache,
+        draft_model_id,
+        speculation_length,
+        prompt_lookup,
+        prefill_chunk_size,
+        max_prefill_padding,
+        regex,
+        json_schema,
+    )
+    generate_jsonl(
+        generator, generator.model.batch_size, input_path, output_path, max_new_tokens=max_new_tokens, resume=resume
+    )
 
 
 @app.command()
@@ -0,0 +1,323 @@
+import time
+from typing import Optional
+
+import torch
+from loguru import logger
+from transformers import AutoConfig, AutoModelForCausalLM, PretrainedConfig, PreTrainedModel
+from transformers.generation import GenerationConfig, GenerationMixin
+from transformers.modeling_outputs import CausalLMOutput
+
+from optimum.neuron import NeuronModelForCausalLM
+
+
+class CPUModelForCausalLM(GenerationMixin):
+    """A CPU stand-in for a `NeuronModelForCausalLM`, to test the server without Neuron hardware.
+
+    It wraps a regular transformers causal language model, and exposes the same static
+    dimensions, inputs and KV cache semantics as the neuron models, for both static and
+    continuous batching: the tokens stored in each row of the emulated KV cache are kept
+    in a `[batch_size, max_length]` buffer, and each forward simply evaluates the whole
+    context of each row.
+
+    This is obviously much slower than an actual KV cache: the purpose of this model is only to
+    produce meaningful outputs when testing the server plumbing.
+
+    Args:
+        model (`transformers.PreTrainedModel`):
+            The CPU causal language model producing the logits.
+        batch_size (`int`):
+            The static batch size.
+        max_length (`int`):
+            The maximum number of tokens of each sequence.
+        continuous_batching (`bool`, defaults to `True`):
+            Whether the model emulates a model exported with continuous batching or not.
+    """
+
+    main_input_name = "input_ids"
+
+    def __init__(self, model: PreTrainedModel, batch_size: int, max_length: int, continuous_batching: bool = True):
+        self.model = model
+        self.config = model.config
+        self.generation_config = model.generation_config
+        self.device = torch.device("cpu")
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.continuous_batching = continuous_batching
+        # The tokens stored in the KV cache of each sequence (-1 for empty positions)
+        self._cache = torch.full([batch_size, max_length], fill_value=-1, dtype=torch.int64)
+        # For static batching, the position of the first token of each sequence in the KV cache
+        self._start_ids = torch.zeros([batch_size], dtype=torch.int64)
+
+    prepare_inputs_for_prefill = NeuronModelForCausalLM.prepare_inputs_for_prefill
+    prepare_inputs_for_decode = NeuronModelForCausalLM.prepare_inputs_for_decode
+
+    def can_generate(self) -> bool:
+        return True
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        cache_ids: Optional[torch.Tensor] = None,
+        start_ids: Optional[torch.Tensor] = None,
+        return_dict: bool = True,
+    ):
+        if self.continuous_batching:
+            contexts = self._update_continuous_cache(input_ids, cache_ids, start_ids)
+        else:
+            contexts = self._update_static_cache(input_ids, cache_ids, start_ids)
+        logits = []
+        with torch.inference_mode():
+            for context in contexts:
+                logits.append(self.model(context.unsqueeze(0)).logits[:, -1, :])
+        logits = torch.cat(logits).unsqueeze(1)
+        if return_dict:
+            return CausalLMOutput(logits=logits)
+        return (logits,)
+
+    def speculative_forward(
+        self, input_ids: torch.Tensor, cache_ids: torch.Tensor, start_ids: torch.Tensor, return_dict: bool = True
+    ):
+        """Evaluate the logits of several new tokens of each sequence (continuous batching only).
+
+        Unlike `NeuronModelForCausalLM.speculative_forward`, any number of new tokens is supported.
+        """
+        if not self.continuous_batching:
+            raise ValueError("Speculative forward is only supported for continuous batching.")
+        contexts = self._update_continuous_cache(input_ids, cache_ids, start_ids)
+        speculation_length = input_ids.shape[-1]
+        logits = []
+        with torch.inference_mode():
+            for context in contexts:
+                logits.append(self.model(context.unsqueeze(0)).logits[:, -speculation_length:, :])
+        logits = torch.cat(logits)
+        if return_dict:
+            return CausalLMOutput(logits=logits)
+        return (logits,)
+
+    def copy_kv_cache(self, seq_id: int, target_seq_ids: torch.Tensor, length: int):
+        """Copy the first tokens of a KV cache row to other rows (continuous batching only).
+
+        This allows requests sharing the same prompt to encode it only once.
+
+        Args:
+            seq_id (`int`):
+                The index of the KV cache row to copy.
+            target_seq_ids (`torch.LongTensor` of shape `(n_rows,)`):
+                The indices of the KV cache rows to overwrite.
+            length (`int`):
+                The number of tokens to copy.
+        """
+        if not self.continuous_batching:
+            raise ValueError("Copying KV cache rows is only supported for continuous batching.")
+        self._cache[target_seq_ids, :length] = self._cache[seq_id, :length]
+        self._cache[target_seq_ids, length:] = -1
+
+    def _update_continuous_cache(self, input_ids: torch.Tensor, cache_ids: torch.Tensor, start_ids: torch.Tensor):
+        contexts = []
+        for i, seq_id in enumerate(start_ids.tolist()):
+            # Inputs are right-padded and the cache ids of the padding tokens are ignored
+            first, last = int(cache_ids[i, 0]), int(cache_ids[i].max())
+            length = last - first + 1
+            self._cache[seq_id, first : last + 1] = input_ids[i, :length]
+            self._cache[seq_id, last + 1 :] = -1
+            contexts.append(self._cache[seq_id, : last + 1])
+        return contexts
+
+    def _update_static_cache(
+        self, input_ids: torch.Tensor, cache_ids: Optional[torch.Tensor], start_ids: torch.Tensor
+    ):
+        if input_ids.shape[0] != self.batch_size:
+            raise ValueError(f"Static batching requires inputs for the {self.batch_size} sequences of the batch.")
+        if cache_ids is None:
+            # The whole KV cache is rebuilt from the left-padded inputs
+            length = input_ids.shape[-1]
+            self._cache[:, :] = -1
+            self._cache[:, :length] = input_ids
+            self._start_ids = start_ids.clone()
+        else:
+            position = int(cache_ids[0])
+            self._cache[:, position] = input_ids[:, 0]
+            length = position + 1
+        return [self._cache[i, start:length] for i, start in enumerate(self._start_ids.tolist())]
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_id: str,
+        revision: Optional[str] = None,
+        batch_size: int = 4,
+        max_length: int = 256,
+        continuous_batching: bool = True,
+    ) -> "CPUModelForCausalLM":
+        """Instantiate a CPU stand-in model from a transformers checkpoint.
+
+        Args:
+            model_id (`str`):
+                The *model_id* of a model on the HuggingFace hub or the path to a local model.
+            revision (`Optional[str]`, defaults to `None`):
+                The revision of the model on the HuggingFace hub.
+            batch_size (`int`, defaults to 4):
+                The static batch size.
+            max_length (`int`, defaults to 256):
+                The maximum number of tokens of each sequence.
+            continuous_batching (`bool`, defaults to `True`):
+                Whether the model emulates a model exported with continuous batching or not.
+
+        Returns:
+            A `CPUModelForCausalLM`.
+        """
+        logger.info(f"Loading {model_id} on CPU (batch_size={batch_size}, max_length={max_length})")
+        model = AutoModelForCausalLM.from_pretrained(model_id, revision=revision)
+        model.eval()
+        return cls(model, batch_size, max_length, continuous_batching)
+
+
+class SimulatedModelForCausalLM(GenerationMixin):
+    """A stand-in for a `NeuronModelForCausalLM` producing deterministic logits at a simulated latency.
+
+    It exposes the same static dimensions and inputs as the neuron models, for both static and continuous
+    batching, but no actual model is evaluated: the logits of each token favor a token that only depends on the
+    value and the position of the previous token, and each forward simply waits for the duration it would take
+    on a device. This allows the generator loop to be benchmarked without Neuron hardware.
+    Like neuron models, it cannot copy its KV cache rows, so that requests with the same prompt are encoded separately.
+
+    Args:
+        config (`transformers.PretrainedConfig`):
+            The configuration of the simulated model (only the vocabulary size and special tokens are used).
+        batch_size (`int`):
+            The static batch size.
+        max_length (`int`):
+            The maximum number of tokens of each sequence.
+        continuous_batching (`bool`, defaults to `True`):
+            Whether the model emulates a model exported with continuous batching or not.
+        forward_latency (`float`, defaults to 0.02):
+            The duration of a forward in seconds, whatever the number of input tokens.
+        token_latency (`float`, defaults to 0.0):
+            The additional duration of a forward in seconds for each input token (including padding tokens).
+    """
+
+    main_input_name = "input_ids"
+
+    def __init__(
+        self,
+        config: PretrainedConfig,
+        batch_size: int,
+        max_length: int,
+        continuous_batching: bool = True,
+        forward_latency: float = 0.02,
+        token_latency: float = 0.0,
+    ):
+        self.config = config
+        self.generation_config = GenerationConfig.from_model_config(config)
+        self.device = torch.device("cpu")
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.continuous_batching = continuous_batching
+        self.forward_latency = forward_latency
+        self.token_latency = token_latency
+        # The total time spent in forwards, to evaluate the overhead of the caller
+        self.forward_time = 0.0
+        # The logits of all tokens share the same random noise, on top of which the favored token stands out
+        generator = torch.Generator().manual_seed(0)
+        self._noise = torch.randn([config.vocab_size], generator=generator)
+        self._noise[config.eos_token_id] = self._noise.min()
+
+    prepare_inputs_for_prefill = NeuronModelForCausalLM.prepare_inputs_for_prefill
+    prepare_inputs_for_decode = NeuronModelForCausalLM.prepare_inputs_for_decode
+
+    def can_generate(self) -> bool:
+        return True
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        cache_ids: Optional[torch.Tensor] = None,
+        start_ids: Optional[torch.Tensor] = None,
+        return_dict: bool = True,
+    ):
+        start = time.perf_counter()
+        if cache_ids is None:
+            # Static batching context encoding of left-padded inputs
+            tokens = input_ids[:, -1]
+            positions = torch.full_like(tokens, input_ids.shape[-1] - 1)
+        elif cache_ids.dim() == 1:
+            # Static batching decode: all sequences share the same position
+            tokens = input_ids[:, -1]
+            positions = cache_ids.expand(tokens.shape).to(torch.int64)
+        else:
+            # Continuous batching: inputs are right-padded and the last token has the highest cache id
+            positions, last = cache_ids.to(torch.int64).max(dim=-1)
+            tokens = input_ids.gather(1, last[:, None])[:, 0]
+        logits = self._logits(tokens, positions).unsqueeze(1)
+        self._wait(start, input_ids.numel())
+        if return_dict:
+            return CausalLMOutput(logits=logits)
+        return (logits,)
+
+    def speculative_forward(
+        self, input_ids: torch.Tensor, cache_ids: torch.Tensor, start_ids: torch.Tensor, return_dict: bool = True
+    ):
+        """Evaluate the logits of several new tokens of each sequence (continuous batching only)."""
+        if not self.continuous_batching:
+            raise ValueError("Speculative forward is only supported for continuous batching.")
+        start = time.perf_counter()
+        logits = self._logits(input_ids.flatten(), cache_ids.flatten().to(torch.int64))
+        logits = logits.reshape(input_ids.shape + (-1,))
+        self._wait(start, input_ids.numel())
+        if return_dict:
+            return CausalLMOutput(logits=logits)
+        return (logits,)
+
+    def _logits(self, tokens: torch.LongTensor, positions: torch.LongTensor) -> torch.Tensor:
+        vocab_size = self.config.vocab_size
+        favored = (tokens * 7919 + positions * 104729 + 1) % vocab_size
+        favored = torch.where(favored == self.config.eos_token_id, (favored + 1) % vocab_size, favored)
+        logits = self._noise.repeat(tokens.shape[0], 1)
+        logits.scatter_(1, favored[:, None], 10.0)
+        return logits
+
+    def _wait(self, start: float, n_tokens: int):
+        end = start + self.forward_latency + self.token_latency * n_tokens
+        time.sleep(max(end - time.perf_counter(), 0))
+        self.forward_time += time.perf_counter() - start
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_id: str,
+        revision: Optional[str] = None,
+        batch_size: int = 4,
+        max_length: int = 256,
+        continuous_batching: bool = True,
+        forward_latency: float = 0.02,
+        token_latency: float = 0.0,
+    ) -> "SimulatedModelForCausalLM":
+        """Instantiate a simulated model from the configuration of a transformers checkpoint.
+
+        Args:
+            model_id (`str`):
+                The *model_id* of a model on the HuggingFace hub or the path to a local model.
+            revision (`Optional[str]`, defaults to `None`):
+                The revision of the model on the HuggingFace hub.
+            batch_size (`int`, defaults to 4):
+                The static batch size.
+            max_length (`int`, defaults to 256):
+                The maximum number of tokens of each sequence.
+            continuous_batching (`bool`, defaults to `True`):
+                Whether the model emulates a model exported with continuous batching or not.
+            forward_latency (`float`, defaults to 0.02):
+                The duration of a forward in seconds, whatever the number of input tokens.
+            token_latency (`float`, defaults to 0.0):
+                The additional duration of a forward in seconds for each input token.
+
+        Returns:
+            A `SimulatedModelForCausalLM`.
+        """
+        config = AutoConfig.from_pretrained(model_id, revision=revision)
+        return cls(config, batch_size, max_length, continuous_batching, forward_latency, token_latency)
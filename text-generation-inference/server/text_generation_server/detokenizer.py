@@ -0,0 +1,81 @@
+from typing import Sequence
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+
+class IncrementalDetokenizer:
+    """Produces the text of a sequence of token ids incrementally, one token at a time.
+
+    Decoding a single token is not enough to obtain its text, because the text of a token might depend on the
+    previous tokens (leading spaces for sentencepiece tokenizers, multi-bytes UTF-8 characters split across tokens).
+
+    This class only decodes a small window of tokens around the new tokens:
+
+    - the prefix tokens, that have already been emitted, but that provide the context to decode the new tokens,
+    - the new tokens, that are emitted only once their text is stable (i.e. does not end with an incomplete UTF-8 character).
+
+    The text of the prefix window is cached, so that in most cases a single decoding of at most `max_prefix_tokens`
+    tokens is required for each new token. For fast tokenizers, the tokens are decoded directly by the backend
+    tokenizer to avoid the python conversions of `PreTrainedTokenizerBase.decode()`.
+
+    Args:
+        tokenizer (`transformers.PreTrainedTokenizerBase`):
+            The tokenizer used to decode the tokens.
+        max_prefix_tokens (`int`, defaults to 8):
+            The maximum number of tokens in the prefix window before it is moved forward.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, max_prefix_tokens: int = 8):
+        self._tokenizer = tokenizer
+        self._backend_tokenizer = tokenizer.backend_tokenizer if tokenizer.is_fast else None
+        self._max_prefix_tokens = max_prefix_tokens
+        self._prefix_offset = 0
+        self._read_offset = 0
+        self._prefix_text = ""
+
+    def _decode(self, token_ids: Sequence[int]) -> str:
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        if self._backend_tokenizer is not None:
+            return self._backend_tokenizer.decode(token_ids, skip_special_tokens=False)
+        return self._tokenizer.decode(token_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False)
+
+    def reset(self, token_ids: Sequence[int], context_tokens: int = 5):
+        """Reset the detokenizer for a new sequence.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                The token ids that have already been emitted (typically the prompt).
+            context_tokens (`int`, defaults to 5):
+                The number of previous tokens used as a context to decode the first new tokens.
+        """
+        self._read_offset = len(token_ids)
+        self._prefix_offset = max(self._read_offset - context_tokens, 0)
+        self._prefix_text = self._decode(token_ids[self._prefix_offset : self._read_offset])
+
+    def decode(self, token_ids: Sequence[int]) -> str:
+        """Return the text of the new tokens of a sequence.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                All the token ids of the sequence. Only the tokens that have been appended since the
+                last call are decoded.
+
+        Return:
+            The text of the new tokens, or an empty string if it is not stable yet.
+        """
+        text = self._decode(token_ids[self._prefix_offset :])
+        if len(text) <= len(self._prefix_text) or text.endswith("�"):
+            # The new tokens are an incomplete UTF-8 character: wait for the next tokens
+            return ""
+        new_text = text[len(self._prefix_text) :]
+        if len(token_ids) - self._prefix_offset > self._max_prefix_tokens:
+            # Move the prefix window forward to the tokens we just emitted
+            self._prefix_offset = self._read_offset
+            self._prefix_text = self._decode(token_ids[self._prefix_offset :])
+        else:
+            # The decoded text is the prefix text of the next tokens
+            self._prefix_text = text
+        self._read_offset = len(token_ids)
+        return new_text
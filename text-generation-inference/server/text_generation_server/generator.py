@@ -1,17 +1,28 @@
 import copy
 import logging
+import time
 from abc import ABC
+from collections import deque
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from loguru import logger
 from transformers import AutoTokenizer, PreTrainedTokenizerBase
-from transformers.generation import GenerationConfig
+from transformers.generation import GenerationConfig, LogitsProcessorList
 
 from optimum.neuron import NeuronModelForCausalLM
-from optimum.neuron.generation import TokenSelector
+from optimum.neuron.generation import (
+    BatchedTokenSelector,
+    FSMIndex,
+    FSMLogitsProcessor,
+    PromptLookupIndex,
+    TokenSelector,
+)
 
+from .cpu_model import CPUModelForCausalLM
+from .detokenizer import IncrementalDetokenizer
+from .metrics import REGISTRY
 from .model import fetch_model
 from .pb.generate_pb2 import (
     Batch,
@@ -22,12 +33,73 @@ from .pb.generate_pb2 import (
     InfoResponse,
     Request,
 )
+from .prefix_cache import PrefixCache
+from .tracing import TRACER
 
 
 # Disable optimum-neuron warnings as it seems to block the server after a while
 optimum_logger = logging.getLogger("optimum.neuron")
 optimum_logger.setLevel("CRITICAL")
 
+TOKENIZATION_DURATION = REGISTRY.histogram(
+    "tgi_neuron_tokenization_duration_seconds", "Duration of the tokenization of a request."
+)
+PREPARE_INPUTS_DURATION = {
+    phase: REGISTRY.histogram(
+        "tgi_neuron_prepare_inputs_duration_seconds",
+        "Duration of the preparation of the model inputs.",
+        {"phase": phase},
+    )
+    for phase in ("prefill", "decode", "draft", "verify")
+}
+FORWARD_DURATION = {
+    phase: REGISTRY.histogram("tgi_neuron_forward_duration_seconds", "Duration of a model forward.", {"phase": phase})
+    for phase in ("prefill", "decode", "draft", "verify")
+}
+TOKEN_SELECTION_DURATION = REGISTRY.histogram(
+    "tgi_neuron_token_selection_duration_seconds", "Duration of the selection of the next tokens of a batch."
+)
+DETOKENIZATION_DURATION = REGISTRY.histogram(
+    "tgi_neuron_detokenization_duration_seconds", "Duration of the decoding of the text of a new token."
+)
+GENERATED_TOKENS = REGISTRY.counter("tgi_neuron_generated_tokens_total", "Number of generated tokens.")
+DECODE_THROUGHPUT = REGISTRY.gauge(
+    "tgi_neuron_decode_tokens_per_second", "Number of tokens generated per second by the last decode."
+)
+ACTIVE_SLOTS = REGISTRY.gauge("tgi_neuron_active_slots", "Number of slots assigned to a request.")
+QUEUE_DEPTH = REGISTRY.gauge("tgi_neuron_queue_depth", "Number of requests waiting for an empty slot.")
+PREFIX_CACHE_LOOKUPS = REGISTRY.counter("tgi_neuron_prefix_cache_lookups_total", "Number of prefix cache lookups.")
+PREFIX_CACHE_HITS = REGISTRY.counter(
+    "tgi_neuron_prefix_cache_hits_total", "Number of requests reusing the cached tokens of a previous request."
+)
+PREFIX_CACHE_SAVED_TOKENS = REGISTRY.counter(
+    "tgi_neuron_prefix_cache_saved_tokens_total", "Number of prompt tokens that did not need to be encoded."
+)
+PREFILL_PADDING_TOKENS = REGISTRY.counter(
+    "tgi_neuron_prefill_padding_tokens_total", "Number of padding tokens evaluated by prefill forwards."
+)
+PREFILL_SHARED_TOKENS = REGISTRY.counter(
+    "tgi_neuron_prefill_shared_tokens_total",
+    "Number of prompt tokens copied from the KV cache row of a request with the same prompt instead of being encoded.",
+)
+SPECULATION_PROPOSED_TOKENS = REGISTRY.counter(
+    "tgi_neuron_speculation_proposed_tokens_total",
+    "Number of tokens proposed by the draft model or the prompt lookup.",
+)
+SPECULATION_ACCEPTED_TOKENS = REGISTRY.counter(
+    "tgi_neuron_speculation_accepted_tokens_total", "Number of proposed tokens accepted by the model."
+)
+SPECULATION_ACCEPTANCE_RATE = REGISTRY.gauge(
+    "tgi_neuron_speculation_acceptance_rate", "Fraction of the proposed tokens accepted by the model."
+)
+
+# The names of the finish reasons, as returned by the router
+FINISH_REASONS = {
+    FinishReason.FINISH_REASON_LENGTH: "length",
+    FinishReason.FINISH_REASON_EOS_TOKEN: "eos_token",
+    FinishReason.FINISH_REASON_STOP_SEQUENCE: "stop_sequence",
+}
+
 
 class Generator(ABC):
     """An abstract class to represent the workhorse behind TextGenerationService.
@@ -87,28 +159,50 @@ class Generator(ABC):
 
 
 class Slot:
-    """Represents a slot in a static batch"""
+    """Represents a slot in a static batch
+
+    The slot owns a preallocated buffer containing the token ids of the request: the prompt
+    token ids followed by the generated token ids. This buffer is the single source of truth
+    for both prefill and decode: the text is only produced for the response.
+
+    The slot token ids and attention mask are fixed-capacity buffers, that are typically rows of the
+    batch-level buffers, so that they can be updated in place for each new token. The token ids beyond
+    the current length of the slot are set to -1 (padding).
+    """
 
     class State(Enum):
         EMPTY = 0
         PAUSE = 1
         READY = 2
+        PREFILL = 3
 
-    def __init__(self, id: int):
+    def __init__(
+        self,
+        id: int,
+        tokenizer: PreTrainedTokenizerBase,
+        max_length: int,
+        attention_mask: Optional[torch.LongTensor] = None,
+        token_ids: Optional[torch.LongTensor] = None,
+    ):
         self._id = id
+        if token_ids is None:
+            token_ids = torch.full([max_length], fill_value=-1, dtype=torch.int64)
+        self._token_ids = token_ids
+        if attention_mask is None:
+            attention_mask = torch.zeros([max_length], dtype=torch.int64)
+        self._mask = attention_mask
+        self._detokenizer = IncrementalDetokenizer(tokenizer)
         self.clear()
 
     def clear(self):
         """Clear the slot and mark it as available."""
         self._state = Slot.State.EMPTY
         self._request_id = None
-        self._inputs = ""
         self._generation_config = None
-        self._tokens = []
-        self._mask = []
+        self._length = 0
+        self._prompt_length = 0
+        self._mask_length = 0
         self._selector = None
-        self._generated_tokens = 0
-        self._next_token_text = ""
 
     @property
     def id(self) -> int:
@@ -122,30 +216,32 @@ class Slot:
     def request_id(self) -> int:
         return self._request_id
 
-    @property
-    def inputs(self) -> str:
-        return self._inputs
-
     @property
     def generation_config(self) -> GenerationConfig:
         return self._generation_config
 
     @property
-    def generated_tokens(self) -> torch.LongTensor:
-        return self._generated_tokens
+    def generated_tokens(self) -> int:
+        return self._length - self._prompt_length
 
-    def assign(self, request: Request, generation_config: GenerationConfig):
+    def assign(self, request: Request, input_ids: torch.LongTensor, generation_config: GenerationConfig):
         """Assign a request to a slot.
 
         Args:
             request (`Request`):
                 The request to be assigned. Contains the inputs and tokens selection parameters.
+            input_ids (`torch.LongTensor`):
+                The unpadded prompt token ids of the request.
             generation_config (`transformers.GenerationConfig`):
                 The base generation config (might be modified by the request generation parameters).
         """
         self._state = Slot.State.READY
         self._request_id = request.id
-        self._inputs = request.inputs
+        self._prompt_length = input_ids.size(-1)
+        self._length = self._prompt_length
+        self._token_ids[: self._length] = input_ids
+        self._token_ids[self._length :] = -1
+        self._detokenizer.reset(self.tokens)
         self._generation_config = copy.deepcopy(generation_config)
         # Update generation config with token chooser parameters
         self._generation_config.temperature = request.parameters.temperature
@@ -158,20 +254,27 @@ class Slot:
         self._generation_config.max_new_tokens = request.stopping_parameters.max_new_tokens
         # TODO: stop_sequences, ignore_eos_token
 
-    def reset(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, selector: TokenSelector):
-        """Reset the slot for the next generation.
+    def reset(self, attention_mask: torch.LongTensor, selector: Optional[TokenSelector] = None):
+        """Reset the slot after its context has been encoded in the KV cache.
 
         Args:
-            input_ids: (`torch.LongTensor`):
-                The new input_ids to use to generate the next token.
             attention_mask: (`torch.LongTensor`):
                 The new attention_mask to use to generate the next token.
-            selector: (`optimum.neuron.generation.TokenSelector`):
-                An object implementing the updated token selection logic.
+            selector: (`optimum.neuron.generation.TokenSelector`, *optional*):
+                An object implementing the token selection logic. If not specified, the current one is kept.
+        """
+        self._mask_length = attention_mask.size(-1)
+        self._mask[: self._mask_length] = attention_mask
+        self._mask[self._mask_length :] = 0
+        if selector is not None:
+            self._selector = selector
+
+    def defer(self):
+        """Mark the slot as waiting for the remaining chunks of its prompt to be encoded in the KV cache.
+
+        No token is generated for this slot until it is resumed.
         """
-        self._tokens = input_ids.clone()
-        self._mask = attention_mask.clone()
-        self._selector = selector
+        self._state = Slot.State.PREFILL
 
     def pause(self):
         """Mark the current slot as paused for generation.
@@ -182,63 +285,67 @@ class Slot:
 
     def resume(self):
         """Mark the slot as ready for generation."""
-        if self._state == Slot.State.PAUSE and self.next_token is not None:
+        if self._state == Slot.State.PAUSE and self.generated_tokens > 0:
             # The generation of this slot was inhibited during a prefill, but it
             # already had a pending token, so we need to increase attention mask
-            self._mask = torch.cat([self._mask, torch.LongTensor([1])])
+            self._extend_mask()
         self._state = Slot.State.READY
 
-    def append(self, next_token: int, next_token_text: str):
+    def append(self, next_token: int) -> str:
         """Append a new generated token to this slot
 
         The new token is added to the list of generated tokens, which impacts
-        directly the generated_text and stopped property.
+        directly the generated_ids and stopped property.
 
-        The new token is however not added immediately to the slot inputs: it will
+        The new token is however not added immediately to the KV cache: it will
         be added later on when it has effectively been used to produce the next token.
 
         Args:
             next_token (`int`):
                 The newly generated token.
-            next_token_test (`str`):
-                The corresponding decoded text.
-        """
-        self._tokens = torch.cat([self._tokens, torch.LongTensor([next_token])])
-        self._mask = torch.cat([self._mask, torch.LongTensor([1])])
-        self._generated_tokens += 1
-        # Now that a new token has been generated, we can append the previous one to the inputs
-        self._inputs += self._next_token_text
-        self._next_token_text = next_token_text
-
-    def select(self, input_ids: torch.LongTensor, logits: torch.Tensor) -> torch.LongTensor:
-        """Select the next token from the candidate logits.
-
-        Args:
-            input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
-                The sequence used as a prompt for the generation (not used in all generation modes).
-            logits (`torch.Tensor` of shape `(batch_size, sequence_length)`):
-                The logits corresponding to the generated tokens.
 
         Return:
-            `torch.LongTensor`: A scalar torch.LongTensor` containing the selected token.
+            The new text produced by this token: it can be empty if the token text
+            cannot be decoded without the next tokens.
         """
-        return self._selector.select(input_ids, logits)[0]
+        self._token_ids[self._length] = next_token
+        self._length += 1
+        if self._mask_length < self._mask.size(-1):
+            self._extend_mask()
+        # Otherwise the KV cache is full and the slot will be stopped before the new token is used
+        return self._detokenizer.decode(self.tokens)
+
+    def _extend_mask(self):
+        self._mask[self._mask_length] = 1
+        self._mask_length += 1
 
     @property
     def stopped(self) -> bool:
-        return self._selector.stopping_criteria(self._tokens, None)
+        return self._selector.stopping_criteria(self.tokens, None)
+
+    @property
+    def tokens(self) -> torch.LongTensor:
+        """The prompt token ids followed by the generated token ids."""
+        return self._token_ids[: self._length]
 
     @property
-    def generated_text(self) -> str:
-        return self._inputs + self._next_token_text
+    def generated_ids(self) -> torch.LongTensor:
+        return self._token_ids[self._prompt_length : self._length]
+
+    @property
+    def cached_tokens(self) -> torch.LongTensor:
+        """The token ids that must be stored in the KV cache, i.e. all tokens but the pending one."""
+        if self.generated_tokens == 0:
+            return self.tokens
+        return self._token_ids[: self._length - 1]
 
     @property
     def next_token(self) -> int:
-        return None if len(self._tokens) == 0 else self._tokens[-1]
+        return None if self._length == 0 else self._token_ids[self._length - 1]
 
     @property
     def attention_mask(self) -> torch.LongTensor:
-        return self._mask
+        return self._mask[: self._mask_length]
 
     @property
     def max_token(self) -> int:
@@ -246,20 +353,149 @@ class Slot:
 
 
 class NeuronGenerator(Generator):
-    """A Generator for Neuron models."""
+    """A Generator for Neuron models.
+
+    With continuous batching, the requests with the same prompt that are prefilled together encode it only once if
+    the model can copy its KV cache rows (`copy_kv_cache`). Only `CPUModelForCausalLM` supports it: the KV cache rows
+    of neuron models cannot be copied, so their prompts are still encoded for each request.
+
+    Args:
+        model (`Union[NeuronModelForCausalLM, CPUModelForCausalLM]`):
+            The model generating the tokens.
+        tokenizer (`transformers.PreTrainedTokenizerBase`):
+            The model tokenizer.
+        decode_steps (`int`, defaults to 1):
+            The maximum number of tokens generated for each request by a single call to `decode`.
+            Additional steps are only performed as long as no request is finished.
+        prefix_cache (`bool`, defaults to `False`):
+            Whether new requests should reuse the tokens of previous requests still stored in the KV cache rows of
+            empty slots when they share a common prefix. Only supported for models exported with continuous batching.
+        draft_model (`Optional[Union[NeuronModelForCausalLM, CPUModelForCausalLM]]`, defaults to `None`):
+            A smaller model sharing the same tokenizer, used for speculative decoding: at each decode step, the draft
+            model proposes `speculation_length` tokens for each request, that are verified by a single forward of the
+            model. Only supported if both models have been exported with continuous batching.
+        speculation_length (`int`, defaults to 4):
+            The number of tokens proposed by the draft model or the prompt lookup at each decode step. Neuron models
+            must have been exported with a `speculation_length` of this value plus one.
+        prompt_lookup (`bool`, defaults to `False`):
+            Whether the tokens verified at each decode step should be proposed by looking up the last tokens of each
+            request in its prompt instead of using a draft model. Only supported for models exported with
+            continuous batching.
+        prefill_chunk_size (`Optional[int]`, defaults to `None`):
+            If specified, the prompts of new requests are encoded in chunks, within a budget of this number of tokens
+            for each call to `prefill` or `decode`, so that the active requests keep generating tokens while long
+            prompts are encoded. Only supported for models exported with continuous batching.
+        max_prefill_padding (`float`, defaults to 1.0):
+            The maximum fraction of padding tokens in the inputs of a prefill forward: the new requests are sorted by
+            prompt length and split into groups that are prefilled separately, so that short prompts are not padded
+            to the length of long prompts, at the cost of additional forwards. The default value prefills all new
+            requests at once. Only supported for models exported with continuous batching.
+        fsm_index (`Optional[FSMIndex]`, defaults to `None`):
+            If specified, the generated text of all requests is constrained to match the regular expression (or JSON
+            schema) of this index: at each step, the tokens that cannot lead to a matching text are masked.
+    """
 
     def __init__(
         self,
-        model: NeuronModelForCausalLM,
+        model: Union[NeuronModelForCausalLM, CPUModelForCausalLM],
         tokenizer: PreTrainedTokenizerBase,
+        decode_steps: int = 1,
+        prefix_cache: bool = False,
+        draft_model: Optional[Union[NeuronModelForCausalLM, CPUModelForCausalLM]] = None,
+        speculation_length: int = 4,
+        prompt_lookup: bool = False,
+        prefill_chunk_size: Optional[int] = None,
+        max_prefill_padding: float = 1.0,
+        fsm_index: Optional[FSMIndex] = None,
     ):
         self.model = model
+        self.decode_steps = decode_steps
+        self.prefix_cache = None
+        if prefix_cache:
+            if self.model.continuous_batching:
+                self.prefix_cache = PrefixCache()
+            else:
+                logger.warning("The prefix cache is ignored: it requires a model exported with continuous batching.")
+        self.draft_model = None
+        self.prompt_lookup = False
+        self.speculation_length = speculation_length
+        if draft_model is not None and prompt_lookup:
+            raise ValueError("The tokens can be proposed either by a draft model or by the prompt lookup, not both.")
+        if draft_model is not None:
+            if self.model.continuous_batching and draft_model.continuous_batching:
+                self._check_draft_model(draft_model)
+                self.draft_model = draft_model
+            else:
+                logger.warning(
+                    "The draft model is ignored: speculative decoding requires models exported with continuous batching."
+                )
+        if prompt_lookup:
+            if self.model.continuous_batching:
+                self._check_speculation_length()
+                self.prompt_lookup = True
+            else:
+                logger.warning("The prompt lookup is ignored: it requires a model exported with continuous batching.")
+        self.prefill_chunk_size = None
+        if prefill_chunk_size is not None:
+            if prefill_chunk_size < 1:
+                raise ValueError("The prefill chunk size must be at least 1.")
+            if self.model.continuous_batching:
+                self.prefill_chunk_size = prefill_chunk_size
+            else:
+                logger.warning("Chunked prefill is ignored: it requires a model exported with continuous batching.")
+        if max_prefill_padding < 0 or max_prefill_padding > 1:
+            raise ValueError("The maximum prefill padding must be a fraction between 0 and 1.")
+        if max_prefill_padding < 1 and not self.model.continuous_batching:
+            logger.warning(
+                "The maximum prefill padding is ignored: it requires a model exported with continuous batching."
+            )
+        self.max_prefill_padding = max_prefill_padding
+        self.fsm_index = fsm_index
+        # Requests with the same prompt can share a single prefill if the KV cache rows can be copied (CPU models only)
+        self.share_prefill = self.model.continuous_batching and hasattr(self.model, "copy_kv_cache")
         # Specify padding options for decoder-only architecture
         tokenizer.pad_token_id = tokenizer.eos_token_id
         tokenizer.padding_side = "left"
         self.tokenizer = tokenizer
         self.special_tokens = [self.tokenizer.eos_token_id, self.tokenizer.pad_token_id]
-        self.slots = [Slot(i) for i in range(self.model.batch_size)]
+        # Batch-level inputs are preallocated and updated in place during decode: each slot
+        # attention mask is a view of the corresponding row of the batch attention mask.
+        batch_size, max_length = self.model.batch_size, self.model.max_length
+        self.input_ids = torch.full([batch_size, 1], fill_value=tokenizer.eos_token_id, dtype=torch.int64)
+        self.attention_mask = torch.zeros([batch_size, max_length], dtype=torch.int64)
+        self.seq_ids = torch.arange(batch_size)
+        # The token ids of all slots are stored in a single buffer to select the next tokens of all slots at once
+        self.token_ids = torch.full([batch_size, max_length], fill_value=-1, dtype=torch.int64)
+        self.selector = BatchedTokenSelector(batch_size)
+        self.slots = [
+            Slot(i, tokenizer, max_length, self.attention_mask[i], self.token_ids[i]) for i in range(batch_size)
+        ]
+        # The requests that cannot be assigned to a slot yet, in order of arrival
+        self.queue = deque()
+        # The number of tokens of each slot stored in the KV cache rows of the draft model
+        self.draft_lengths = [0] * batch_size
+        # The n-grams of the prompt of each slot, to propose tokens with the prompt lookup
+        self.lookup_indices: List[Optional[PromptLookupIndex]] = [None] * batch_size
+        # The slots whose prompt is being encoded chunk by chunk, in order of arrival
+        self.prefilling: List[Slot] = []
+        # The number of prompt tokens of each prefilling slot already stored in its KV cache row
+        self.prefill_lengths = [0] * batch_size
+
+    def _check_draft_model(self, draft_model: Union[NeuronModelForCausalLM, CPUModelForCausalLM]):
+        if draft_model.batch_size < self.model.batch_size or draft_model.max_length < self.model.max_length:
+            raise ValueError(
+                f"The draft model dimensions [{draft_model.batch_size}, {draft_model.max_length}] must be at least"
+                f" the model dimensions [{self.model.batch_size}, {self.model.max_length}]."
+            )
+        self._check_speculation_length()
+
+    def _check_speculation_length(self):
+        target_speculation_length = getattr(self.model, "speculation_length", None)
+        if target_speculation_length is not None and target_speculation_length != self.speculation_length + 1:
+            raise ValueError(
+                f"To verify {self.speculation_length} proposed tokens, the model must be exported with"
+                f" speculation_length={self.speculation_length + 1} (got {target_speculation_length})."
+            )
 
     @property
     def info(self) -> InfoResponse:
@@ -268,7 +504,7 @@ class NeuronGenerator(Generator):
         return InfoResponse(
             requires_padding=True,
             dtype=str(dtype),
-            device_type="xla",
+            device_type="cpu" if isinstance(self.model, CPUModelForCausalLM) else "xla",
         )
 
     def warmup(self, batch: Batch) -> int:
@@ -287,6 +523,10 @@ class NeuronGenerator(Generator):
     def prefill(self, batch: Batch) -> Tuple[List[Generation], CachedBatch]:
         """Prefill new requests.
 
+        The new requests are assigned to the empty slots. If there are not enough empty slots, the
+        remaining requests are queued and will be prefilled during the next decode steps as soon
+        as slots become available.
+
         Args:
             batch (`Batch`):
                 A batch containing the new requests.
@@ -294,54 +534,238 @@ class NeuronGenerator(Generator):
         Return:
             A list of `Generation` for each request and a `CachedBatch` containing all pending requests.
         """
+        for request in batch.requests:
+            TRACER.queued(
+                request.id,
+                max_new_tokens=request.stopping_parameters.max_new_tokens,
+                do_sample=request.parameters.do_sample,
+            )
+        generations = []
+        if len(self.queue) > 0:
+            # Requests queued from previous batches have precedence and can only be prefilled during decode
+            logger.debug(f"Queuing {len(batch.requests)} new request(s) behind {len(self.queue)} queued request(s)")
+            self.queue.extend(batch.requests)
+        else:
+            self.queue.extend(batch.requests)
+            generations = self._prefill_queued_requests()
+        request_ids = [request.id for request in batch.requests]
+        self._update_gauges()
+        return generations, self._cached_batch(batch.id, self._pending_request_ids(request_ids))
+
+    def _prefill_queued_requests(self) -> List[Generation]:
+        """Assign as many queued requests as possible to empty slots and prefill them."""
         slots = {state: [] for state in Slot.State}
         for slot in self.slots:
             slots[slot.state].append(slot)
         active_slots = slots[Slot.State.READY]
         empty_slots = slots[Slot.State.EMPTY]
-        if len(empty_slots) < len(batch.requests):
-            raise ValueError(
-                f"Cannot prefill {len(batch.requests)} new request(s) with only {len(empty_slots)} empty slots."
-                f"Please align the number of concurrent requests with the static batch size: {self.model.batch_size}."
-            )
+        n_requests = min(len(empty_slots), len(self.queue))
+        if n_requests == 0:
+            return [] if self.prefill_chunk_size is None else self._prefill_chunk()
+        if n_requests < len(self.queue):
+            logger.debug(f"Not enough empty slots: {len(self.queue) - n_requests} request(s) remain queued")
         # Assign each request to an empty slot
-        logger.debug(f"Prefilling {len(batch.requests)} new request(s) with {len(empty_slots)} empty slot(s)")
-        for request in batch.requests:
-            slot = empty_slots.pop()
-            slot.assign(request, self.model.generation_config)
+        logger.debug(f"Prefilling {n_requests} new request(s) with {len(empty_slots)} empty slot(s)")
+        new_slots = []
+        # The number of tokens already stored in the KV cache row of each new slot
+        cache_offsets = []
+        for _ in range(n_requests):
+            request = self.queue.popleft()
+            # Requests are tokenized only once: the slot token ids are used for all subsequent steps
+            with TOKENIZATION_DURATION.time():
+                slot_input_ids = self._tokenize(request)
+            if self.prefix_cache is None:
+                slot = empty_slots.pop()
+                cache_offsets.append(0)
+            else:
+                slot_id, prefix_length = self.prefix_cache.acquire(
+                    slot_input_ids.tolist(), [slot.id for slot in empty_slots]
+                )
+                slot = self.slots[slot_id]
+                empty_slots.remove(slot)
+                cache_offsets.append(prefix_length)
+                PREFIX_CACHE_LOOKUPS.inc()
+                if prefix_length > 0:
+                    PREFIX_CACHE_HITS.inc()
+                    PREFIX_CACHE_SAVED_TOKENS.inc(prefix_length)
+                    logger.debug(f"Request {request.id} reuses {prefix_length} cached tokens of slot {slot.id}")
+            slot.assign(request, slot_input_ids, self.model.generation_config)
+            TRACER.assigned(
+                request.id, slot.id, prompt_tokens=slot_input_ids.size(-1), cached_tokens=cache_offsets[-1]
+            )
+            # The draft KV cache row may hold fewer of the reused tokens than the model KV cache row
+            self.draft_lengths[slot.id] = min(self.draft_lengths[slot.id], cache_offsets[-1])
+            if self.prompt_lookup:
+                self.lookup_indices[slot.id] = PromptLookupIndex(slot_input_ids.tolist())
+            logits_processor = None
+            if self.fsm_index is not None:
+                # Only the generated tokens must match the expression
+                logits_processor = LogitsProcessorList([FSMLogitsProcessor(self.fsm_index, slot_input_ids.size(-1))])
+            selector = TokenSelector.create(
+                slot_input_ids.unsqueeze(0),
+                slot.generation_config,
+                self.model,
+                self.model.max_length,
+                logits_processor=logits_processor,
+            )
+            slot.reset(torch.ones_like(slot_input_ids), selector)
+            self.selector.set(slot.id, selector)
+            new_slots.append(slot)
             logger.debug(f"Request {slot.request_id} assigned to slot {slot.id}")
-        # Reconstruct the full inputs (without padding)
-        inputs = [slot.inputs for slot in self.slots]
-        # Tokenize with padding
-        padded_inputs = self.tokenizer(inputs, return_tensors="pt", padding=True)
-        #  If needed truncate sequences to fit into the static dimensions
-        seq_length = min(padded_inputs.input_ids.shape[-1], self.model.max_length)
-        input_ids = padded_inputs.input_ids[:, :seq_length]
-        attention_mask = padded_inputs.attention_mask[:, :seq_length]
-        # Each slot must be reset with the padded inputs and masks
-        for i, slot in enumerate(self.slots):
+        if self.prefill_chunk_size is not None:
+            # The new prompts are encoded after the remaining chunks of the prompts assigned before them
+            for slot, offset in zip(new_slots, cache_offsets):
+                slot.defer()
+                self.prefill_lengths[slot.id] = offset
+                self.prefilling.append(slot)
+            return self._prefill_chunk()
+        if self.model.continuous_batching:
+            # Only the new requests are encoded: the KV cache rows of active slots are left untouched.
+            # Only the tokens that are not already in the KV cache rows are encoded.
+            encoded, forks = self._share_prompts(new_slots)
+            prefill_input_ids = [new_slots[i].cached_tokens[cache_offsets[i] :] for i in encoded]
+            generations = []
+            for group in self._group_by_length([input_ids.size(-1) for input_ids in prefill_input_ids]):
+                prefill_slots = [new_slots[encoded[i]] for i in group]
+                seq_ids = torch.tensor([slot.id for slot in prefill_slots])
+                input_ids, attention_mask = self._pad([prefill_input_ids[i] for i in group])
+                PREFILL_PADDING_TOKENS.inc(int(attention_mask.numel() - attention_mask.sum()))
+                with PREPARE_INPUTS_DURATION["prefill"].time():
+                    model_inputs = self.model.prepare_inputs_for_prefill(
+                        input_ids,
+                        attention_mask,
+                        seq_ids,
+                        cache_offsets=torch.tensor([cache_offsets[encoded[i]] for i in group]),
+                    )
+                logits = self._forward(prefill_slots, model_inputs, "prefill")
+                # The KV cache row of each encoded prompt is copied to the slots sharing the same prompt, that
+                # select their first token from the same logits
+                select_slots = list(prefill_slots)
+                logits_rows = list(range(len(prefill_slots)))
+                for row, i in enumerate(group):
+                    slot = new_slots[encoded[i]]
+                    shared = [new_slots[j] for j in forks[encoded[i]]]
+                    if len(shared) == 0:
+                        continue
+                    length = slot.cached_tokens.size(-1)
+                    self.model.copy_kv_cache(slot.id, torch.tensor([fork.id for fork in shared]), length)
+                    PREFILL_SHARED_TOKENS.inc(sum(length - cache_offsets[j] for j in forks[encoded[i]]))
+                    logger.debug(f"Slots {[fork.id for fork in shared]} share the prompt of slot {slot.id}")
+                    select_slots += shared
+                    logits_rows += [row] * len(shared)
+                generations += self._select_next_tokens(select_slots, logits[logits_rows])
+            logger.debug("Model ready for decoding")
+            return generations
+        # The static KV cache must be rebuilt for all slots
+        prefill_slots = self.slots
+        # Build the padded inputs from the tokens that must be stored in the KV cache of each slot
+        input_ids, attention_mask = self._pad([slot.cached_tokens for slot in prefill_slots])
+        PREFILL_PADDING_TOKENS.inc(int(attention_mask.numel() - attention_mask.sum()))
+        # Each slot must be reset with the padded masks
+        for i, slot in enumerate(prefill_slots):
             if slot.state != slot.state.EMPTY:
-                slot_input_ids = input_ids[i : i + 1, :]
-                # Padded input ids are also required to set logits processors and stopping criterias
-                selector = TokenSelector.create(
-                    slot_input_ids, slot.generation_config, self.model, self.model.max_length
-                )
-                slot_input_ids = slot_input_ids.squeeze().type(torch.int64)
-                slot_attention_mask = attention_mask[i]
-                slot.reset(slot_input_ids, slot_attention_mask, selector)
-        # Clear KV cache
-        self.model.reset_generation()
+                slot.reset(attention_mask[i])
         # Pause previously active slots during generation.
         # Their KV cache will be prefilled but new tokens will be ignored, as they
         # have already been generated and sent back in the last decode.
         for slot in active_slots:
             slot.pause()
-        generation, next_batch = self._generate_token(batch.id, input_ids, attention_mask)
+        with PREPARE_INPUTS_DURATION["prefill"].time():
+            model_inputs = self.model.prepare_inputs_for_prefill(input_ids, attention_mask)
+        generations = self._generate_token(prefill_slots, model_inputs, "prefill")
         # Reactivate previously active slots for the next decode.
         for slot in active_slots:
             slot.resume()
         logger.debug("Model ready for decoding")
-        return generation, next_batch
+        return generations
+
+    def _share_prompts(self, new_slots: List[Slot]) -> Tuple[List[int], Dict[int, List[int]]]:
+        """Identify the new slots whose prompt needs to be encoded (continuous batching only).
+
+        When the KV cache rows of the model can be copied, only the first of the slots sharing the same prompt (e.g.
+        the samples of a `best_of` request) is encoded: its KV cache row is then copied to the other slots.
+
+        Args:
+            new_slots (`List[Slot]`):
+                The slots of the new requests.
+
+        Return:
+            The indices of the slots to encode, and for each of them the indices of the slots sharing its prompt.
+        """
+        encoded = []
+        forks = {}
+        prompts = {}
+        for i, slot in enumerate(new_slots):
+            j = prompts.setdefault(tuple(slot.cached_tokens.tolist()), i) if self.share_prefill else i
+            if j == i:
+                encoded.append(i)
+                forks[i] = []
+            else:
+                forks[j].append(i)
+        return encoded, forks
+
+    def _group_by_length(self, lengths: List[int]) -> List[List[int]]:
+        """Split the new requests into groups that are prefilled separately.
+
+        The requests are sorted by length, and each request is added to the current group as long as the fraction
+        of padding tokens in the group does not exceed `max_prefill_padding`.
+
+        Args:
+            lengths (`List[int]`):
+                The number of tokens to encode for each request.
+
+        Return:
+            The indices of the requests of each group, from the shortest to the longest requests.
+        """
+        groups = []
+        group = []
+        group_tokens = 0
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # The requests of the group are padded to the length of the new request, which is the longest
+            padding = 1 - (group_tokens + lengths[i]) / ((len(group) + 1) * lengths[i])
+            if len(group) > 0 and padding > self.max_prefill_padding:
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            group.append(i)
+            group_tokens += lengths[i]
+        groups.append(group)
+        return groups
+
+    def _prefill_chunk(self) -> List[Generation]:
+        """Encode the next chunk of the prompts being prefilled (continuous batching only).
+
+        The prompts are encoded in order of arrival, within a budget of `prefill_chunk_size` tokens. The slots whose
+        prompt is entirely stored in the KV cache are resumed, and their first token is generated.
+        """
+        budget = self.prefill_chunk_size
+        chunk_slots = []
+        chunk_input_ids = []
+        for slot in self.prefilling:
+            if budget == 0:
+                break
+            offset = self.prefill_lengths[slot.id]
+            input_ids = slot.cached_tokens[offset : offset + budget]
+            budget -= input_ids.size(-1)
+            chunk_slots.append(slot)
+            chunk_input_ids.append(input_ids)
+        if len(chunk_slots) == 0:
+            return []
+        logger.debug(f"Prefilling {self.prefill_chunk_size - budget} prompt token(s) of {len(chunk_slots)} slot(s)")
+        seq_ids = torch.tensor([slot.id for slot in chunk_slots])
+        cache_offsets = torch.tensor([self.prefill_lengths[slot.id] for slot in chunk_slots])
+        for slot, input_ids in zip(chunk_slots, chunk_input_ids):
+            self.prefill_lengths[slot.id] += input_ids.size(-1)
+            if self.prefill_lengths[slot.id] == slot.cached_tokens.size(-1):
+                # The next token is selected from the logits of the last prompt token
+                self.prefilling.remove(slot)
+                slot.resume()
+        input_ids, attention_mask = self._pad(chunk_input_ids)
+        with PREPARE_INPUTS_DURATION["prefill"].time():
+            model_inputs = self.model.prepare_inputs_for_prefill(
+                input_ids, attention_mask, seq_ids, cache_offsets=cache_offsets
+            )
+        return self._generate_token(chunk_slots, model_inputs, "prefill")
 
     def decode(self, batches: List[CachedBatch]) -> Tuple[List[Generation], CachedBatch]:
         """Decode the specified prefilled requests.
@@ -360,92 +784,327 @@ class NeuronGenerator(Generator):
         # just carry on with decoding. We adopt the id of the first
         # batch in the list as our next batch id.
         next_batch_id = batches[0].id
-        # Reconstruct input_ids and attention_mask from slots
-        input_ids = None
-        attention_mask = None
-        for i, slot in enumerate(self.slots):
-            if slot.state != Slot.State.EMPTY:
-                if input_ids is None:
-                    # Create blank inputs covering all slots (even empty ones)
-                    input_ids = torch.full(
-                        [self.model.batch_size, 1], fill_value=self.tokenizer.eos_token_id, dtype=torch.int64
-                    )
-                # input_ids are simply the tokens generated by the last decode or prefill requests (other tokens are cached)
-                input_ids[i, 0] = slot.next_token
-                if attention_mask is None:
-                    # Create default mask covering all slots (even empty ones)
-                    attention_mask = torch.zeros(
-                        [self.model.batch_size, slot.attention_mask.size(-1)], dtype=torch.int64
-                    )
-                    attention_mask[:, -1] = 1
-                attention_mask[i, :] = slot.attention_mask
-        if input_ids is None:
+        # Queued requests are prefilled first if slots have become available
+        generations = self._prefill_queued_requests()
+        active_slots = [slot for slot in self.slots if slot.state == Slot.State.READY]
+        if len(active_slots) > 0:
+            start = time.perf_counter()
+            decode_generations = self._decode_step(active_slots)
+            # Chain additional decode steps to save round-trips with the router until a request finishes. Note that
+            # empty slots (that could be assigned to queued requests) only appear when a request finishes. Chunked
+            # prompts are not left waiting either, so that their encoding stays interleaved with decode steps.
+            for _ in range(self.decode_steps - 1):
+                if len(self.prefilling) > 0:
+                    break
+                if any(generation.generated_text is not None for generation in decode_generations):
+                    break
+                decode_generations += self._decode_step(
+                    [slot for slot in self.slots if slot.state == Slot.State.READY]
+                )
+            DECODE_THROUGHPUT.set(len(decode_generations) / (time.perf_counter() - start))
+            generations += decode_generations
+        elif len(generations) == 0 and len(self.prefilling) == 0:
             raise ValueError("Unable to decode tokens for non-prefilled batches (probably due to a previous failure)")
-        return self._generate_token(next_batch_id, input_ids, attention_mask)
+        self._update_gauges()
+        # Whatever initial batch these requests came from, we always return all pending requests in a single batch
+        return generations, self._cached_batch(next_batch_id, self._pending_request_ids())
+
+    def _decode_step(self, active_slots: List[Slot]) -> List[Generation]:
+        """Generate the next token of the active slots."""
+        if self.draft_model is not None or self.prompt_lookup:
+            max_length = max(slot.tokens.size(-1) for slot in active_slots)
+            # The proposed tokens of all slots must fit in the KV cache
+            if max_length + self.speculation_length <= self.model.max_length:
+                generations = self._speculative_step(active_slots)
+                if generations is not None:
+                    return generations
+        # The batch inputs are updated in place: input_ids are simply the tokens generated by the
+        # last decode or prefill requests (other tokens are cached), and the slot attention masks
+        # are views of the batch attention mask rows.
+        mask_length = max(slot.attention_mask.size(-1) for slot in active_slots)
+        for slot in self.slots:
+            if slot.state != Slot.State.EMPTY:
+                self.input_ids[slot.id, 0] = slot.next_token
+            elif not self.model.continuous_batching:
+                # Empty slots are decoded with the other slots in the static KV cache: their outputs are ignored
+                self.attention_mask[slot.id, mask_length - 1] = 1
+        if self.model.continuous_batching and len(active_slots) < len(self.slots):
+            # Only active slots are decoded, each one at its own position in the KV cache
+            decode_slots = active_slots
+            seq_ids = torch.tensor([slot.id for slot in decode_slots])
+            input_ids = self.input_ids[seq_ids]
+            attention_mask = self.attention_mask[seq_ids, :mask_length]
+        else:
+            # All slots are decoded (for static batching, they share the same position in the KV cache)
+            decode_slots = self.slots
+            seq_ids = self.seq_ids if self.model.continuous_batching else None
+            input_ids = self.input_ids
+            attention_mask = self.attention_mask[:, :mask_length]
+        with PREPARE_INPUTS_DURATION["decode"].time():
+            model_inputs = self.model.prepare_inputs_for_decode(input_ids, attention_mask, seq_ids)
+        return self._generate_token(decode_slots, model_inputs, "decode")
 
-    def _generate_token(
-        self, next_batch_id: int, input_ids: torch.LongTensor, attention_mask: Optional[torch.LongTensor] = None
-    ) -> Tuple[List[Generation], CachedBatch]:
-        model_inputs = self.model.prepare_inputs_for_generation(input_ids, attention_mask)
-        outputs = self.model(
-            **model_inputs,
-            return_dict=True,
-        )
-        generations = []
-        request_ids = []
-        active_slots = False
-        for i, slot in enumerate(self.slots):
-            if slot.state != Slot.State.READY:
-                continue
-            request_id = slot.request_id
-            request_ids.append(request_id)
-            next_token_logits = outputs.logits[i : i + 1, -1, :]
-            slot_input_ids = input_ids[i : i + 1, :]
-            next_token = slot.select(slot_input_ids, next_token_logits)
-            next_token_text = self.tokenizer.decode(next_token)
-            if not slot.generated_text.endswith(" ") and not next_token_text.startswith(" "):
-                # Some tokenizers do not prepend spaces automatically when decoding a single token
-                contextual_text = self.tokenizer.decode([slot.next_token, next_token])
-                if contextual_text[: -len(next_token_text)].endswith(" "):
-                    next_token_text = " " + next_token_text
-            slot.append(next_token, next_token_text)
-            generated_text = None
-            finish_reason = None
-            if next_token == self.tokenizer.eos_token_id:
-                finish_reason = FinishReason.FINISH_REASON_EOS_TOKEN
-            elif slot.stopped:
-                finish_reason = FinishReason.FINISH_REASON_STOP_SEQUENCE
-            if finish_reason is not None:
-                # We must include the generated text for each finished sequence in the response
-                generated_text = GeneratedText(
-                    text=slot.generated_text, generated_tokens=slot.generated_tokens, finish_reason=finish_reason
+    def _speculative_step(self, active_slots: List[Slot]) -> Optional[List[Generation]]:
+        """Generate the next tokens of the active slots by verifying proposed tokens (continuous batching only).
+
+        The draft model or the prompt lookup proposes `speculation_length` tokens for each slot, which are verified
+        at once by the model. Each slot gets the accepted proposed tokens plus one token selected by the model, that
+        follow the same distribution as the tokens generated without speculation.
+
+        The keys and values of the rejected tokens remain in the KV cache rows beyond the length of each
+        slot: they are simply overwritten by the next steps.
+
+        Return:
+            A list of `Generation` for each new token, or `None` if no tokens could be proposed.
+        """
+        k = self.speculation_length
+        seq_ids = torch.tensor([slot.id for slot in active_slots])
+        lengths = torch.tensor([slot.tokens.size(-1) for slot in active_slots])
+        # The tokens of each slot, followed by its proposed tokens
+        token_ids = self.token_ids[seq_ids, : int(lengths.max()) + k].clone()
+        positions = torch.arange(token_ids.shape[-1])[None, :]
+
+        def input_ids_at(step: int) -> torch.LongTensor:
+            # The tokens of each slot followed by its first proposed tokens
+            return token_ids.masked_fill(positions >= (lengths + step)[:, None], -1)
+
+        vocab_size = self.model.config.vocab_size
+        if self.draft_model is not None:
+            # Both models share the same tokenizer, but their logits may be padded differently
+            vocab_size = min(vocab_size, self.draft_model.config.vocab_size)
+            draft_probs = self._propose_draft_tokens(active_slots, token_ids, lengths, input_ids_at, vocab_size)
+            proposed = torch.full([len(active_slots)], fill_value=k)
+        else:
+            proposals = [self.lookup_indices[slot.id].propose(slot.tokens.tolist(), k) for slot in active_slots]
+            if all(len(proposal) == 0 for proposal in proposals):
+                return None
+            # Missing proposed tokens are replaced by padding tokens, that are only accepted if they match
+            token_ids.scatter_(1, lengths[:, None] + torch.arange(k)[None, :], self.tokenizer.pad_token_id)
+            for i, proposal in enumerate(proposals):
+                token_ids[i, lengths[i] : lengths[i] + len(proposal)] = torch.tensor(proposal)
+            proposed = torch.tensor([len(proposal) for proposal in proposals])
+        # The model evaluates the pending token of each slot followed by its proposed tokens
+        verify_ids = torch.gather(token_ids, 1, lengths[:, None] - 1 + torch.arange(k + 1)[None, :])
+        with PREPARE_INPUTS_DURATION["verify"].time():
+            model_inputs = self.model.prepare_inputs_for_prefill(
+                verify_ids, torch.ones_like(verify_ids), seq_ids, cache_offsets=lengths - 1
+            )
+        with FORWARD_DURATION["verify"].time():
+            logits = self.model.speculative_forward(**model_inputs, return_dict=True).logits[:, :, :vocab_size]
+        with TOKEN_SELECTION_DURATION.time():
+            if self.draft_model is not None:
+                target_probs = torch.stack(
+                    [
+                        self.selector.probabilities(logits[:, step, :], input_ids=input_ids_at(step), rows=seq_ids)
+                        for step in range(k + 1)
+                    ],
+                    dim=1,
                 )
-                logger.debug(f"Finished generating tokens for request {request_id}")
-                # mark the slot as available
-                slot.clear()
+                n_accepted, next_tokens = BatchedTokenSelector.accept(verify_ids[:, 1:], draft_probs, target_probs)
             else:
-                active_slots = True
-            generations.append(
-                Generation(
-                    request_id=request_id,
-                    prefill_tokens=None,
-                    token_id=next_token,
-                    token_logprob=None,
-                    token_text=next_token_text,
-                    token_is_special=(next_token in [self.special_tokens]),
-                    generated_text=generated_text,
+                # For proposed tokens that are not sampled, selecting the token of each position and accepting the
+                # proposed tokens as long as they match is equivalent to rejection sampling
+                selected = torch.stack(
+                    [
+                        self.selector.select(logits[:, step, :], input_ids=input_ids_at(step), rows=seq_ids)
+                        for step in range(k + 1)
+                    ],
+                    dim=1,
+                )
+                n_accepted = torch.cumprod((selected[:, :k] == verify_ids[:, 1:]).int(), dim=-1).sum(dim=-1)
+                next_tokens = selected[torch.arange(len(active_slots)), n_accepted]
+        SPECULATION_PROPOSED_TOKENS.inc(int(proposed.sum()))
+        SPECULATION_ACCEPTED_TOKENS.inc(int(torch.minimum(n_accepted, proposed).sum()))
+        SPECULATION_ACCEPTANCE_RATE.set(SPECULATION_ACCEPTED_TOKENS.value / max(SPECULATION_PROPOSED_TOKENS.value, 1))
+        generations = []
+        for i, slot in enumerate(active_slots):
+            accepted = int(n_accepted[i])
+            if self.draft_model is not None:
+                # The last draft token is never stored in the draft KV cache row
+                self.draft_lengths[slot.id] = int(lengths[i]) + min(accepted, k - 1)
+            for next_token in verify_ids[i, 1 : accepted + 1].tolist() + [int(next_tokens[i])]:
+                generations.append(self._append_token(slot, next_token))
+                if slot.state == Slot.State.EMPTY:
+                    # The request is finished: the remaining tokens are discarded
+                    break
+        return generations
+
+    def _propose_draft_tokens(
+        self,
+        active_slots: List[Slot],
+        token_ids: torch.LongTensor,
+        lengths: torch.LongTensor,
+        input_ids_at: Callable[[int], torch.LongTensor],
+        vocab_size: int,
+    ) -> torch.Tensor:
+        """Generate `speculation_length` tokens for each slot with the draft model.
+
+        The draft tokens are stored in the token ids of each slot after its current tokens.
+
+        Return:
+            The `(batch_size, speculation_length, vocab_size)` distributions each draft token was sampled from.
+        """
+        seq_ids = torch.tensor([slot.id for slot in active_slots])
+        # The first draft step also encodes the tokens that are not yet stored in the draft KV cache rows
+        cache_offsets = torch.tensor([self.draft_lengths[slot.id] for slot in active_slots])
+        draft_inputs = [slot.tokens[offset:] for slot, offset in zip(active_slots, cache_offsets.tolist())]
+        draft_probs = []
+        for step in range(self.speculation_length):
+            input_ids, attention_mask = self._pad(draft_inputs)
+            with PREPARE_INPUTS_DURATION["draft"].time():
+                model_inputs = self.draft_model.prepare_inputs_for_prefill(
+                    input_ids, attention_mask, seq_ids, cache_offsets=cache_offsets
                 )
+            with FORWARD_DURATION["draft"].time():
+                logits = self.draft_model(**model_inputs, return_dict=True).logits[:, -1, :vocab_size]
+            with TOKEN_SELECTION_DURATION.time():
+                probs = self.selector.probabilities(logits, input_ids=input_ids_at(step), rows=seq_ids)
+                draft_tokens = torch.multinomial(probs, num_samples=1)
+            token_ids.scatter_(1, (lengths + step)[:, None], draft_tokens)
+            draft_probs.append(probs)
+            draft_inputs = list(draft_tokens)
+            cache_offsets = lengths + step
+        return torch.stack(draft_probs, dim=1)
+
+    def _generate_token(
+        self, slots: List[Slot], model_inputs: Dict[str, torch.Tensor], phase: str
+    ) -> List[Generation]:
+        """Evaluate the model and select the next token of each slot.
+
+        Args:
+            slots (`List[Slot]`):
+                The slots corresponding to each row of the model inputs.
+            model_inputs (`Dict[str, torch.Tensor]`):
+                The model inputs, as returned by `prepare_inputs_for_prefill` or `prepare_inputs_for_decode`.
+            phase (`str`):
+                The generation phase (`prefill` or `decode`), used to record metrics.
+
+        Return:
+            A list of `Generation` for each ready slot.
+        """
+        return self._select_next_tokens(slots, self._forward(slots, model_inputs, phase))
+
+    def _forward(self, slots: List[Slot], model_inputs: Dict[str, torch.Tensor], phase: str) -> torch.Tensor:
+        """Evaluate the model and return the `(batch_size, vocab_size)` logits of the next token of each row."""
+        start = time.time_ns()
+        with FORWARD_DURATION[phase].time():
+            outputs = self.model(
+                **model_inputs,
+                return_dict=True,
             )
-        batch = None
-        if active_slots:
-            # Whatever initial batch these requests came from, we always return all pending requests in a single batch
-            batch = self._cached_batch(next_batch_id, request_ids)
-        else:
-            logger.debug("No more pending requests")
-        return generations, batch
+        if phase == "prefill":
+            TRACER.prefill(
+                [slot.request_id for slot in slots if slot.state != Slot.State.EMPTY],
+                start,
+                time.time_ns(),
+                batch_size=len(slots),
+                input_tokens=model_inputs["input_ids"].numel(),
+            )
+        return outputs.logits[:, -1, :]
 
-    def _cached_batch(self, batch_id: int, request_ids: List):
+    def _select_next_tokens(self, slots: List[Slot], logits: torch.Tensor) -> List[Generation]:
+        """Select the next token of each ready slot from the logits of the corresponding row."""
+        generations = []
+        ready_indices = [i for i, slot in enumerate(slots) if slot.state == Slot.State.READY]
+        if len(ready_indices) == 0:
+            return generations
+        ready_slots = [slots[i] for i in ready_indices]
+        # Select the next tokens of all ready slots at once, each slot with its own generation parameters
+        rows = torch.tensor([slot.id for slot in ready_slots])
+        max_length = max(slot.tokens.size(-1) for slot in ready_slots)
+        with TOKEN_SELECTION_DURATION.time():
+            next_tokens = self.selector.select(
+                logits[ready_indices], input_ids=self.token_ids[rows, :max_length], rows=rows
+            ).tolist()
+        return [self._append_token(slot, next_token) for slot, next_token in zip(ready_slots, next_tokens)]
+
+    def _append_token(self, slot: Slot, next_token: int) -> Generation:
+        """Append a new token to a slot, releasing the slot if its request is finished.
+
+        Args:
+            slot (`Slot`):
+                The slot of the request.
+            next_token (`int`):
+                The new token.
+
+        Return:
+            The `Generation` of the new token.
+        """
+        GENERATED_TOKENS.inc()
+        request_id = slot.request_id
+        TRACER.token(request_id)
+        with DETOKENIZATION_DURATION.time():
+            next_token_text = slot.append(next_token)
+        generated_text = None
+        finish_reason = None
+        if next_token == self.tokenizer.eos_token_id:
+            finish_reason = FinishReason.FINISH_REASON_EOS_TOKEN
+        elif slot.stopped:
+            finish_reason = FinishReason.FINISH_REASON_STOP_SEQUENCE
+        elif slot.attention_mask.size(-1) >= self.model.max_length:
+            # The pending token cannot be stored in the KV cache
+            finish_reason = FinishReason.FINISH_REASON_LENGTH
+        if finish_reason is not None:
+            # We must include the generated text for each finished sequence in the response
+            generated_text = GeneratedText(
+                text=self.tokenizer.decode(slot.generated_ids, skip_special_tokens=True),
+                generated_tokens=slot.generated_tokens,
+                finish_reason=finish_reason,
+            )
+            logger.debug(f"Finished generating tokens for request {request_id}")
+            TRACER.finished(
+                request_id, FINISH_REASONS[finish_reason], generated_tokens=generated_text.generated_tokens
+            )
+            # mark the slot as available
+            self._release(slot)
+        return Generation(
+            request_id=request_id,
+            prefill_tokens=None,
+            token_id=next_token,
+            token_logprob=None,
+            token_text=next_token_text,
+            token_is_special=(next_token in self.special_tokens),
+            generated_text=generated_text,
+        )
+
+    def _tokenize(self, request: Request) -> torch.LongTensor:
+        """Tokenize the request inputs, keeping only the last tokens if they do not fit in the model."""
+        input_ids = self.tokenizer(request.inputs, return_tensors="pt").input_ids[0]
+        max_input_length = self.model.max_length - 1
+        if request.truncate > 0:
+            max_input_length = min(request.truncate, max_input_length)
+        return input_ids[-max_input_length:]
+
+    def _pad(self, slot_input_ids: List[torch.LongTensor]) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """Left-pad the token ids of several slots into a single batch.
+
+        Empty sequences are replaced by a single padding token.
+        """
+        seq_length = max(max(input_ids.size(-1) for input_ids in slot_input_ids), 1)
+        input_ids = torch.full(
+            [len(slot_input_ids), seq_length], fill_value=self.tokenizer.pad_token_id, dtype=torch.int64
+        )
+        attention_mask = torch.zeros([len(slot_input_ids), seq_length], dtype=torch.int64)
+        attention_mask[:, -1] = 1
+        for i, ids in enumerate(slot_input_ids):
+            if ids.size(-1) > 0:
+                input_ids[i, -ids.size(-1) :] = ids
+                attention_mask[i, -ids.size(-1) :] = 1
+        return input_ids, attention_mask
+
+    def _pending_request_ids(self, request_ids: Optional[List[int]] = None) -> List[int]:
+        """Return the ids of the requests being generated or queued, optionally restricted to a list of requests."""
+        pending_ids = [slot.request_id for slot in self.slots if slot.state != Slot.State.EMPTY]
+        pending_ids += [request.id for request in self.queue]
+        if request_ids is None:
+            return pending_ids
+        return [request_id for request_id in request_ids if request_id in pending_ids]
+
+    def _cached_batch(self, batch_id: int, request_ids: List) -> Optional[CachedBatch]:
         size = len(request_ids)
+        if size == 0:
+            logger.debug("No more pending requests")
+            return None
         max_tokens = size * self.model.max_length
         return CachedBatch(id=batch_id, request_ids=request_ids, size=size, max_tokens=max_tokens)
 
@@ -472,13 +1131,44 @@ class NeuronGenerator(Generator):
         for slot in self.slots:
             if slot.state != Slot.State.EMPTY and slot.request_id not in request_ids:
                 logger.debug(f"Removing request {slot.request_id}")
-                slot.clear()
+                TRACER.finished(slot.request_id, "cancelled", generated_tokens=slot.generated_tokens)
+                self._release(slot)
+        for request in [request for request in self.queue if request.id not in request_ids]:
+            logger.debug(f"Removing queued request {request.id}")
+            TRACER.finished(request.id, "cancelled")
+            self.queue.remove(request)
+        self._update_gauges()
+
+    def _release(self, slot: Slot):
+        """Clear a slot, keeping track of the tokens still stored in its KV cache row to reuse them."""
+        cached_tokens = slot.cached_tokens
+        if slot.state == Slot.State.PREFILL:
+            # Only the first chunks of the prompt are stored in the KV cache row
+            cached_tokens = cached_tokens[: self.prefill_lengths[slot.id]]
+            self.prefilling.remove(slot)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(slot.id, cached_tokens.tolist())
+        slot.clear()
+
+    def _update_gauges(self):
+        ACTIVE_SLOTS.set(sum(slot.state != Slot.State.EMPTY for slot in self.slots))
+        QUEUE_DEPTH.set(len(self.queue))
 
     @classmethod
     def from_pretrained(
         cls,
         model_id: str,
         revision: Optional[str],
+        cpu_model_kwargs: Optional[Dict[str, Any]] = None,
+        decode_steps: int = 1,
+        prefix_cache: bool = False,
+        draft_model_id: Optional[str] = None,
+        speculation_length: int = 4,
+        prompt_lookup: bool = False,
+        prefill_chunk_size: Optional[int] = None,
+        max_prefill_padding: float = 1.0,
+        regex: Optional[str] = None,
+        json_schema: Optional[Union[str, Dict[str, Any]]] = None,
     ):
         """Instantiate a NeuronGenerator.
 
@@ -488,11 +1178,61 @@ class NeuronGenerator(Generator):
                 In either case, the hub or local path must also contain a Tokenizer.
             revision (`str`):
                 The revision of the model on the HuggingFace hub.
+            cpu_model_kwargs (`Optional[Dict[str, Any]]`, defaults to `None`):
+                If specified, the model is a regular transformers model instantiated on CPU as a
+                `CPUModelForCausalLM` stand-in with these parameters, instead of a neuron model.
+            decode_steps (`int`, defaults to 1):
+                The maximum number of tokens generated for each request by a single call to `decode`.
+            prefix_cache (`bool`, defaults to `False`):
+                Whether new requests should reuse the cached tokens of previous requests sharing the same prefix.
+            draft_model_id (`Optional[str]`, defaults to `None`):
+                The *model_id* of a smaller model sharing the same tokenizer, used for speculative decoding.
+            speculation_length (`int`, defaults to 4):
+                The number of tokens proposed by the draft model or the prompt lookup at each decode step.
+            prompt_lookup (`bool`, defaults to `False`):
+                Whether the verified tokens should be proposed by looking up the last tokens of each request in its prompt.
+            prefill_chunk_size (`Optional[int]`, defaults to `None`):
+                If specified, the maximum number of prompt tokens encoded by each call to `prefill` or `decode`.
+            max_prefill_padding (`float`, defaults to 1.0):
+                The maximum fraction of padding tokens in the inputs of a prefill forward.
+            regex (`Optional[str]`, defaults to `None`):
+                If specified, a regular expression the generated text of all requests must match.
+            json_schema (`Optional[Union[str, Dict[str, Any]]]`, defaults to `None`):
+                If specified, a JSON schema the generated text of all requests must follow.
 
         Returns:
             A NeuronGenerator.
         """
-        model_path = fetch_model(model_id, revision)
-        model = NeuronModelForCausalLM.from_pretrained(model_path, revision=revision)
+        model = cls._load_model(model_id, revision, cpu_model_kwargs)
+        draft_model = None
+        if draft_model_id is not None:
+            draft_model = cls._load_model(draft_model_id, None, cpu_model_kwargs)
         tokenizer = AutoTokenizer.from_pretrained(model_id, revision=revision)
-        return cls(model, tokenizer)
+        if regex is not None and json_schema is not None:
+            raise ValueError("The generated text can be constrained either by a regex or by a JSON schema, not both.")
+        fsm_index = None
+        if regex is not None:
+            fsm_index = FSMIndex.from_regex(regex, tokenizer)
+        elif json_schema is not None:
+            fsm_index = FSMIndex.from_json_schema(json_schema, tokenizer)
+        return cls(
+            model,
+            tokenizer,
+            decode_steps,
+            prefix_cache,
+            draft_model,
+            speculation_length,
+            prompt_lookup,
+            prefill_chunk_size,
+            max_prefill_padding,
+            fsm_index,
+        )
+
+    @staticmethod
+    def _load_model(
+        model_id: str, revision: Optional[str], cpu_model_kwargs: Optional[Dict[str, Any]]
+    ) -> Union[NeuronModelForCausalLM, CPUModelForCausalLM]:
+        if cpu_model_kwargs is not None:
+            return CPUModelForCausalLM.from_pretrained(model_id, revision, **cpu_model_kwargs)
+        model_path = fetch_model(model_id, revision)
+        return NeuronModelForCausalLM.from_pretrained(model_path, revision=revision)
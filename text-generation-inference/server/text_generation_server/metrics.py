@@ -0,0 +1,246 @@
+"""A minimal metrics registry for the inference server.
+
+Metrics are recorded in-process at a negligible cost (a few python operations per observation), and can
+be exposed using the Prometheus text exposition format either on a local HTTP port or in a file.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _format_labels(labels: Dict[str, str], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class Metric:
+    """Base class of a metric series, identified by its name and labels."""
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A monotonically increasing value."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        super().__init__(name, help, labels)
+        self.value = 0
+
+    def inc(self, value: float = 1):
+        self.value += value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels)} {self.value}"]
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        super().__init__(name, help, labels)
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels)} {self.value}"]
+
+
+class Histogram(Metric):
+    """The distribution of observed values (typically durations in seconds) in fixed buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Optional[Dict[str, str]] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # The last count corresponds to the implicit +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of a block of code."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> List[str]:
+        samples = []
+        cumulated = 0
+        counts = list(self.counts)
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulated += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append(f"{self.name}_bucket{_format_labels(self.labels, ('le', le))} {cumulated}")
+        samples.append(f"{self.name}_sum{_format_labels(self.labels)} {self.sum}")
+        samples.append(f"{self.name}_count{_format_labels(self.labels)} {cumulated}")
+        return samples
+
+
+class MetricsRegistry:
+    """A collection of metrics that can be exposed using the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Tuple], Metric] = {}
+
+    def _get_or_create(self, cls, name: str, help: str, labels: Optional[Dict[str, str]] = None, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = cls(name, help, labels, **kwargs)
+            self._metrics[key] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Optional[Dict[str, str]] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def expose(self) -> str:
+        """Return all metrics using the Prometheus text exposition format."""
+        lines = []
+        names = set()
+        for metric in sorted(self._metrics.values(), key=lambda metric: metric.name):
+            if metric.name not in names:
+                names.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def start_http_server(port: int, addr: str = "127.0.0.1", registry: MetricsRegistry = REGISTRY) -> ThreadingHTTPServer:
+    """Expose the metrics of a registry on a local HTTP port, in a background thread.
+
+    Args:
+        port (`int`):
+            The HTTP port.
+        addr (`str`, defaults to `127.0.0.1`):
+            The address to bind.
+        registry (`MetricsRegistry`):
+            The registry of the metrics to expose.
+
+    Returns:
+        The HTTP server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            content = registry.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            # Do not pollute the server logs with each scrape
+            pass
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Metrics exposed on http://{addr}:{port}/metrics")
+    return server
+
+
+def start_file_sink(path: str, interval: float = 10.0, registry: MetricsRegistry = REGISTRY) -> threading.Thread:
+    """Periodically write the metrics of a registry to a file, in a background thread.
+
+    The file is replaced atomically, so that it can be read at any time (e.g. by the node exporter textfile collector).
+
+    Args:
+        path (`str`):
+            The path of the metrics file.
+        interval (`float`, defaults to 10.0):
+            The interval in seconds between two updates of the file.
+        registry (`MetricsRegistry`):
+            The registry of the metrics to write.
+
+    Returns:
+        The background thread.
+    """
+
+    def write_metrics():
+        while True:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(registry.expose())
+            os.replace(tmp_path, path)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=write_metrics, name="metrics-file", daemon=True)
+    thread.start()
+    logger.info(f"Metrics written to {path} every {interval} seconds")
+    return thread
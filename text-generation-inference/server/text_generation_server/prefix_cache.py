@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+
+class _Node:
+    """A node of the radix tree.
+
+    Each node corresponds to a sequence of tokens (the concatenation of the edges from the root),
+    and keeps track of the ids of all the KV cache rows whose tokens start with this sequence.
+    """
+
+    __slots__ = ("edge", "children", "row_ids")
+
+    def __init__(self, edge: Tuple[int, ...] = ()):
+        self.edge = edge
+        self.children: Dict[int, "_Node"] = {}
+        self.row_ids: Set[int] = set()
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class PrefixCache:
+    """Index the tokens stored in KV cache rows that are not assigned to any request.
+
+    When a request is finished, the keys and values of its tokens are still stored in its KV cache row.
+    If a new request shares a prefix with these tokens (typically a system prompt), it can be assigned
+    to the same row and only its remaining tokens need to be encoded.
+
+    The tokens of the free rows are indexed in a radix tree, so that the row sharing the longest
+    prefix with a new request can be found in a time proportional to the length of the request.
+    When no free row shares a prefix with a new request, the least recently released row is evicted.
+
+    The cache also keeps track of its hit rate and of the number of tokens that did not need to be encoded.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._tokens: Dict[int, Tuple[int, ...]] = {}
+        # Cached rows, from the least recently released to the most recently released
+        self._lru: OrderedDict = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.saved_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def insert(self, row_id: int, token_ids: Sequence[int]):
+        """Index the tokens stored in a KV cache row that has been released.
+
+        Args:
+            row_id (`int`):
+                The index of the KV cache row.
+            token_ids (`Sequence[int]`):
+                The tokens whose keys and values are stored in the row.
+        """
+        self.remove(row_id)
+        token_ids = tuple(token_ids)
+        self._tokens[row_id] = token_ids
+        self._lru[row_id] = None
+        node = self._root
+        node.row_ids.add(row_id)
+        position = 0
+        while position < len(token_ids):
+            child = node.children.get(token_ids[position])
+            if child is None:
+                # Add a leaf with the remaining tokens
+                child = _Node(token_ids[position:])
+                node.children[token_ids[position]] = child
+                child.row_ids.add(row_id)
+                return
+            length = _common_prefix_length(child.edge, token_ids[position:])
+            if length < len(child.edge):
+                # Split the edge of the child at the end of the common prefix
+                split = _Node(child.edge[:length])
+                split.row_ids = set(child.row_ids)
+                child.edge = child.edge[length:]
+                split.children[child.edge[0]] = child
+                node.children[split.edge[0]] = split
+                child = split
+            child.row_ids.add(row_id)
+            node = child
+            position += length
+
+    def remove(self, row_id: int):
+        """Remove a KV cache row from the index.
+
+        Args:
+            row_id (`int`):
+                The index of the KV cache row.
+        """
+        token_ids = self._tokens.pop(row_id, None)
+        if token_ids is None:
+            return
+        del self._lru[row_id]
+        node = self._root
+        node.row_ids.discard(row_id)
+        position = 0
+        while position < len(token_ids):
+            child = node.children[token_ids[position]]
+            child.row_ids.discard(row_id)
+            if len(child.row_ids) == 0:
+                # No other row goes through this branch
+                del node.children[token_ids[position]]
+                return
+            node = child
+            position += len(child.edge)
+
+    def match(self, token_ids: Sequence[int]) -> Tuple[int, Optional[int]]:
+        """Find the cached row sharing the longest prefix with a sequence of tokens.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                The tokens of the sequence.
+
+        Returns:
+            The length of the longest common prefix and the index of the corresponding row
+            (or `None` if no row shares a prefix with the sequence).
+        """
+        node = self._root
+        position = 0
+        while position < len(token_ids):
+            child = node.children.get(token_ids[position])
+            if child is None:
+                break
+            length = _common_prefix_length(child.edge, token_ids[position:])
+            node = child
+            position += length
+            if length < len(child.edge):
+                break
+        if position == 0:
+            return 0, None
+        # All the rows going through the last node share the same prefix: return the most recently released
+        row_id = next(row_id for row_id in reversed(self._lru) if row_id in node.row_ids)
+        return position, row_id
+
+    def acquire(self, token_ids: Sequence[int], row_ids: List[int]) -> Tuple[int, int]:
+        """Select the free KV cache row to assign to a new sequence.
+
+        The selected row is removed from the cache, since its content will be overwritten.
+
+        Args:
+            token_ids (`Sequence[int]`):
+                The tokens of the new sequence.
+            row_ids (`List[int]`):
+                The indices of all the free rows (including rows that are not cached).
+
+        Returns:
+            The index of the selected row and the number of tokens of the sequence already stored in the row.
+        """
+        self.lookups += 1
+        prefix_length, row_id = self.match(token_ids)
+        # At least the last token of the sequence must be encoded to obtain the logits of the next token
+        prefix_length = min(prefix_length, len(token_ids) - 1)
+        if row_id is None or row_id not in row_ids or prefix_length <= 0:
+            prefix_length = 0
+            # Prefer rows that are not cached, then evict the least recently released row
+            uncached_row_ids = [row_id for row_id in row_ids if row_id not in self._tokens]
+            if len(uncached_row_ids) > 0:
+                row_id = uncached_row_ids[0]
+            else:
+                row_id = next(row_id for row_id in self._lru if row_id in row_ids)
+        else:
+            self.hits += 1
+            self.saved_tokens += prefix_length
+        self.remove(row_id)
+        return row_id, prefix_length
+
+    @property
+    def hit_rate(self) -> float:
+        return 0.0 if self.lookups == 0 else self.hits / self.lookups
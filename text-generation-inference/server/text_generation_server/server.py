@@ -1,20 +1,41 @@
 import asyncio
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 from grpc import aio
 from grpc_reflection.v1alpha import reflection
 from loguru import logger
+from transformers import AutoConfig
 
 from .generator import Generator, NeuronGenerator
 from .interceptor import ExceptionInterceptor
+from .metrics import start_file_sink, start_http_server
+from .model import fetch_model
 from .pb import generate_pb2, generate_pb2_grpc
+from .tracing import TRACER
 
 
 class TextGenerationService(generate_pb2_grpc.TextGenerationServiceServicer):
+    """The gRPC service exposing a Generator to the router.
+
+    The generator methods are blocking calls to the model: they are all submitted to a single dedicated
+    thread, so that they are executed in the order they were received without blocking the event loop.
+    This allows control-plane requests (e.g. `Health` or `Info`) to be served while the model is busy.
+    """
+
     def __init__(self, generator: Generator, server_urls: List[str]):
         self.generator = generator
         self.server_urls = server_urls
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+
+    async def _run(self, method: Callable, *args):
+        """Run a generator method in the model thread and wait for its result"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
 
     async def Info(self, request, context):
         return self.generator.info
@@ -28,23 +49,23 @@ class TextGenerationService(generate_pb2_grpc.TextGenerationServiceServicer):
     async def ClearCache(self, request, context):
         if request.HasField("id"):
             logger.warning(f"Clearing all batches instead of batch {request.id} only.")
-        self.generator.clear()
+        await self._run(self.generator.clear)
         return generate_pb2.ClearCacheResponse()
 
     async def FilterBatch(self, request, context):
-        filtered_batch = self.generator.filter(request.batch_id, request.request_ids)
+        filtered_batch = await self._run(self.generator.filter, request.batch_id, request.request_ids)
         return generate_pb2.FilterBatchResponse(batch=filtered_batch)
 
     async def Warmup(self, request, context):
-        max_tokens = self.generator.warmup(request.batch)
+        max_tokens = await self._run(self.generator.warmup, request.batch)
         return generate_pb2.WarmupResponse(max_supported_total_tokens=max_tokens)
 
     async def Prefill(self, request, context):
-        generations, batch = self.generator.prefill(request.batch)
+        generations, batch = await self._run(self.generator.prefill, request.batch)
         return generate_pb2.PrefillResponse(generations=generations, batch=batch)
 
     async def Decode(self, request, context):
-        generations, batch = self.generator.decode(request.batches)
+        generations, batch = await self._run(self.generator.decode, request.batches)
         return generate_pb2.DecodeResponse(generations=generations, batch=batch)
 
 
@@ -52,22 +73,112 @@ def serve(
     model_id: str,
     revision: Optional[str],
     uds_path: Path,
+    replicas: int = 1,
+    cores_per_replica: Optional[int] = None,
+    cpu_model_kwargs: Optional[Dict[str, Any]] = None,
+    decode_steps: int = 1,
+    metrics_port: Optional[int] = None,
+    metrics_file: Optional[str] = None,
+    prefix_cache: bool = False,
+    draft_model_id: Optional[str] = None,
+    speculation_length: int = 4,
+    prompt_lookup: bool = False,
+    prefill_chunk_size: Optional[int] = None,
+    max_prefill_padding: float = 1.0,
+    regex: Optional[str] = None,
+    json_schema: Optional[str] = None,
+    trace_file: Optional[str] = None,
+    trace_endpoint: Optional[str] = None,
+    trace_sample_rate: float = 0.1,
 ):
-    async def serve_inner(model_id: str, revision: Optional[str]):
-        unix_socket_template = "unix://{}-{}"
-        local_url = unix_socket_template.format(uds_path, 0)
-        server_urls = [local_url]
+    """Serve a model on one or several unix sockets.
+
+    Each replica of the model is served by its own generator in a dedicated process, bound to
+    its own set of NeuronCores and exposed on its own socket. The `ServiceDiscovery` response of each
+    replica only lists its own socket: the router treats all listed sockets as shards of a single model,
+    so each replica must be driven by its own router (e.g. behind a load balancer). In particular, the router
+    started by the text-generation-launcher only drives the replica of rank 0: the router of the replica of
+    rank `i` must be started with `--master-shard-uds-path {uds_path}-{i}`.
+
+    Args:
+        model_id (`str`):
+            The *model_id* of a model on the HuggingFace hub or the path to a local model.
+        revision (`Optional[str]`):
+            The revision of the model on the HuggingFace hub.
+        uds_path (`Path`):
+            The prefix of the unix sockets: the replica of rank `i` is exposed on `unix://{uds_path}-{i}`.
+        replicas (`int`, defaults to 1):
+            The number of model replicas.
+        cores_per_replica (`Optional[int]`, defaults to `None`):
+            The number of NeuronCores of each replica. Defaults to the number of cores the model was exported for.
+        cpu_model_kwargs (`Optional[Dict[str, Any]]`, defaults to `None`):
+            If specified, each replica uses a CPU stand-in model instantiated with these parameters.
+        decode_steps (`int`, defaults to 1):
+            The maximum number of tokens generated for each request by a single `Decode` call.
+        metrics_port (`Optional[int]`, defaults to `None`):
+            If specified, the metrics of the replica of rank `i` are exposed on the local HTTP port `metrics_port + i`.
+        metrics_file (`Optional[str]`, defaults to `None`):
+            If specified, the metrics are periodically written to this file (suffixed by the rank for several replicas).
+        prefix_cache (`bool`, defaults to `False`):
+            Whether new requests should reuse the cached tokens of previous requests sharing the same prefix.
+        draft_model_id (`Optional[str]`, defaults to `None`):
+            If specified, a smaller model sharing the same tokenizer used for speculative decoding.
+        speculation_length (`int`, defaults to 4):
+            The number of tokens proposed by the draft model or the prompt lookup at each decode step.
+        prompt_lookup (`bool`, defaults to `False`):
+            Whether the verified tokens should be proposed by looking up the last tokens of each request in its prompt.
+        prefill_chunk_size (`Optional[int]`, defaults to `None`):
+            If specified, the maximum number of prompt tokens encoded by each `Prefill` or `Decode` call.
+        max_prefill_padding (`float`, defaults to 1.0):
+            The maximum fraction of padding tokens in the inputs of a prefill forward.
+        regex (`Optional[str]`, defaults to `None`):
+            If specified, a regular expression the generated text of all requests must match.
+        json_schema (`Optional[str]`, defaults to `None`):
+            If specified, a serialized JSON schema the generated text of all requests must follow.
+        trace_file (`Optional[str]`, defaults to `None`):
+            If specified, the request traces are appended to this file (suffixed by the rank for several replicas).
+        trace_endpoint (`Optional[str]`, defaults to `None`):
+            If specified, the request traces are posted to this OTLP/HTTP traces endpoint.
+        trace_sample_rate (`float`, defaults to 0.1):
+            The fraction of the requests that are traced.
+    """
+    unix_socket_template = "unix://{}-{}"
+    server_urls = [unix_socket_template.format(uds_path, rank) for rank in range(replicas)]
+
+    async def serve_inner(rank: int):
+        local_url = server_urls[rank]
+
+        if metrics_port is not None:
+            start_http_server(metrics_port + rank)
+        if metrics_file is not None:
+            start_file_sink(metrics_file if replicas == 1 else f"{metrics_file}.{rank}")
+        if trace_file is not None or trace_endpoint is not None:
+            trace_path = trace_file if trace_file is None or replicas == 1 else f"{trace_file}.{rank}"
+            TRACER.start_export(trace_path, trace_endpoint, trace_sample_rate, **{"replica.rank": rank})
 
         try:
-            generator = NeuronGenerator.from_pretrained(model_id, revision)
+            generator = NeuronGenerator.from_pretrained(
+                model_id,
+                revision,
+                cpu_model_kwargs,
+                decode_steps,
+                prefix_cache,
+                draft_model_id,
+                speculation_length,
+                prompt_lookup,
+                prefill_chunk_size,
+                max_prefill_padding,
+                regex,
+                json_schema,
+            )
         except Exception:
             logger.exception("Error when initializing model")
             raise
 
         server = aio.server(interceptors=[ExceptionInterceptor()])
-        generate_pb2_grpc.add_TextGenerationServiceServicer_to_server(
-            TextGenerationService(generator, server_urls), server
-        )
+        # Only the local socket is advertised: the other replicas are not shards of this model
+        service = TextGenerationService(generator, [local_url])
+        generate_pb2_grpc.add_TextGenerationServiceServicer_to_server(service, server)
         SERVICE_NAMES = (
             generate_pb2.DESCRIPTOR.services_by_name["TextGenerationService"].full_name,
             reflection.SERVICE_NAME,
@@ -84,5 +195,69 @@ def serve(
         except KeyboardInterrupt:
             logger.info("Signal received. Shutting down")
             await server.stop(0)
+        finally:
+            service.executor.shutdown(wait=False)
+
+    if replicas == 1:
+        asyncio.run(serve_inner(0))
+        return
+
+    if cpu_model_kwargs is None and cores_per_replica is None:
+        # Fetch the model only once before starting the replicas
+        config = AutoConfig.from_pretrained(fetch_model(model_id, revision))
+        cores_per_replica = config.neuron["num_cores"]
+
+    logger.warning(
+        f"Each replica must be driven by its own router: a single router only drives the replica exposed on"
+        f" {server_urls[0]}."
+    )
+    _run_replicas(lambda rank: asyncio.run(serve_inner(rank)), replicas, cores_per_replica)
+
+
+def _visible_cores(rank: int, cores_per_replica: int) -> str:
+    """Return the range of NeuronCores of the replica of the specified rank, as expected by the neuron runtime."""
+    first_core = rank * cores_per_replica
+    return f"{first_core}-{first_core + cores_per_replica - 1}"
+
+
+def _run_replicas(serve_replica: Callable[[int], None], replicas: int, cores_per_replica: Optional[int]):
+    """Run each replica in its own forked process, until any of them terminates.
+
+    Args:
+        serve_replica (`Callable[[int], None]`):
+            The function serving the replica of the specified rank.
+        replicas (`int`):
+            The number of replicas.
+        cores_per_replica (`Optional[int]`):
+            If specified, the neuron runtime of each replica only sees its own group of this number of NeuronCores.
+    """
+
+    def run(rank: int):
+        if cores_per_replica is not None:
+            visible_cores = _visible_cores(rank, cores_per_replica)
+            os.environ["NEURON_RT_VISIBLE_CORES"] = visible_cores
+            logger.info(f"Replica {rank} bound to NeuronCores {visible_cores}")
+        serve_replica(rank)
 
-    asyncio.run(serve_inner(model_id, revision))
+    if cores_per_replica is not None and "NEURON_RT_VISIBLE_CORES" in os.environ:
+        logger.warning("NEURON_RT_VISIBLE_CORES is ignored: each replica is bound to its own NeuronCores.")
+    # The replica processes are forked, so that they inherit the logger configuration.
+    # This is safe because the neuron runtime is only initialized in the replicas.
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=run, args=(rank,), name=f"replica-{rank}") for rank in range(replicas)]
+    for process in processes:
+        process.start()
+    try:
+        # If any replica terminates, the others are terminated too
+        wait([process.sentinel for process in processes])
+    except KeyboardInterrupt:
+        logger.info("Signal received. Shutting down")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+    failed = [process.name for process in processes if process.exitcode not in (0, -signal.SIGTERM)]
+    if len(failed) > 0:
+        raise RuntimeError(f"Model replica(s) {', '.join(failed)} failed.")
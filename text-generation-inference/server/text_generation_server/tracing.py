@@ -0,0 +1,237 @@
+"""A minimal request tracer for the inference server.
+
+A sample of the requests are traced from the moment they reach the generator until they are finished: the trace of
+a request contains a root span covering its whole lifetime, a span for its wait in the queue, a span for each
+prefill forward encoding its prompt (with the composition of the prefilled batch), a span for each prefill of other
+requests pausing its generation, and an event for each generated token.
+
+Finished traces are exported in the OpenTelemetry protocol JSON encoding, one `ExportTraceServiceRequest` per line,
+either to a local file (as the `file` exporter of the OpenTelemetry collector) or to an OTLP/HTTP collector endpoint.
+The export happens in a background thread, so that the generator is never blocked.
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+
+def _attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Encode attributes as OTLP JSON key values."""
+
+    def encode(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        if isinstance(value, (list, tuple)):
+            return {"arrayValue": {"values": [encode(item) for item in value]}}
+        return {"stringValue": str(value)}
+
+    return [{"key": key, "value": encode(value)} for key, value in attributes.items() if value is not None]
+
+
+class _Span:
+    def __init__(self, trace_id: str, name: str, start: int, parent_id: Optional[str] = None, **attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+        self.events = []
+
+    def to_json(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": _attributes(self.attributes),
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if len(self.events) > 0:
+            span["events"] = [
+                {"timeUnixNano": str(timestamp), "name": name, "attributes": _attributes(attributes)}
+                for timestamp, name, attributes in self.events
+            ]
+        return span
+
+
+class _Trace:
+    def __init__(self, request_id: int, **attributes):
+        now = time.time_ns()
+        self.root = _Span(os.urandom(16).hex(), "request", now, **{"request.id": request_id}, **attributes)
+        self.queue = self.child("queue", now)
+        self.spans = [self.queue]
+        self.last_token = None
+
+    def child(self, name: str, start: int, **attributes) -> _Span:
+        return _Span(self.root.trace_id, name, start, self.root.span_id, **attributes)
+
+
+class RequestTracer:
+    """Record the trace of a sample of the requests, and export the finished traces.
+
+    The tracer is disabled until an exporter is configured: all methods are then no-ops, and for requests that are
+    not sampled they only cost a dictionary lookup.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.resource = {}
+        self._traces: Dict[int, _Trace] = {}
+        self._exports: Optional[queue.Queue] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._exports is not None
+
+    def start_export(
+        self,
+        path: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        sample_rate: float = 0.1,
+        **resource_attributes,
+    ) -> threading.Thread:
+        """Start exporting finished traces in a background thread.
+
+        Args:
+            path (`Optional[str]`, defaults to `None`):
+                If specified, the traces are appended to this file as OTLP JSON lines.
+            endpoint (`Optional[str]`, defaults to `None`):
+                If specified, the traces are posted to this OTLP/HTTP traces endpoint
+                (e.g. `http://localhost:4318/v1/traces`).
+            sample_rate (`float`, defaults to 0.1):
+                The fraction of the requests that are traced.
+            resource_attributes:
+                Additional attributes of the resource producing the traces (e.g. the replica rank).
+
+        Returns:
+            The background thread.
+        """
+        if path is None and endpoint is None:
+            raise ValueError("The traces must be exported to a file or to a collector endpoint.")
+        if sample_rate < 0 or sample_rate > 1:
+            raise ValueError("The trace sample rate must be a fraction between 0 and 1.")
+        self.sample_rate = sample_rate
+        self.resource = {"service.name": "text-generation-server", **resource_attributes}
+        self._exports = queue.Queue()
+
+        def export():
+            while True:
+                line = json.dumps(self._exports.get())
+                try:
+                    if path is not None:
+                        with open(path, "a") as f:
+                            f.write(line + "\n")
+                    if endpoint is not None:
+                        request = urllib.request.Request(
+                            endpoint, data=line.encode(), headers={"Content-Type": "application/json"}
+                        )
+                        urllib.request.urlopen(request, timeout=10).close()
+                except Exception as e:
+                    logger.warning(f"Unable to export a request trace: {e}")
+
+        thread = threading.Thread(target=export, name="traces-export", daemon=True)
+        thread.start()
+        logger.info(f"Tracing {sample_rate:.0%} of the requests to {path or endpoint}")
+        return thread
+
+    def queued(self, request_id: int, **attributes):
+        """Start tracing a new request (if it is sampled) when it is queued by the generator."""
+        if self.enabled and random.random() < self.sample_rate:
+            self._traces[request_id] = _Trace(request_id, **attributes)
+
+    def assigned(self, request_id: int, slot_id: int, **attributes):
+        """Record the assignment of a request to a slot, that ends its wait in the queue."""
+        trace = self._traces.get(request_id)
+        if trace is None:
+            return
+        trace.queue.end = time.time_ns()
+        trace.root.attributes["slot.id"] = slot_id
+        trace.root.attributes.update(attributes)
+
+    def prefill(self, request_ids: List[int], start: int, end: int, **attributes):
+        """Record a prefill forward of the generator.
+
+        Args:
+            request_ids (`List[int]`):
+                The requests whose prompt is encoded by the forward (including, for static batching, the requests
+                whose KV cache is rebuilt).
+            start (`int`):
+                The start time of the forward in nanoseconds since the epoch.
+            end (`int`):
+                The end time of the forward in nanoseconds since the epoch.
+            attributes:
+                The attributes of the prefilled batch.
+        """
+        if len(self._traces) == 0:
+            return
+        prefilled = set(request_ids)
+        for request_id, trace in self._traces.items():
+            if trace.last_token is not None:
+                # The generation of the request is paused by the prefill of other requests
+                name = "pause"
+            elif request_id in prefilled:
+                name = "prefill"
+            else:
+                continue
+            span = trace.child(name, start, **{"prefill.request_ids": request_ids}, **attributes)
+            span.end = end
+            trace.spans.append(span)
+
+    def token(self, request_id: int):
+        """Record a new token of a request."""
+        trace = self._traces.get(request_id)
+        if trace is None:
+            return
+        now = time.time_ns()
+        if trace.last_token is None:
+            trace.root.attributes["time_to_first_token_ms"] = (now - trace.root.start) / 1e6
+            trace.root.events.append((now, "first_token", {}))
+        else:
+            trace.root.events.append((now, "token", {"gap_ms": (now - trace.last_token) / 1e6}))
+        trace.last_token = now
+
+    def finished(self, request_id: int, finish_reason: str, **attributes):
+        """Record the end of a request and export its trace."""
+        trace = self._traces.pop(request_id, None)
+        if trace is None:
+            return
+        now = time.time_ns()
+        if trace.queue.end is None:
+            trace.queue.end = now
+        trace.root.end = now
+        trace.root.attributes["finish_reason"] = finish_reason
+        trace.root.attributes.update(attributes)
+        spans = [trace.root] + trace.spans
+        self._exports.put(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {"attributes": _attributes(self.resource)},
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": "text_generation_server"},
+                                "spans": [span.to_json() for span in spans],
+                            }
+                        ],
+                    }
+                ]
+            }
+        )
+
+
+TRACER = RequestTracer()